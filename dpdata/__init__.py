@@ -1,5 +1,4 @@
-from pkg_resources import resource_string
-import yaml
+import pkgutil
 
 
 __version__ = '0.5'
@@ -15,7 +14,7 @@ def expand_lists(data):
         name_0: val[0], name_1: val[1], ..., name_N: val[N]
     """
     newdict = data.copy()
-    for k, v in data.iteritems():
+    for k, v in data.items():
         if isinstance(v, list) or isinstance(v, tuple):
             d = dict([(k + '_' + str(i), e) for i, e in enumerate(v)])
             del newdict[k]
@@ -23,8 +22,42 @@ def expand_lists(data):
     return newdict
 
 
+_data_dict = None
+
+
+def _load_yaml(text):
+    import yaml
+    try:
+        import builtins
+    except ImportError:
+        import __builtin__ as builtins
+
+    class Loader(yaml.SafeLoader):
+        pass
+
+    # The data dictionary refers to conversion functions by name,
+    # only allow the Python builtins.
+    def builtin_name(loader, suffix, node):
+        try:
+            return getattr(builtins, suffix)
+        except AttributeError:
+            raise yaml.constructor.ConstructorError(
+                None, None, 'unknown function {0!r}'.format(suffix),
+                node.start_mark)
+
+    Loader.add_multi_constructor('tag:yaml.org,2002:python/name:',
+                                 builtin_name)
+    return yaml.load(text, Loader=Loader)
+
+
 def data_dictionary():
     """
-    Return the Deep Profiler data dictionary.
+    Return the Deep Profiler data dictionary. The file is only
+    parsed on the first call, the returned dictionary is shared
+    and must not be modified.
     """
-    return yaml.load(resource_string(__name__, 'data_dictionary.yaml'))
+    global _data_dict
+    if _data_dict is None:
+        _data_dict = _load_yaml(pkgutil.get_data(__name__,
+                                                 'data_dictionary.yaml'))
+    return _data_dict
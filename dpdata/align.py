@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""
+.. module:: align
+   :synopsis: Align sensor data-sets onto a common timebase.
+"""
+import numpy as np
+
+#: Supported alignment methods
+METHODS = ('linear', 'nearest', 'asof')
+
+
+def align(t, src_t, values, method='linear', max_gap=None):
+    """
+    Align sensor data onto a set of sample times. Target times which
+    are outside of the source time range, or further than *max_gap*
+    from the source samples used, are set to NaN.
+
+    Methods:
+
+    *linear*
+        linear interpolation between the source samples which bracket
+        each target time, *max_gap* limits the spacing of the
+        bracketing samples.
+    *nearest*
+        the nearest source sample, *max_gap* limits the distance to
+        the sample.
+    *asof*
+        the last source sample at or before each target time,
+        *max_gap* limits the age of the sample.
+
+    :param t: target times in microseconds since 1/1/1970 UTC
+    :param src_t: source sample times, in increasing order
+    :param values: dictionary of source columns
+    :param method: alignment method
+    :param max_gap: maximum gap in microseconds
+    :return: dictionary of float64 columns aligned onto *t*
+    """
+    if method not in METHODS:
+        raise ValueError('Unknown alignment method: {0}'.format(method))
+    t = np.asarray(t)
+    src_t = np.asarray(src_t)
+    n = len(src_t)
+    result = {}
+    if n == 0:
+        for name in values:
+            result[name] = np.full(len(t), np.nan)
+        return result
+
+    # The valid target points and (for nearest and asof) the source
+    # sample used for each point are found once for all of the columns.
+    hi = np.searchsorted(src_t, t, side='right')
+    if method == 'asof':
+        k = hi - 1
+        valid = k >= 0
+        k[~valid] = 0
+        if max_gap is not None:
+            valid &= (t - src_t[k]) <= max_gap
+    elif method == 'nearest':
+        lo = np.maximum(hi - 1, 0)
+        up = np.minimum(hi, n - 1)
+        use_up = np.abs(src_t[up] - t) < np.abs(t - src_t[lo])
+        k = np.where(use_up, up, lo)
+        valid = np.ones(len(t), dtype=bool)
+        if max_gap is not None:
+            valid &= np.abs(t - src_t[k]) <= max_gap
+    else:
+        valid = (t >= src_t[0]) & (t <= src_t[-1])
+        if max_gap is not None:
+            lo = np.maximum(hi - 1, 0)
+            up = np.minimum(hi, n - 1)
+            exact = src_t[lo] == t
+            valid &= exact | ((src_t[up] - src_t[lo]) <= max_gap)
+    idx = np.flatnonzero(valid)
+    tv = t[idx]
+    for name, v in values.items():
+        v = np.asarray(v, dtype='f8')
+        out = np.full(len(t), np.nan)
+        if method == 'linear':
+            out[idx] = np.interp(tv, src_t, v)
+        else:
+            out[idx] = v[k[idx]]
+        result[name] = out
+    return result
+
+
+class Source(object):
+    """
+    Sensor data stream for :func:`merge`.
+
+    :param stream: a :class:`pandas.DataFrame`, a dictionary of
+                   arrays or an iterator of either, e.g. from
+                   :func:`dpdata.sql.get_dataset` with *chunksize* or
+                   :func:`dpdata.mpk.iter_columns`. The data must be
+                   in time order.
+    :param columns: names of the columns to align
+    :param method: alignment method, see :func:`align`
+    :param max_gap: maximum gap in microseconds
+    :param prefix: prefix added to the output column names
+    """
+    def __init__(self, stream, columns, method='linear', max_gap=None,
+                 prefix=''):
+        if method not in METHODS:
+            raise ValueError('Unknown alignment method: {0}'.format(method))
+        self.chunks = _chunks(stream)
+        self.columns = list(columns)
+        self.method = method
+        self.max_gap = max_gap
+        self.prefix = prefix
+        self.t = np.zeros(0, dtype='i8')
+        self.values = dict([(c, np.zeros(0)) for c in self.columns])
+        self.done = False
+
+    def fill(self, t_end):
+        """
+        Read chunks until the buffer extends past *t_end* or the
+        stream is exhausted.
+        """
+        while not self.done and (len(self.t) == 0 or self.t[-1] < t_end):
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.done = True
+                break
+            t = np.asarray(chunk['timestamp'])
+            if len(t) == 0:
+                continue
+            self.t = np.concatenate((self.t, t))
+            for c in self.columns:
+                self.values[c] = np.concatenate((self.values[c],
+                                                 np.asarray(chunk[c])))
+
+    def discard(self, t):
+        """
+        Drop the buffered samples which are not needed for target
+        times after *t*, i.e. all but the last sample at or before *t*.
+        """
+        k = np.searchsorted(self.t, t, side='right') - 1
+        if k > 0:
+            self.t = self.t[k:]
+            for c in self.columns:
+                self.values[c] = self.values[c][k:]
+
+
+def _chunks(stream):
+    if hasattr(stream, 'columns') or isinstance(stream, dict):
+        return iter([stream])
+    return iter(stream)
+
+
+def merge(target, sources, columns=None):
+    """
+    Align one or more sensor streams onto the sample times of a
+    target stream. The streams are merged chunk by chunk, only the
+    source samples needed for the current target chunk are kept in
+    memory, so whole deployments can be processed from chunked SQL
+    queries or archive files.
+
+    :param target: target stream, in the same forms as
+                   :class:`Source` streams.
+    :param sources: list of :class:`Source`
+    :param columns: target columns to include in the output, the
+                    *timestamp* column is always included.
+    :return: iterator of :class:`pandas.DataFrame`, one per target
+             chunk.
+    """
+    import pandas as pd
+    for chunk in _chunks(target):
+        t = np.asarray(chunk['timestamp'])
+        out = {'timestamp': t}
+        names = ['timestamp']
+        for c in (columns or []):
+            if c != 'timestamp':
+                out[c] = np.asarray(chunk[c])
+                names.append(c)
+        if len(t):
+            for src in sources:
+                src.fill(t[-1])
+        for src in sources:
+            aligned = align(t, src.t, src.values, method=src.method,
+                            max_gap=src.max_gap)
+            for c in src.columns:
+                out[src.prefix + c] = aligned[c]
+                names.append(src.prefix + c)
+            if len(t):
+                src.discard(t[-1])
+        yield pd.DataFrame(out, columns=names)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+.. module:: cache
+   :synopsis: Local on-disk cache of data-set query results.
+"""
+import os
+import hashlib
+import numpy as np
+from dpdata.sql import database, dataset_query
+
+
+class DatasetCache(object):
+    """
+    Opt-in on-disk cache for :func:`dpdata.sql.get_dataset`. Query
+    results are split into fixed-length time blocks and each block is
+    stored as a NumPy ``.npz`` file keyed by database URL, table,
+    column list and block start time. Text columns are stored as
+    fixed-width strings, so the files can be loaded without pickle.
+    The missing blocks of a request are read with one query per run
+    of consecutive blocks. A block is only cached once the end time of its
+    table (see :func:`dpdata.sql.get_time_range`) has moved past the
+    end of the block, so the still-growing tail of a table is always
+    read from the database. This assumes that rows are only added to
+    the end of a table, use :meth:`clear` after back-filling older
+    data.
+
+    The least recently used blocks are removed when the total size of
+    the cache exceeds *max_bytes*.
+
+    :param directory: cache directory
+    :param max_bytes: maximum total size of the cache files
+    :param block: block length in microseconds, the default is one day.
+    """
+    def __init__(self, directory, max_bytes=1 << 30, block=86400000000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.block = block
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, url, table, columns, bstart):
+        key = ','.join(columns) if columns is not None else '*'
+        # The database URL is hashed so no password is written to disk
+        digest = hashlib.sha1('{0}|{1}'.format(url, key).encode(
+            'utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, table, digest,
+                            '{0:d}.npz'.format(bstart))
+
+    def _load(self, path):
+        import pandas as pd
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                names = [str(name) for name in npz['__columns__']]
+                cols = {}
+                for i, name in enumerate(names):
+                    v = npz['c{0:d}'.format(i)]
+                    mkey = 'm{0:d}'.format(i)
+                    if mkey in npz.files:
+                        # Text column, restore the NULL values
+                        v = v.astype(object)
+                        v[npz[mkey]] = None
+                    cols[name] = v
+                df = pd.DataFrame(cols, columns=names)
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+        # Mark the block as recently used
+        os.utime(path, None)
+        return df
+
+    def _store(self, path, df):
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        arrays = {}
+        for i, name in enumerate(df.columns):
+            v = df[name].values
+            if v.dtype == object:
+                isnull = np.array([x is None for x in v], dtype=bool)
+                arrays['m{0:d}'.format(i)] = isnull
+                v = np.array(['' if x is None else x for x in v],
+                             dtype=np.str_)
+            arrays['c{0:d}'.format(i)] = v
+        arrays['__columns__'] = np.array([str(c) for c in df.columns],
+                                         dtype=np.str_)
+        tmpfile = path + '.tmp'
+        with open(tmpfile, 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(tmpfile, path)
+
+    def _files(self):
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                if name.endswith('.npz'):
+                    path = os.path.join(dirpath, name)
+                    st = os.stat(path)
+                    yield st.st_mtime, st.st_size, path
+
+    def size(self):
+        """
+        Return the total size of the cache files in bytes.
+        """
+        return sum([size for _, size, _ in self._files()])
+
+    def evict(self):
+        """
+        Remove the least recently used blocks until the cache size
+        is below the limit.
+        """
+        files = sorted(self._files())
+        total = sum([size for _, size, _ in files])
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def clear(self, table=None):
+        """
+        Remove all cached blocks, or all cached blocks of a table.
+
+        :param table: SQL table name
+        """
+        top = self.directory
+        if table is not None:
+            top = os.path.join(top, table)
+        for _, _, path in list(self._files()):
+            if path.startswith(top + os.sep):
+                os.remove(path)
+
+    def get_dataset(self, eng, table, t_start=0, t_end=0, columns=None):
+        """
+        Return a data-set, see :func:`dpdata.sql.get_dataset`.
+
+        :param eng: SQLAlchemy database engine or
+                    :class:`dpdata.sql.DPDatabase`
+        :param table: SQL table name
+        :param t_start: start time (in microseconds since 1/1/1970 UTC)
+        :param t_end: end time
+        :param columns: list of column names to select
+        :rtype: :class:`pandas.DataFrame`
+        """
+        import pandas as pd
+        db = database(eng)
+        t0, t1 = db.get_time_range(table)
+        if t1 == 0:
+            return db.get_dataset(table, t_start, t_end, columns=columns)
+        if t_start == 0 and t_end == 0:
+            lo, hi = t0, t1
+        elif t_end == 0:
+            lo, hi = t_start, t1
+        else:
+            lo, hi = t_start, min(t_end, t1)
+        if lo > hi:
+            return db.get_dataset(table, t_start, t_end, columns=columns)
+
+        tbl = db.table(table)
+        base = dataset_query(tbl, columns=columns)
+        url = str(db.eng.url)
+        blocks = [b * self.block
+                  for b in range(lo // self.block, hi // self.block + 1)]
+        frames = {}
+        for bstart in blocks:
+            if bstart + self.block <= t1:
+                df = self._load(self._path(url, table, columns, bstart))
+                if df is not None:
+                    frames[bstart] = df
+        # Read each run of consecutive missing blocks with one query
+        stored = False
+        missing = [bstart for bstart in blocks if bstart not in frames]
+        while missing:
+            n = 1
+            while n < len(missing) and \
+                    missing[n] == missing[0] + n * self.block:
+                n += 1
+            run, missing = missing[:n], missing[n:]
+            query = base.where(tbl.c.timestamp >= run[0]).where(
+                tbl.c.timestamp < run[-1] + self.block)
+            df = pd.read_sql_query(query, db.eng)
+            edges = np.searchsorted(df['timestamp'].values,
+                                    run + [run[-1] + self.block])
+            for k, bstart in enumerate(run):
+                part = df.iloc[edges[k]:edges[k + 1]].reset_index(drop=True)
+                frames[bstart] = part
+                if bstart + self.block <= t1:
+                    self._store(self._path(url, table, columns, bstart),
+                                part)
+                    stored = True
+        if stored:
+            self.evict()
+        frames = [frames[bstart] for bstart in blocks]
+
+        nonempty = [df for df in frames if len(df)]
+        if nonempty:
+            df = pd.concat(nonempty, ignore_index=True)
+        else:
+            df = frames[0]
+        if t_start == 0 and t_end == 0:
+            return df
+        if t_end == 0:
+            mask = df['timestamp'] > t_start
+        else:
+            mask = (df['timestamp'] >= t_start) & (df['timestamp'] <= t_end)
+        return df[mask].reset_index(drop=True)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""
+.. module:: colstore
+   :synopsis: Memory-mapped columnar data archive.
+"""
+import os
+import json
+import msgpack
+import numpy as np
+from dpdata.mpk import ColumnBuilder, _sensor_schema
+
+#: Name of the archive header file
+HEADER = 'header.json'
+_VERSION = 1
+#: Initial storage type of text columns, the width is doubled when
+#: a longer value is added.
+TEXT_DTYPE = 'S32'
+
+
+def _dtypes(sch):
+    dtypes = [('timestamp', '<i8')]
+    for name in sch.columns:
+        if sch.dtypes[name] == 'O':
+            dtypes.append((name, TEXT_DTYPE))
+        else:
+            dtypes.append((name, '<' + sch.dtypes[name]))
+    return dtypes
+
+
+def _encode(values):
+    return np.array([b'' if v is None else
+                     (v if isinstance(v, bytes) else
+                      u'{0}'.format(v).encode('utf-8'))
+                     for v in values], dtype='S')
+
+
+def _is_text(dtype):
+    return np.dtype(dtype).kind == 'S'
+
+
+class ColumnStore(object):
+    """
+    Columnar archive of the data from a single sensor. Each column
+    is stored in a separate raw binary file (*<name>.bin*) with a
+    fixed dtype derived from the data dictionary, numeric variables
+    are float64 (NaN for missing values) and text variables are
+    fixed-width byte strings. A text column is rewritten with a wider
+    type (in a new file, *<name>.S<width>.bin*) when a longer value is
+    added. A JSON header records the column
+    dtypes, the number of rows and, for each MessagePack file which
+    has been added, the number of bytes read so growing files can be
+    appended incrementally with :meth:`add_file`.
+
+    The columns are read with :func:`numpy.memmap` so reading a time
+    window from a large archive only touches the pages which are
+    needed. The rows of each added chunk are sorted by time, if the
+    chunks themselves are out of order the *sorted* header flag is
+    cleared and time windows are selected with a mask instead of a
+    binary search.
+
+    :param directory: archive directory
+    :param sensor: sensor name or :class:`dpdata.schema.SensorSchema`,
+                   only needed to create a new archive.
+    :param data_dict: data dictionary or :class:`dpdata.schema.Schema`
+    """
+    def __init__(self, directory, sensor=None, data_dict=None):
+        self.directory = directory
+        path = os.path.join(directory, HEADER)
+        sch = None
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.header = json.load(f)
+            self._truncate()
+        else:
+            if sensor is None:
+                raise IOError('No archive in {0}'.format(directory))
+            sch = _sensor_schema(sensor, data_dict)
+            self.header = {'version': _VERSION,
+                           'sensor': sch.name,
+                           'nrows': 0,
+                           'sorted': True,
+                           'columns': _dtypes(sch),
+                           'sources': {}}
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._write_header()
+        self._maps = {}
+        self._sch = sch
+        self._data_dict = data_dict
+
+    def __len__(self):
+        return self.header['nrows']
+
+    @property
+    def columns(self):
+        """
+        Column names, starting with *timestamp*.
+        """
+        return [name for name, _ in self.header['columns']]
+
+    def _path(self, name, dtype=None):
+        if dtype is None:
+            dtype = dict(self.header['columns'])[name]
+        if _is_text(dtype) and dtype != TEXT_DTYPE:
+            return os.path.join(self.directory,
+                                '{0}.{1}.bin'.format(name, dtype))
+        return os.path.join(self.directory, name + '.bin')
+
+    def _write_header(self):
+        path = os.path.join(self.directory, HEADER)
+        tmpfile = path + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(self.header, f, indent=1, sort_keys=True)
+        os.rename(tmpfile, path)
+
+    def _truncate(self):
+        # Discard any rows written after the last header update (e.g.
+        # by an interrupted conversion).
+        n = self.header['nrows']
+        for name, dtype in self.header['columns']:
+            path = self._path(name, dtype)
+            size = n * np.dtype(dtype).itemsize
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+
+    def __getitem__(self, name):
+        """
+        Return a read-only memory-mapped column.
+        """
+        n = self.header['nrows']
+        a = self._maps.get(name)
+        if a is None or len(a) != n:
+            dtype = np.dtype(dict(self.header['columns'])[name])
+            if n == 0:
+                a = np.empty(0, dtype=dtype)
+            else:
+                a = np.memmap(self._path(name), dtype=dtype, mode='r',
+                              shape=(n,))
+            self._maps[name] = a
+        return a
+
+    def append(self, cols):
+        """
+        Append rows to the archive.
+
+        :param cols: dictionary of column arrays, e.g. from
+                     :func:`dpdata.mpk.iter_columns`
+        :return: number of rows added
+        """
+        t = np.asarray(cols['timestamp'], dtype='i8')
+        if len(t) == 0:
+            return 0
+        order = np.argsort(t, kind='mergesort')
+        if len(self) and t[order[0]] < self['timestamp'][-1]:
+            self.header['sorted'] = False
+        for name, dtype in self.header['columns']:
+            values = cols[name]
+            if _is_text(dtype):
+                a = _encode(values)
+                if a.dtype.itemsize > np.dtype(dtype).itemsize:
+                    dtype = self._widen(name, a.dtype.itemsize)
+                a = a.astype(dtype)
+            else:
+                a = np.asarray(values, dtype=dtype)
+            with open(self._path(name, dtype), 'ab') as f:
+                a[order].tofile(f)
+        self.header['nrows'] += len(t)
+        return len(t)
+
+    def _widen(self, name, width):
+        # Copy a text column to a new file with a type wide enough for
+        # *width* bytes. The header is updated before the old file is
+        # removed, so an interrupted copy leaves the archive intact.
+        columns = self.header['columns']
+        k = [c for c, _ in columns].index(name)
+        old = columns[k][1]
+        size = np.dtype(old).itemsize
+        while size < width:
+            size *= 2
+        new = 'S{0:d}'.format(size)
+        path = self._path(name, new)
+        self[name].astype(new).tofile(path)
+        self._maps.pop(name, None)
+        columns[k] = (name, new)
+        self._write_header()
+        if os.path.exists(self._path(name, old)):
+            os.remove(self._path(name, old))
+        return new
+
+    def add_file(self, filename, chunksize=100000):
+        """
+        Append the new records from a MessagePack file. Only the part
+        of the file which was not read by an earlier call is decoded,
+        a partial record at the end of the file is left for the next
+        call. A file which has shrunk since it was added raises
+        :class:`IOError`, the archive must be rebuilt.
+
+        :param filename: MessagePack data file
+        :param chunksize: number of records decoded at a time
+        :return: number of rows added
+        """
+        key = os.path.abspath(filename)
+        offset = self.header['sources'].get(key, 0)
+        size = os.path.getsize(filename)
+        if size < offset:
+            raise IOError('{0} is smaller than when it was added, it has '
+                          'been truncated or replaced'.format(filename))
+        if size == offset:
+            return 0
+        if self._sch is None:
+            self._sch = _sensor_schema(self.header['sensor'],
+                                       self._data_dict)
+        builder = ColumnBuilder(self._sch, capacity=chunksize)
+        nrows = 0
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            unpacker = msgpack.Unpacker(f)
+            end = offset
+            for secs, usecs, data in unpacker:
+                builder.append(secs, usecs, data)
+                end = offset + unpacker.tell()
+                if len(builder) >= chunksize:
+                    nrows += self._commit(builder, key, end)
+            nrows += self._commit(builder, key, end)
+        return nrows
+
+    def _commit(self, builder, key, end):
+        n = self.append(builder.columns())
+        builder.reset()
+        self.header['sources'][key] = end
+        self._write_header()
+        return n
+
+    def window(self, t_start=0, t_end=0):
+        """
+        Return the rows within a time window. The window is the same
+        as for :func:`dpdata.sql.get_dataset`.
+
+        :param t_start: start time (in microseconds since 1/1/1970 UTC)
+        :param t_end: end time
+        :return: a slice, or a boolean mask if the archive is not in
+                 time order.
+        """
+        t = self['timestamp']
+        if t_start == 0 and t_end == 0:
+            return slice(0, len(t))
+        if not self.header['sorted']:
+            if t_end == 0:
+                return t > t_start
+            return (t >= t_start) & (t <= t_end)
+        if t_end == 0:
+            return slice(np.searchsorted(t, t_start, side='right'), len(t))
+        return slice(np.searchsorted(t, t_start, side='left'),
+                     np.searchsorted(t, t_end, side='right'))
+
+    def get(self, t_start=0, t_end=0, columns=None):
+        """
+        Return the columns within a time window. When the archive is
+        in time order the arrays are views of the memory-mapped files.
+
+        :param t_start: start time (in microseconds since 1/1/1970 UTC)
+        :param t_end: end time
+        :param columns: list of column names, the *timestamp* column is
+                        always included.
+        :rtype: dict
+        """
+        if columns is None:
+            columns = self.columns
+        elif 'timestamp' not in columns:
+            columns = ['timestamp'] + list(columns)
+        sel = self.window(t_start, t_end)
+        return dict([(name, self[name][sel]) for name in columns])
+
+    def get_dataset(self, t_start=0, t_end=0, columns=None):
+        """
+        Return the columns within a time window as a DataFrame (this
+        copies the data).
+
+        :rtype: :class:`pandas.DataFrame`
+        """
+        import pandas as pd
+        cols = self.get(t_start, t_end, columns)
+        names = [c for c in self.columns if c in cols]
+        return pd.DataFrame(dict([(c, np.array(cols[c])) for c in names]),
+                            columns=names)
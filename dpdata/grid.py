@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+"""
+.. module:: grid
+   :synopsis: Bin profile data onto a fixed pressure grid.
+"""
+import os
+import numpy as np
+
+
+#: Supported bin statistics
+STATS = ('mean', 'median', 'count')
+
+
+def pressure_bins(pmin, pmax, dp):
+    """
+    Return the bin edges of a regular pressure grid.
+
+    :param pmin: minimum pressure in dbar
+    :param pmax: maximum pressure in dbar
+    :param dp: bin size in dbar
+    :rtype: numpy array
+    """
+    n = int(np.ceil((pmax - pmin) / float(dp)))
+    return pmin + dp * np.arange(n + 1, dtype='f8')
+
+
+def bin_stat(index, values, size, stat='mean'):
+    """
+    Reduce values into bins. Bins without any values are set to NaN
+    (or 0 for *count*).
+
+    :param index: bin index of each value
+    :type index: numpy integer array
+    :param values: values to reduce, NaNs must already be removed.
+    :type values: numpy array
+    :param size: number of bins
+    :param stat: one of *mean*, *median* or *count*
+    :rtype: numpy array
+    """
+    count = np.bincount(index, minlength=size)
+    if stat == 'count':
+        return count
+    result = np.empty(size, dtype='f8')
+    result.fill(np.nan)
+    ok = count > 0
+    if stat == 'mean':
+        total = np.bincount(index, weights=values, minlength=size)
+        result[ok] = total[ok] / count[ok]
+    elif stat == 'median':
+        # Sort by bin then value, the median of each bin is then found
+        # from the bin's offset into the sorted values.
+        order = np.lexsort((values, index))
+        v = values[order]
+        start = np.cumsum(count) - count
+        n = count[ok]
+        lo = start[ok] + (n - 1) // 2
+        hi = start[ok] + n // 2
+        result[ok] = 0.5 * (v[lo] + v[hi])
+    else:
+        raise ValueError('Unknown statistic: {0}'.format(stat))
+    return result
+
+
+def grid_values(pnum, pressure, values, edges, pnums=None, stat='mean'):
+    """
+    Bin the values from many profiles onto a pressure grid in a
+    single pass.
+
+    :param pnum: profile number of each sample
+    :param pressure: pressure of each sample in dbar
+    :param values: sample values
+    :param edges: pressure bin edges from :func:`pressure_bins`
+    :param pnums: profile numbers of the grid columns, defaults to the
+                  sorted unique values of *pnum*.
+    :param stat: one of *mean*, *median* or *count*
+    :return: tuple of profile numbers and 2-D array with one row per
+             pressure bin and one column per profile.
+    """
+    pnum = np.asarray(pnum)
+    pressure = np.asarray(pressure, dtype='f8')
+    values = np.asarray(values, dtype='f8')
+    if pnums is None:
+        pnums = np.unique(pnum)
+    else:
+        pnums = np.asarray(pnums)
+    nbins = len(edges) - 1
+    col = np.searchsorted(pnums, pnum)
+    row = np.searchsorted(edges, pressure, side='right') - 1
+    col_ok = col < len(pnums)
+    col_ok[col_ok] = pnums[col[col_ok]] == pnum[col_ok]
+    keep = col_ok & (row >= 0) & (row < nbins) & ~np.isnan(values)
+    index = row[keep] * len(pnums) + col[keep]
+    result = bin_stat(index, values[keep], nbins * len(pnums), stat=stat)
+    return pnums, result.reshape((nbins, len(pnums)))
+
+
+def interp_pressure(t, ctd, pnum=None):
+    """
+    Interpolate the CTD pressure onto a set of sample times.
+
+    :param t: sample times in microseconds since 1/1/1970 UTC
+    :param ctd: CTD data-set with *timestamp* and *preswat* columns
+    :type ctd: :class:`pandas.DataFrame`
+    :param pnum: profile number of each sample, if given the CTD
+                 data-set must have a *pnum* column and the pressure
+                 is only interpolated between CTD samples from the
+                 same profile.
+    :returns: pressure in dbar, NaN outside of the CTD time range
+              and for profiles without any CTD samples.
+    """
+    t = np.asarray(t)
+    ctd_t = np.asarray(ctd['timestamp'])
+    nan = float('NaN')
+    if len(ctd_t) == 0:
+        return np.zeros(len(t)) + nan
+    order = np.argsort(ctd_t, kind='mergesort')
+    ctd_t = ctd_t[order]
+    p = np.interp(t, ctd_t, np.asarray(ctd['preswat'], dtype='f8')[order],
+                  left=nan, right=nan)
+    if pnum is not None:
+        # Samples which are not bracketed by CTD samples from their
+        # own profile.
+        ctd_pnum = np.asarray(ctd['pnum'])[order]
+        pnum = np.asarray(pnum)
+        hi = np.minimum(np.searchsorted(ctd_t, t), len(ctd_t) - 1)
+        lo = np.maximum(np.searchsorted(ctd_t, t, side='right') - 1, 0)
+        p[(ctd_pnum[lo] != pnum) | (ctd_pnum[hi] != pnum)] = nan
+    return p
+
+
+class ProfileGrid(object):
+    """
+    Depth-by-profile grid of one or more variables. Each variable is
+    stored as a 2-D array with one row per pressure bin and one
+    column per profile. The columns are sorted by profile number and
+    :attr:`time` holds the time of the first sample of each profile
+    (in microseconds since 1/1/1970 UTC).
+
+    Profiles are independent of each other, so new profiles can be
+    added at any time with :meth:`add` or :meth:`update`; a profile
+    which is added again replaces the existing column. The profiles
+    which have been gridded are tracked separately for each variable
+    in :attr:`done` so variables from different tables can be added
+    to the same grid.
+
+    :param edges: pressure bin edges from :func:`pressure_bins`
+    :param stat: one of *mean*, *median* or *count*
+    """
+    def __init__(self, edges, stat='mean'):
+        if stat not in STATS:
+            raise ValueError('Unknown statistic: {0}'.format(stat))
+        self.edges = np.asarray(edges, dtype='f8')
+        self.stat = stat
+        self.pnums = np.zeros(0, dtype='i8')
+        self.time = np.zeros(0, dtype='i8')
+        self.data = {}
+        self.done = {}
+
+    @property
+    def centers(self):
+        """
+        Pressure at the center of each bin.
+        """
+        return 0.5 * (self.edges[:-1] + self.edges[1:])
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+    def _empty(self, ncols):
+        dtype = 'i8' if self.stat == 'count' else 'f8'
+        a = np.zeros((len(self.edges) - 1, ncols), dtype=dtype)
+        if self.stat != 'count':
+            a.fill(np.nan)
+        return a
+
+    def add(self, df, variables, pressure=None):
+        """
+        Add profiles to the grid.
+
+        :param df: data-set with *timestamp* and *pnum* columns, e.g.
+                   from :func:`dpdata.sql.get_profile_datasets` with
+                   *grouped=False*.
+        :type df: :class:`pandas.DataFrame`
+        :param variables: names of the columns to grid
+        :param pressure: sample pressures, defaults to the *preswat*
+                         column.
+        """
+        if len(df) == 0:
+            return
+        pnum = np.asarray(df['pnum'])
+        t = np.asarray(df['timestamp'])
+        if pressure is None:
+            pressure = df['preswat']
+        # Time of the first sample of each profile
+        order = np.argsort(pnum, kind='mergesort')
+        sp = pnum[order]
+        starts = np.flatnonzero(np.r_[True, sp[1:] != sp[:-1]])
+        new = sp[starts]
+        tnew = np.minimum.reduceat(t[order], starts)
+        pnums = np.union1d(self.pnums, new)
+        old_cols = np.searchsorted(pnums, self.pnums)
+        new_cols = np.searchsorted(pnums, new)
+        time = np.empty(len(pnums), dtype='i8')
+        time.fill(np.iinfo('i8').max)
+        time[old_cols] = self.time
+        time[new_cols] = np.minimum(time[new_cols], tnew)
+        for name in set(self.data) | set(variables):
+            a = self._empty(len(pnums))
+            if name in self.data:
+                a[:, old_cols] = self.data[name]
+            if name in variables:
+                _, g = grid_values(pnum, pressure, df[name], self.edges,
+                                   pnums=new, stat=self.stat)
+                a[:, new_cols] = g
+                self.done.setdefault(name, set()).update(new.tolist())
+            self.data[name] = a
+        self.pnums = pnums
+        self.time = time
+
+    def update(self, db, table, variables, ctd_table='ctd_1'):
+        """
+        Add the completed profiles which are not already in the grid.
+        Samples from tables without a *preswat* column are located
+        using the pressure interpolated from the CTD table.
+
+        :param db: database interface
+        :type db: :class:`dpdata.sql.DPDatabase`
+        :param table: SQL table name
+        :param variables: names of the columns to grid
+        :param ctd_table: CTD table name
+        :return: number of profiles processed
+        """
+        complete = set([p.pnum for p in db.get_profiles()
+                        if p.end is not None])
+        pnums = set()
+        for name in variables:
+            pnums.update(complete - self.done.get(name, set()))
+        if not pnums:
+            return 0
+        pnums = sorted(pnums)
+        columns = list(variables)
+        use_ctd = 'preswat' not in db.table(table).c
+        if not use_ctd and 'preswat' not in columns:
+            columns.append('preswat')
+        df = db.get_profile_datasets(table, pnums, columns=columns,
+                                     grouped=False)
+        pressure = None
+        if use_ctd:
+            ctd = db.get_profile_datasets(ctd_table, pnums,
+                                          columns=['preswat'],
+                                          grouped=False)
+            pressure = interp_pressure(df['timestamp'], ctd,
+                                       pnum=df['pnum'])
+        self.add(df, variables, pressure=pressure)
+        # Profiles without any samples are not retried
+        for name in variables:
+            self.done.setdefault(name, set()).update(pnums)
+        return len(pnums)
+
+    def save(self, path):
+        """
+        Save the grid to a NumPy ``.npz`` file.
+        """
+        names = sorted(self.data)
+        arrays = dict([('v{0:d}'.format(i), self.data[name])
+                       for i, name in enumerate(names)])
+        arrays.update([('d{0:d}'.format(i),
+                        np.array(sorted(self.done.get(name, ())), dtype='i8'))
+                       for i, name in enumerate(names)])
+        # Fixed-width strings so the file loads without pickle
+        arrays['__names__'] = np.array(names, dtype='U')
+        arrays['__stat__'] = np.array(self.stat, dtype='U')
+        tmpfile = path + '.tmp'
+        with open(tmpfile, 'wb') as f:
+            np.savez(f, edges=self.edges, pnums=self.pnums, time=self.time,
+                     **arrays)
+        os.rename(tmpfile, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a grid saved with :meth:`save`.
+        """
+        with np.load(path, allow_pickle=False) as npz:
+            grid = cls(npz['edges'], stat=str(npz['__stat__']))
+            grid.pnums = npz['pnums']
+            grid.time = npz['time']
+            for i, name in enumerate(npz['__names__'].tolist()):
+                grid.data[name] = npz['v{0:d}'.format(i)]
+                grid.done[name] = set(npz['d{0:d}'.format(i)].tolist())
+        return grid
@@ -3,19 +3,95 @@
 .. module:: mpk
    :synopsis: read MessagePack-format data.
 """
+import os
+import time
+import struct
 import msgpack
+import numpy as np
+from operator import itemgetter
+from dpdata.schema import get_schema, SensorSchema
 
 
-def get_records(infile):
+#: File name suffix of the sidecar time index
+INDEX_SUFFIX = '.idx'
+_INDEX_MAGIC = b'DPIX'
+_INDEX_VERSION = 1
+# magic, version, stride, number of records, bytes indexed
+_INDEX_HEADER = struct.Struct('<4sHxxiqq')
+
+
+def get_records(infile, t_start=None, t_end=None, index=None):
     """
-    Iterate over all of the records in a MessagePack file.
+    Iterate over all of the records in a MessagePack file. If a time
+    window is specified, only the records within the window are
+    returned and the sidecar time index (see :func:`build_index`) is
+    used, if available, to seek to the start of the window. The
+    records in the file must be in time order.
 
     :param infile: input data file.
+    :param t_start: start time (in microseconds since 1/1/1970 UTC)
+    :param t_end: end time
+    :param index: time index as returned by :func:`load_index`, if
+                  not specified, the index is loaded from the sidecar
+                  file of *infile*. An index which covers more bytes
+                  than the file holds is ignored.
     """
+    if t_start is None and t_end is None:
+        for secs, usecs, data in msgpack.Unpacker(infile):
+            yield secs, usecs, data
+        return
+
+    offset = 0
+    if t_start is not None:
+        if index is None and hasattr(infile, 'name'):
+            index = load_index(index_path(infile.name))
+        if index is not None and index.length > _file_size(infile):
+            # The archive has been truncated or replaced since it
+            # was indexed.
+            index = None
+        if index is not None:
+            offset = index.offset(t_start)
+    infile.seek(offset)
     for secs, usecs, data in msgpack.Unpacker(infile):
+        t = secs * 1000000 + usecs
+        if t_start is not None and t < t_start:
+            continue
+        if t_end is not None and t > t_end:
+            break
         yield secs, usecs, data
 
 
+def _file_size(infile):
+    try:
+        return os.fstat(infile.fileno()).st_size
+    except (AttributeError, IOError, OSError, ValueError):
+        # Not a real file (e.g. BytesIO)
+        pos = infile.tell()
+        infile.seek(0, os.SEEK_END)
+        size = infile.tell()
+        infile.seek(pos)
+        return size
+
+
+def scan_records(infile, offset=0):
+    """
+    Iterate over the records in a MessagePack file starting at a
+    byte offset. Each record is returned along with its offset in
+    the file. A partial record at the end of the file (from a file
+    which is still being written) is not returned.
+
+    :param infile: input data file.
+    :param offset: starting offset, this must be on a record boundary.
+    :return: tuple of offset, seconds, microseconds, data
+    """
+    infile.seek(offset)
+    unpacker = msgpack.Unpacker(infile)
+    pos = offset
+    for secs, usecs, data in unpacker:
+        yield pos, secs, usecs, data
+        pos = offset + unpacker.tell()
+
+
 def put_record(outfile, secs, usecs, data):
     """
     Append a record to a MessagePack file.
@@ -29,3 +105,434 @@ def put_record(outfile, secs, usecs, data):
     :param data: data object
     """
     outfile.write(msgpack.packb([secs, usecs, data]))
+
+
+class ArchiveWriter(object):
+    """
+    Buffered writer for MessagePack archives. Records are packed with
+    a single reusable :class:`msgpack.Packer` and written to the file
+    in one call when the buffer reaches *max_buffer* bytes or the
+    oldest buffered record is more than *max_delay* seconds old. The
+    delay is only checked when a record is written, call
+    :meth:`flush` to write the buffer during idle periods. The files
+    are readable with :func:`get_records`.
+
+    If *max_size* or *max_age* is set the output is rotated, each file
+    is named from the start time of the data it holds, e.g.
+    ``<prefix>_20150101T120000.mpk``. With *max_age*, the start time is
+    rounded down to a multiple of *max_age* so the name of the file
+    for a record can be predicted from its timestamp. Otherwise all
+    records are appended to ``<prefix>.mpk``.
+
+    The *fsync* policy selects when the data is forced to disk,
+    ``none`` leaves it to the operating system, ``flush`` syncs after
+    each write of the buffer and ``close`` when each file is closed.
+
+    :param prefix: output file name prefix, including the directory
+    :param max_buffer: maximum buffer size in bytes
+    :param max_delay: maximum time in seconds a record is buffered
+    :param max_size: rotate when a file reaches this size in bytes
+    :param max_age: rotate when the data time moves into a new
+                    interval of this many seconds
+    :param fsync: one of ``none``, ``flush`` or ``close``
+    :param suffix: output file name suffix
+    """
+    def __init__(self, prefix, max_buffer=65536, max_delay=1.0,
+                 max_size=None, max_age=None, fsync='none', suffix='.mpk'):
+        if fsync not in ('none', 'flush', 'close'):
+            raise ValueError('Bad fsync policy: {0}'.format(fsync))
+        self.prefix = prefix
+        self.suffix = suffix
+        self.max_buffer = max_buffer
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self.max_age = max_age
+        self.fsync = fsync
+        self.filename = None
+        self._file = None
+        self._size = 0
+        self._period = None
+        self._buffer = []
+        self._buffered = 0
+        self._oldest = None
+        self._packer = msgpack.Packer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _name(self, secs):
+        if self.max_size is None and self.max_age is None:
+            return self.prefix + self.suffix
+        if self.max_age is not None:
+            secs -= secs % self.max_age
+        stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime(secs))
+        return '{0}_{1}{2}'.format(self.prefix, stamp, self.suffix)
+
+    def _open(self, secs, fresh=False):
+        name = self._name(secs)
+        if fresh:
+            # A size rotation within the same second, pick an unused
+            # name rather than appending to the file just closed.
+            base, n = name[:-len(self.suffix)], 1
+            while os.path.exists(name):
+                name = '{0}.{1:d}{2}'.format(base, n, self.suffix)
+                n += 1
+        self._file = open(name, 'ab')
+        self.filename = name
+        self._size = self._file.tell()
+        if self.max_age is not None:
+            self._period = secs // self.max_age
+
+    def write(self, secs, usecs, data):
+        """
+        Add a record to the archive.
+
+        :param secs: timestamp in seconds since 1/1/1970 UTC
+        :param usecs: microsecond component of the timestamp
+        :param data: data object
+        """
+        if self._file is None:
+            self._open(secs)
+        elif self.max_age is not None and \
+                secs // self.max_age != self._period:
+            self._rotate(secs)
+        elif self.max_size is not None and \
+                self._size + self._buffered >= self.max_size:
+            self._rotate(secs, fresh=True)
+        buf = self._packer.pack([secs, usecs, data])
+        self._buffer.append(buf)
+        self._buffered += len(buf)
+        now = time.time()
+        if self._oldest is None:
+            self._oldest = now
+        if self._buffered >= self.max_buffer or \
+                now - self._oldest >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered records to the current file.
+        """
+        if self._buffer and self._file is not None:
+            self._file.write(b''.join(self._buffer))
+            self._file.flush()
+            if self.fsync == 'flush':
+                os.fsync(self._file.fileno())
+            self._size += self._buffered
+        self._buffer = []
+        self._buffered = 0
+        self._oldest = None
+
+    def _close_file(self):
+        if self._file is not None:
+            self.flush()
+            if self.fsync == 'close':
+                os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+    def _rotate(self, secs, fresh=False):
+        self._close_file()
+        self._open(secs, fresh=fresh)
+
+    def close(self):
+        """
+        Flush the buffer and close the current file.
+        """
+        self._close_file()
+
+
+def index_path(filename):
+    """
+    Return the name of the sidecar index file for an archive.
+    """
+    return filename + INDEX_SUFFIX
+
+
+class TimeIndex(object):
+    """
+    Sparse time index for a MessagePack archive. The index contains
+    the timestamp and byte offset of every *stride* records.
+
+    :param stride: number of records between index entries
+    :param nrecs: number of records indexed
+    :param length: number of bytes of the archive indexed
+    :param entries: Nx2 array of (timestamp, offset) entries
+    """
+    def __init__(self, stride, nrecs=0, length=0, entries=None):
+        self.stride = stride
+        self.nrecs = nrecs
+        self.length = length
+        if entries is None:
+            entries = np.empty((0, 2), dtype='<i8')
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def offset(self, t):
+        """
+        Return the byte offset at which to start reading in order
+        to find the first record with a timestamp >= *t*.
+        """
+        i = np.searchsorted(self.entries[:, 0], t, side='left') - 1
+        if i < 0:
+            return 0
+        return int(self.entries[i, 1])
+
+    def tobytes(self):
+        hdr = _INDEX_HEADER.pack(_INDEX_MAGIC, _INDEX_VERSION,
+                                 self.stride, self.nrecs, self.length)
+        return hdr + self.entries.astype('<i8').tobytes()
+
+    @classmethod
+    def frombytes(cls, buf):
+        magic, version, stride, nrecs, length = \
+            _INDEX_HEADER.unpack_from(buf)
+        if magic != _INDEX_MAGIC or version != _INDEX_VERSION:
+            raise ValueError('Invalid index file')
+        entries = np.frombuffer(buf, dtype='<i8',
+                                offset=_INDEX_HEADER.size).reshape((-1, 2))
+        return cls(stride, nrecs, length, entries)
+
+
+def load_index(filename):
+    """
+    Load a time index file.
+
+    :param filename: index file name
+    :return: time index or ``None`` if the index does not exist
+    :rtype: :class:`TimeIndex`
+    """
+    try:
+        with open(filename, 'rb') as f:
+            return TimeIndex.frombytes(f.read())
+    except (IOError, OSError, ValueError, struct.error):
+        return None
+
+
+def build_index(filename, stride=1000):
+    """
+    Create or update the sidecar time index for a MessagePack
+    archive. If the archive has grown since it was last indexed,
+    only the new records are read.
+
+    :param filename: archive file name
+    :param stride: number of records between index entries
+    :return: the updated index
+    :rtype: :class:`TimeIndex`
+    """
+    idxfile = index_path(filename)
+    size = os.path.getsize(filename)
+    index = load_index(idxfile)
+    if index is None or index.stride != stride or index.length > size:
+        index = TimeIndex(stride)
+    elif index.length == size:
+        return index
+
+    entries = []
+    nrecs = index.nrecs
+    pos = index.length
+    with open(filename, 'rb') as f:
+        f.seek(index.length)
+        unpacker = msgpack.Unpacker(f)
+        for secs, usecs, data in unpacker:
+            if nrecs % stride == 0:
+                entries.append((secs * 1000000 + usecs, pos))
+            nrecs += 1
+            pos = index.length + unpacker.tell()
+
+    if entries:
+        new = np.array(entries, dtype='<i8').reshape((-1, 2))
+        index.entries = np.concatenate((index.entries, new))
+    index.nrecs = nrecs
+    index.length = pos
+    tmpfile = idxfile + '.tmp'
+    with open(tmpfile, 'wb') as f:
+        f.write(index.tobytes())
+    os.rename(tmpfile, idxfile)
+    return index
+
+
+class ColumnBuilder(object):
+    """
+    Accumulate data records for a single sensor into growable NumPy
+    column arrays. The columns are derived from the data dictionary
+    entry for the sensor, list-valued variables are expanded into
+    *name_0* ... *name_N* columns. Numeric columns are stored as
+    float64 (NaN for missing values) and text columns as Python
+    objects. Timestamps are stored as int64 microseconds since
+    1/1/1970 UTC. The column names, in data dictionary order, are
+    available in the *order* attribute.
+
+    :param sch: sensor schema
+    :type sch: :class:`dpdata.schema.SensorSchema`
+    :param capacity: initial number of rows to allocate
+    """
+    def __init__(self, sch, capacity=4096):
+        self.order = list(sch.columns)
+        self.text = [c for c in sch.columns if sch.kinds[c] == 'text']
+        self.names = [c for c in sch.columns if sch.kinds[c] != 'text']
+        colnum = dict([(c, i) for i, c in enumerate(self.names)])
+        vectors, expanded = [], set()
+        for name, cols in sch.vectors:
+            if cols[0] in colnum:
+                c0 = colnum[cols[0]]
+                vectors.append((name, c0, c0 + len(cols)))
+                expanded.update(cols)
+        scalars = [(c, colnum[c]) for c in self.names if c not in expanded]
+        self._scalars = scalars
+        self._vectors = vectors
+        # Scalar variables are copied into each row with a single
+        # assignment from an itemgetter tuple.
+        keys = [k for k, _ in scalars]
+        idx = [c for _, c in scalars]
+        if len(keys) > 1:
+            self._getter = itemgetter(*keys)
+        elif keys:
+            self._getter = lambda d, k=keys[0]: (d[k],)
+        else:
+            self._getter = None
+        self._sidx = np.array(idx, dtype=int)
+        self._contiguous = idx == list(range(len(idx)))
+        self._capacity = capacity
+        self.reset()
+
+    def __len__(self):
+        return self.n
+
+    def reset(self):
+        """
+        Discard the contents of the builder.
+        """
+        self.n = 0
+        self._values = np.empty((self._capacity, len(self.names)), dtype='f8')
+        self._time = np.empty(self._capacity, dtype='i8')
+        self._strings = dict([(name, []) for name in self.text])
+
+    def _grow(self):
+        size = 2 * len(self._time)
+        values = np.empty((size, len(self.names)), dtype='f8')
+        values[:self.n] = self._values[:self.n]
+        t = np.empty(size, dtype='i8')
+        t[:self.n] = self._time[:self.n]
+        self._values, self._time = values, t
+
+    def _fill(self, row, data):
+        # Slow path for records with missing or malformed variables.
+        row[:] = np.nan
+        for k, c in self._scalars:
+            if k in data:
+                row[c] = data[k]
+        for k, c0, c1 in self._vectors:
+            v = data.get(k, ())
+            row[c0:c0 + min(len(v), c1 - c0)] = v[:c1 - c0]
+
+    def append(self, secs, usecs, data):
+        """
+        Add a data record.
+
+        :param secs: timestamp in seconds since 1/1/1970 UTC
+        :param usecs: microsecond component of the timestamp
+        :param data: data record
+        :type data: dict
+        """
+        i = self.n
+        if i == len(self._time):
+            self._grow()
+        self._time[i] = secs * 1000000 + usecs
+        row = self._values[i]
+        try:
+            if self._getter is not None:
+                if self._contiguous:
+                    row[:len(self._sidx)] = self._getter(data)
+                else:
+                    row[self._sidx] = self._getter(data)
+            for k, c0, c1 in self._vectors:
+                row[c0:c1] = data[k]
+        except (KeyError, ValueError, TypeError):
+            self._fill(row, data)
+        for name in self.text:
+            self._strings[name].append(data.get(name))
+        self.n = i + 1
+
+    def columns(self):
+        """
+        Return the accumulated data as a dictionary of arrays. The
+        arrays are copies, the builder may be reused after calling
+        :meth:`reset`.
+
+        :rtype: dict
+        """
+        cols = {'timestamp': self._time[:self.n].copy()}
+        for j, name in enumerate(self.names):
+            cols[name] = self._values[:self.n, j].copy()
+        for name in self.text:
+            cols[name] = np.array(self._strings[name], dtype=object)
+        return cols
+
+    def frame(self):
+        """
+        Return the accumulated data as a DataFrame.
+
+        :rtype: :class:`pandas.DataFrame`
+        """
+        import pandas as pd
+        return pd.DataFrame(self.columns(),
+                            columns=['timestamp'] + self.order)
+
+
+def _sensor_schema(sensor, data_dict):
+    if isinstance(sensor, SensorSchema):
+        return sensor
+    return get_schema(data_dict)[sensor]
+
+
+def read_columns(infile, sensor, data_dict=None, as_frame=True):
+    """
+    Read all of the records from a MessagePack file into NumPy
+    column arrays.
+
+    :param infile: input data file.
+    :param sensor: sensor name or :class:`dpdata.schema.SensorSchema`
+    :param data_dict: data dictionary or :class:`dpdata.schema.Schema`,
+                      if not specified the default Deep Profiler data
+                      dictionary is used.
+    :param as_frame: if true, return a :class:`pandas.DataFrame`,
+                     otherwise return a dictionary of arrays.
+    """
+    builder = ColumnBuilder(_sensor_schema(sensor, data_dict))
+    append = builder.append
+    for secs, usecs, data in msgpack.Unpacker(infile):
+        append(secs, usecs, data)
+    if as_frame:
+        return builder.frame()
+    return builder.columns()
+
+
+def iter_columns(infile, sensor, chunksize=10000, data_dict=None):
+    """
+    Iterate over the records from a MessagePack file in chunks of
+    NumPy column arrays.
+
+    :param infile: input data file.
+    :param sensor: sensor name or :class:`dpdata.schema.SensorSchema`
+    :param chunksize: maximum number of records per chunk
+    :param data_dict: data dictionary or :class:`dpdata.schema.Schema`,
+                      if not specified the default Deep Profiler data
+                      dictionary is used.
+    :return: iterator of dictionaries of arrays
+    """
+    builder = ColumnBuilder(_sensor_schema(sensor, data_dict),
+                            capacity=chunksize)
+    append = builder.append
+    for secs, usecs, data in msgpack.Unpacker(infile):
+        append(secs, usecs, data)
+        if len(builder) >= chunksize:
+            yield builder.columns()
+            builder.reset()
+    if len(builder):
+        yield builder.columns()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""
+.. module:: parallel
+   :synopsis: Chunked, parallel processing of CTD and Optode data.
+"""
+import multiprocessing
+from sqlalchemy import select, and_
+from sqlalchemy.sql import func
+from sqlalchemy.exc import NoSuchTableError
+from dpdata.sql import DPDatabase, profile_bounds
+from dpdata.sci import process_ctd, process_optode
+
+
+def time_chunks(db, table, length, t_start=0, t_end=0):
+    """
+    Split the time range of a table into chunks.
+
+    :param db: database interface
+    :type db: :class:`dpdata.sql.DPDatabase`
+    :param table: SQL table name
+    :param length: chunk length in microseconds
+    :param t_start: start time (in microseconds since 1/1/1970 UTC),
+                    defaults to the start of the table.
+    :param t_end: end time, defaults to the end of the table.
+    :return: list of (start, end) tuples, the end time is exclusive.
+    """
+    t0, t1 = db.get_time_range(table)
+    if t1 == 0:
+        return []
+    lo = max(t0, t_start)
+    hi = min(t1, t_end) if t_end else t1
+    return [(t, min(t + length, hi + 1)) for t in range(lo, hi + 1, length)]
+
+
+def profile_chunks(db, pnums=None):
+    """
+    Return the time range of each profile.
+
+    :param db: database interface
+    :type db: :class:`dpdata.sql.DPDatabase`
+    :param pnums: sequence of profile numbers, defaults to all
+                  completed profiles.
+    :return: list of (start, end) tuples, the end time is exclusive,
+             see :func:`dpdata.sql.profile_bounds`.
+    """
+    profiles = db.get_profiles()
+    bounds = profile_bounds(profiles)
+    if pnums is None:
+        pnums = [p.pnum for p in profiles if p.end is not None]
+    return sorted([bounds[pnum] for pnum in set(pnums) if pnum in bounds])
+
+
+def bracket(db, table, t_start, t_end):
+    """
+    Return the time range of the samples in *table* which bracket
+    the interval [*t_start*, *t_end*], i.e. the time of the last
+    sample at or before *t_start* and the first sample at or after
+    *t_end*. If there are no such samples, the interval bounds are
+    returned.
+
+    :param db: database interface
+    :type db: :class:`dpdata.sql.DPDatabase`
+    :param table: SQL table name
+    :param t_start: start time (in microseconds since 1/1/1970 UTC)
+    :param t_end: end time
+    """
+    tbl = db.table(table)
+    ts = tbl.c.timestamp
+    with db.eng.connect() as conn:
+        lo = conn.execute(select([func.max(ts)]).where(ts <= t_start)).scalar()
+        hi = conn.execute(select([func.min(ts)]).where(ts >= t_end)).scalar()
+    return (t_start if lo is None else lo), (t_end if hi is None else hi)
+
+
+_db = None
+
+
+def _init_worker(url):
+    global _db
+    _db = DPDatabase(url)
+
+
+def ctd_worker(args):
+    """
+    Pool worker which processes one chunk of CTD data.
+    """
+    (t_start, t_end), ctd_table, lat, lon = args
+    ctd = _db.get_dataset(ctd_table, t_start, t_end - 1)
+    if len(ctd) == 0:
+        return None
+    return process_ctd(ctd, lat=lat, lon=lon)
+
+
+def optode_worker(args):
+    """
+    Pool worker which processes one chunk of Optode data. The CTD
+    data is read from the samples which bracket the chunk so the
+    interpolation onto the Optode sample times is the same as when
+    processing the entire data-set.
+    """
+    (t_start, t_end), ctd_table, optode_table, fc, lat, lon = args
+    optode = _db.get_dataset(optode_table, t_start, t_end - 1)
+    if len(optode) == 0:
+        return None
+    c_start, c_end = bracket(_db, ctd_table, t_start, t_end - 1)
+    ctd = _db.get_dataset(ctd_table, c_start, c_end)
+    if len(ctd) == 0:
+        return None
+    df = process_optode(process_ctd(ctd, lat=lat, lon=lon), optode, fc,
+                        lat=lat, lon=lon)
+    return df.reset_index(drop=True)
+
+
+def write_chunk(db, table, chunk, df):
+    """
+    Replace the rows of *table* in a time range with the rows of a
+    data-set in a single transaction, so processing a chunk again does
+    not duplicate its output. The table is created if necessary.
+
+    :param db: database interface
+    :type db: :class:`dpdata.sql.DPDatabase`
+    :param table: SQL table name
+    :param chunk: (start, end) time range, the end time is exclusive.
+    :param df: data-set contents or ``None``
+    :type df: :class:`pandas.DataFrame`
+    """
+    try:
+        tbl = db.table(table)
+    except NoSuchTableError:
+        tbl = None
+    with db.eng.connect() as conn:
+        with conn.begin():
+            if tbl is not None:
+                conn.execute(tbl.delete().where(
+                    and_(tbl.c.timestamp >= chunk[0],
+                         tbl.c.timestamp < chunk[1])))
+            if df is not None and len(df):
+                df.to_sql(table, conn, if_exists='append', index=False)
+
+
+def _run(url, worker, tasks, out_table, jobs):
+    db = DPDatabase(url)
+    nrows = 0
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, _init_worker, (url,))
+        results = pool.imap(worker, tasks)
+    else:
+        _init_worker(url)
+        pool = None
+        results = (worker(task) for task in tasks)
+    try:
+        # The results are returned in task order
+        for task, df in zip(tasks, results):
+            write_chunk(db, out_table, task[0], df)
+            if df is not None:
+                nrows += len(df)
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        # Stop the workers if a task or a write failed
+        if pool is not None:
+            pool.terminate()
+    return nrows
+
+
+def run_ctd(url, chunks, out_table, ctd_table='ctd_1', lat=0, lon=0,
+            jobs=1):
+    """
+    Process CTD data in chunks using a pool of worker processes and
+    write the results to *out_table*. The workers only read from the
+    database, the results are written by the calling process and
+    replace any earlier output for the same time ranges.
+
+    :param url: SQLAlchemy database connection string
+    :param chunks: list of (start, end) time ranges from
+                   :func:`time_chunks` or :func:`profile_chunks`
+    :param out_table: output table name
+    :param ctd_table: raw CTD table name
+    :param lat: data-set latitude in degrees
+    :param lon: data-set longitude in degrees
+    :param jobs: number of worker processes
+    :return: number of rows written
+    """
+    tasks = [(chunk, ctd_table, lat, lon) for chunk in chunks]
+    return _run(url, ctd_worker, tasks, out_table, jobs)
+
+
+def run_optode(url, chunks, fc, out_table, ctd_table='ctd_1',
+               optode_table='optode_1', lat=0, lon=0, jobs=1):
+    """
+    Process Optode data in chunks using a pool of worker processes
+    and write the results to *out_table*.
+
+    :param url: SQLAlchemy database connection string
+    :param chunks: list of (start, end) time ranges from
+                   :func:`time_chunks` or :func:`profile_chunks`
+    :param fc: Optode foil calibration coefficients
+    :param out_table: output table name
+    :param ctd_table: raw CTD table name
+    :param optode_table: raw Optode table name
+    :param lat: data-set latitude in degrees
+    :param lon: data-set longitude in degrees
+    :param jobs: number of worker processes
+    :return: number of rows written
+    """
+    tasks = [(chunk, ctd_table, optode_table, list(fc), lat, lon)
+             for chunk in chunks]
+    return _run(url, optode_worker, tasks, out_table, jobs)
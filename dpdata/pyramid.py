@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""
+.. module:: pyramid
+   :synopsis: Multi-resolution summaries of long time-series.
+"""
+from sqlalchemy import Table, Column, Integer, Float, Numeric, select,\
+    and_
+from sqlalchemy.sql import func
+from sqlalchemy.exc import NoSuchTableError
+from dpdata.sql import database
+
+#: Default summary intervals in seconds (1 minute, 1 hour and 1 day)
+LEVELS = (60, 3600, 86400)
+
+#: Summary statistics stored for each column
+STATS = ('min', 'max', 'mean', 'count')
+
+
+def level_table(table, secs):
+    """
+    Return the name of the summary table of *table* at a resolution
+    of *secs* seconds.
+    """
+    return '{0}_{1:d}s'.format(table, secs)
+
+
+def data_columns(tbl):
+    """
+    Return the names of the numeric data columns of a table.
+
+    :param tbl: SQL table
+    :type tbl: :class:`sqlalchemy.Table`
+    """
+    return [c.name for c in tbl.columns
+            if c.name != 'timestamp' and
+            isinstance(c.type, (Integer, Numeric))]
+
+
+def make_level_table(db, name, columns):
+    """
+    Create a summary table if it does not exist. Each row holds the
+    summary of one interval, the *timestamp* column is the start of
+    the interval.
+
+    :param db: database interface
+    :type db: :class:`dpdata.sql.DPDatabase`
+    :param name: table name
+    :param columns: names of the summarized data columns
+    :rtype: :class:`sqlalchemy.Table`
+    """
+    try:
+        return db.table(name)
+    except NoSuchTableError:
+        pass
+    cols = [Column('timestamp', Integer, primary_key=True,
+                   autoincrement=False)]
+    for c in columns:
+        cols.extend([Column(c + '_min', Float),
+                     Column(c + '_max', Float),
+                     Column(c + '_mean', Float),
+                     Column(c + '_count', Integer)])
+    tbl = Table(name, db.meta, *cols)
+    db.meta.create_all(db.eng, tables=[tbl])
+    return tbl
+
+
+def summarize(df, columns, width):
+    """
+    Summarize raw data over fixed intervals.
+
+    :param df: raw data-set
+    :type df: :class:`pandas.DataFrame`
+    :param columns: names of the columns to summarize
+    :param width: interval length in microseconds
+    :returns: summary data-set
+    :rtype: :class:`pandas.DataFrame`
+    """
+    import pandas as pd
+    g = df[columns].groupby((df['timestamp'] // width) * width)
+    parts = [g.min(), g.max(), g.mean(), g.count()]
+    out = pd.DataFrame(index=parts[0].index)
+    for c in columns:
+        for stat, part in zip(STATS, parts):
+            out[c + '_' + stat] = part[c]
+    out.index.name = 'timestamp'
+    return out.reset_index()
+
+
+def combine(df, columns, width):
+    """
+    Combine summaries into summaries over longer intervals.
+
+    :param df: summary data-set from :func:`summarize` or
+               :func:`combine`
+    :type df: :class:`pandas.DataFrame`
+    :param columns: names of the summarized data columns
+    :param width: interval length in microseconds, this must be a
+                  multiple of the interval of the input summaries.
+    :returns: summary data-set
+    :rtype: :class:`pandas.DataFrame`
+    """
+    import pandas as pd
+    work = pd.DataFrame({'timestamp': (df['timestamp'] // width) * width})
+    for c in columns:
+        n = df[c + '_count']
+        work[c + '_min'] = df[c + '_min']
+        work[c + '_max'] = df[c + '_max']
+        work[c + '_sum'] = (df[c + '_mean'] * n).where(n > 0, 0.)
+        work[c + '_count'] = n
+    g = work.groupby('timestamp')
+    mins, maxs, sums = g.min(), g.max(), g.sum()
+    out = pd.DataFrame(index=sums.index)
+    for c in columns:
+        n = sums[c + '_count']
+        out[c + '_min'] = mins[c + '_min']
+        out[c + '_max'] = maxs[c + '_max']
+        out[c + '_mean'] = (sums[c + '_sum'] / n).where(n > 0)
+        out[c + '_count'] = n
+    return out.reset_index()
+
+
+def _summarize_range(db, source, columns, width, reduce, chunksize,
+                     t_start, t_end):
+    import pandas as pd
+    # The summaries are much smaller than the source data, they are
+    # collected and written once the (streaming) read has finished.
+    parts = []
+    carry = None
+    for chunk in db.get_dataset(source, t_start, t_end, chunksize=chunksize):
+        if len(chunk) == 0:
+            continue
+        s = reduce(chunk, columns, width)
+        if carry is not None:
+            s = combine(pd.concat([carry, s], ignore_index=True),
+                        columns, width)
+        # The last interval may continue into the next chunk
+        parts.append(s.iloc[:-1])
+        carry = s.iloc[-1:]
+    if carry is None:
+        return None
+    parts.append(carry)
+    return pd.concat(parts, ignore_index=True)
+
+
+def _replace(db, tbl, t_start, t_end, df):
+    # Replace the summary rows in [t_start, t_end) in one transaction,
+    # t_end is None for all of the rows from t_start.
+    cond = tbl.c.timestamp >= t_start
+    if t_end is not None:
+        cond = and_(cond, tbl.c.timestamp < t_end)
+    with db.eng.connect() as conn:
+        with conn.begin():
+            conn.execute(tbl.delete().where(cond))
+            if df is not None:
+                df.to_sql(tbl.name, conn, if_exists='append', index=False)
+    return 0 if df is None else len(df)
+
+
+def intervals(ranges, width):
+    """
+    Return the intervals of a summary level which cover a set of
+    time ranges, overlapping and adjacent intervals are merged.
+
+    :param ranges: list of (start, end) tuples, in microseconds since
+                   1/1/1970 UTC, the end time is inclusive.
+    :param width: interval length in microseconds
+    :return: sorted list of (start, end) tuples, the end time is
+             exclusive.
+    """
+    result = []
+    for t0, t1 in sorted([((t0 // width) * width, (t1 // width + 1) * width)
+                          for t0, t1 in ranges]):
+        if result and t0 <= result[-1][1]:
+            result[-1] = (result[-1][0], max(result[-1][1], t1))
+        else:
+            result.append((t0, t1))
+    return result
+
+
+def _update_level(db, tbl, source, columns, width, reduce, chunksize,
+                  ranges):
+    if ranges is None:
+        # The last interval of the summary table may be incomplete,
+        # it is recomputed along with any new intervals.
+        with db.eng.connect() as conn:
+            t0 = conn.execute(select([func.max(tbl.c.timestamp)])).scalar()
+        t0 = t0 or 0
+        df = _summarize_range(db, source, columns, width, reduce,
+                              chunksize, t0 - 1, 0)
+        return _replace(db, tbl, t0, None, df)
+    nrows = 0
+    for t0, t1 in intervals(ranges, width):
+        df = _summarize_range(db, source, columns, width, reduce,
+                              chunksize, t0, t1 - 1)
+        nrows += _replace(db, tbl, t0, t1, df)
+    return nrows
+
+
+def update_pyramid(eng, table, levels=LEVELS, chunksize=100000,
+                   ranges=None):
+    """
+    Bring the summary tables of a data table up to date, creating
+    them if necessary. The intervals which cover *ranges*, e.g. the
+    time ranges of the data which has just been loaded, are
+    recomputed at each level. Without *ranges* only the data after
+    the last summarized interval is read, so data loaded into earlier
+    intervals is not summarized. An empty summary table is always
+    computed from all of the data. The finest level is computed from
+    the raw data and each coarser level from the level below it, so
+    every level must be a multiple of the previous one.
+
+    :param eng: SQLAlchemy database engine or
+                :class:`dpdata.sql.DPDatabase`
+    :param table: SQL table name
+    :param levels: summary intervals in seconds
+    :param chunksize: number of rows read at a time
+    :param ranges: list of (start, end) tuples of the times (in
+                   microseconds since 1/1/1970 UTC) to recompute, the
+                   end time is inclusive.
+    :return: dictionary of the number of rows written to each summary
+             table.
+    """
+    db = database(eng)
+    levels = sorted(levels)
+    for lo, hi in zip(levels[:-1], levels[1:]):
+        if hi % lo != 0:
+            raise ValueError('Summary level {0:d}s is not a multiple '
+                             'of {1:d}s'.format(hi, lo))
+    columns = data_columns(db.table(table))
+    source, reduce = table, summarize
+    result = {}
+    for secs in levels:
+        name = level_table(table, secs)
+        tbl = make_level_table(db, name, columns)
+        # An empty summary table is computed from all of the data
+        empty = db.get_time_range(name)[1] == 0
+        result[name] = _update_level(db, tbl, source, columns,
+                                     secs * 1000000, reduce, chunksize,
+                                     None if empty else ranges)
+        source, reduce = name, combine
+    return result
+
+
+def get_summary(eng, table, t_start=0, t_end=0, npoints=1000,
+                columns=None, levels=LEVELS):
+    """
+    Return a summary of a data table for plotting. The coarsest
+    summary level which still has at least *npoints* intervals in the
+    requested time range is used. If even the finest level is too
+    coarse, the raw data is returned in the same form with the
+    min, max and mean all set to the sample value.
+
+    :param eng: SQLAlchemy database engine or
+                :class:`dpdata.sql.DPDatabase`
+    :param table: SQL table name
+    :param t_start: start time (in microseconds since 1/1/1970 UTC),
+                    defaults to the start of the table.
+    :param t_end: end time, defaults to the end of the table.
+    :param npoints: minimum number of points required
+    :param columns: list of column names, defaults to all numeric
+                    columns.
+    :param levels: summary intervals in seconds
+    :return: tuple of the summary interval in seconds (0 for raw
+             data) and the summary data-set.
+    """
+    db = database(eng)
+    t0, t1 = db.get_time_range(table)
+    t_start = t_start or t0
+    t_end = t_end or t1
+    if columns is None:
+        columns = data_columns(db.table(table))
+    for secs in sorted(levels, reverse=True):
+        if (t_end - t_start) // (secs * 1000000) < npoints:
+            continue
+        name = level_table(table, secs)
+        if db.get_time_range(name)[1] == 0:
+            continue
+        names = [c + '_' + stat for c in columns for stat in STATS]
+        # Include the interval containing t_start
+        t = (t_start // (secs * 1000000)) * secs * 1000000
+        return secs, db.get_dataset(name, t, t_end, columns=names)
+    df = db.get_dataset(table, t_start, t_end, columns=columns)
+    out = df[['timestamp']].copy()
+    for c in columns:
+        out[c + '_min'] = df[c]
+        out[c + '_max'] = df[c]
+        out[c + '_mean'] = df[c]
+        out[c + '_count'] = df[c].notnull().astype('i8')
+    return 0, out
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+"""
+.. module:: qc
+   :synopsis: Data dictionary driven quality control tests.
+
+The tests for a variable are given by its *qc* attribute in the data
+dictionary, the thresholds are in the units of the stored values
+(i.e. before *scale* is applied)::
+
+    - name: condwat
+      ...
+      qc:
+        range: [0, 70]    # valid range, either limit may be null
+        spike: 0.5        # maximum deviation from the neighbouring samples
+        gradient: 2.0     # maximum rate of change per second
+        stuck: 20         # maximum number of identical consecutive values
+
+The result of the tests for each variable is a bit-mask of the QC_*
+flags, zero if all of the tests pass, which is stored in the
+*<name>_qc* column of the sensor table.
+"""
+import numpy as np
+from dpdata.schema import get_schema
+
+#: Flag bits
+QC_MISSING = 1
+QC_RANGE = 2
+QC_SPIKE = 4
+QC_GRADIENT = 8
+QC_STUCK = 16
+
+#: Test names used in the data dictionary
+TESTS = ('range', 'spike', 'gradient', 'stuck')
+
+
+def flag_column(name):
+    """
+    Return the name of the flag column for a variable.
+    """
+    return name + '_qc'
+
+
+def qc_tests(sensor, data_dict=None):
+    """
+    Return the QC test parameters for the variables of a sensor.
+
+    :param sensor: sensor name
+    :param data_dict: data dictionary or :class:`dpdata.schema.Schema`
+    :return: dictionary of test parameters keyed by column name
+    """
+    tests = get_schema(data_dict)[sensor].qc
+    for name, params in tests.items():
+        for test in params:
+            if test not in TESTS:
+                raise ValueError('{0}.{1}: unknown QC test {2!r}'.format(
+                    sensor, name, test))
+        # A null range disables the test
+        if params.get('range') is not None and \
+                len(params['range']) != 2:
+            raise ValueError('{0}.{1}: QC range must be [min, max]'.format(
+                sensor, name))
+    return tests
+
+
+def range_test(v, limits):
+    """
+    Return a boolean array which is true where the values are
+    outside of the range [min, max]. Either limit may be ``None``.
+    """
+    lo, hi = limits
+    bad = np.zeros(len(v), dtype=bool)
+    if lo is not None:
+        bad |= v < lo
+    if hi is not None:
+        bad |= v > hi
+    return bad
+
+
+def spike_test(v, threshold):
+    """
+    Return a boolean array which is true where a value differs from
+    the mean of its neighbours by more than *threshold* plus half of
+    the difference between the neighbours. The first and last values
+    are never flagged.
+    """
+    bad = np.zeros(len(v), dtype=bool)
+    if len(v) > 2:
+        prev, nxt = v[:-2], v[2:]
+        bad[1:-1] = (np.abs(v[1:-1] - 0.5 * (prev + nxt)) -
+                     np.abs(0.5 * (nxt - prev))) > threshold
+    return bad
+
+
+def gradient_test(t, v, threshold):
+    """
+    Return a boolean array which is true where the rate of change
+    from the previous value is more than *threshold* per second.
+
+    :param t: sample times in microseconds
+    :param v: sample values
+    :param threshold: maximum rate of change
+    """
+    bad = np.zeros(len(v), dtype=bool)
+    if len(v) > 1:
+        dt = np.diff(t) * 1e-6
+        bad[1:] = (dt > 0) & (np.abs(np.diff(v)) > threshold * dt)
+    return bad
+
+
+def run_lengths(v, run0=0):
+    """
+    Return the number of consecutive identical values ending at each
+    value.
+
+    :param v: sample values
+    :param run0: number of values equal to the first value which
+                 precede the array.
+    """
+    n = len(v)
+    idx = np.arange(n)
+    change = np.ones(n, dtype=bool)
+    change[1:] = v[1:] != v[:-1]
+    start = np.maximum.accumulate(np.where(change, idx, 0))
+    runs = idx - start + 1
+    runs[start == 0] += run0
+    return runs
+
+
+def stuck_test(v, n, run0=0):
+    """
+    Return a boolean array which is true where a value is the *n*-th
+    or later identical value in a row.
+    """
+    return run_lengths(v, run0) >= n
+
+
+def apply_tests(t, v, params, run0=0):
+    """
+    Apply the QC tests to the values of a single variable.
+
+    :param t: sample times in microseconds
+    :param v: sample values
+    :param params: test parameters from the data dictionary
+    :param run0: see :func:`run_lengths`
+    :return: tuple of flags (uint8 array), run lengths
+    """
+    v = np.asarray(v, dtype='f8')
+    flags = np.zeros(len(v), dtype='u1')
+    flags[np.isnan(v)] |= QC_MISSING
+    if params.get('range') is not None:
+        flags[range_test(v, params['range'])] |= QC_RANGE
+    if params.get('spike') is not None:
+        flags[spike_test(v, params['spike'])] |= QC_SPIKE
+    if params.get('gradient') is not None:
+        flags[gradient_test(t, v, params['gradient'])] |= QC_GRADIENT
+    runs = run_lengths(v, run0)
+    if params.get('stuck') is not None:
+        flags[runs >= params['stuck']] |= QC_STUCK
+    return flags, runs
+
+
+class Checker(object):
+    """
+    Apply the QC tests to a sensor data-set which is read in chunks,
+    e.g. from :func:`dpdata.sql.get_dataset` with *chunksize*. The
+    spike test needs the following value, so the flags for the last
+    row of each chunk are returned with the next chunk and the flags
+    for the final row by :meth:`flush`. The results are identical to
+    testing the whole data-set at once.
+
+    :param sensor: sensor name
+    :param data_dict: data dictionary or :class:`dpdata.schema.Schema`
+    :param columns: columns to test, the default is all columns with
+                    QC tests.
+    """
+    def __init__(self, sensor, data_dict=None, columns=None):
+        tests = qc_tests(sensor, data_dict)
+        self.columns = [c for c in get_schema(data_dict)[sensor].columns
+                        if c in tests and (columns is None or c in columns)]
+        self.tests = dict([(c, tests[c]) for c in self.columns])
+        self._reset()
+
+    def _reset(self):
+        self._t = np.zeros(0, dtype='i8')
+        self._v = dict([(c, np.zeros(0)) for c in self.columns])
+        # Number of rows at the start of the buffer whose flags have
+        # already been returned (0 or 1), and the run length at that row
+        self._ctx = 0
+        self._runs = dict([(c, 0) for c in self.columns])
+
+    def _flags(self, end, keep):
+        import pandas as pd
+        out = {'timestamp': self._t[self._ctx:end]}
+        names = ['timestamp']
+        run0 = self._ctx
+        for c in self.columns:
+            flags, runs = apply_tests(self._t, self._v[c], self.tests[c],
+                                      run0=self._runs[c] - run0)
+            out[flag_column(c)] = flags[self._ctx:end]
+            names.append(flag_column(c))
+            if keep:
+                self._runs[c] = runs[-keep]
+        return pd.DataFrame(out, columns=names)
+
+    def check(self, chunk):
+        """
+        Test the next chunk of data.
+
+        :param chunk: data-set with a *timestamp* column
+        :type chunk: :class:`pandas.DataFrame` or dictionary of arrays
+        :return: flags for the rows which can be tested, with a
+                 *timestamp* column and one *<name>_qc* column per
+                 variable.
+        :rtype: :class:`pandas.DataFrame`
+        """
+        self._t = np.concatenate((self._t, np.asarray(chunk['timestamp'])))
+        for c in self.columns:
+            self._v[c] = np.concatenate((self._v[c],
+                                         np.asarray(chunk[c], dtype='f8')))
+        n = len(self._t)
+        end = max(n - 1, self._ctx)
+        result = self._flags(end, 2 if n > 1 else 0)
+        if n > 1:
+            # Keep the last tested row as context and the last row
+            self._t = self._t[-2:]
+            for c in self.columns:
+                self._v[c] = self._v[c][-2:]
+            self._ctx = 1
+        return result
+
+    def flush(self):
+        """
+        Return the flags for the last row and reset the checker.
+        """
+        result = self._flags(len(self._t), 0)
+        self._reset()
+        return result
+
+
+def check(data, sensor, data_dict=None, columns=None):
+    """
+    Apply the QC tests to a whole data-set.
+
+    :param data: data-set with a *timestamp* column
+    :type data: :class:`pandas.DataFrame` or dictionary of arrays
+    :param sensor: sensor name
+    :param data_dict: data dictionary or :class:`dpdata.schema.Schema`
+    :param columns: columns to test, the default is all columns with
+                    QC tests.
+    :return: flags with a *timestamp* column and one *<name>_qc* column
+             per variable
+    :rtype: :class:`pandas.DataFrame`
+    """
+    import pandas as pd
+    qc = Checker(sensor, data_dict=data_dict, columns=columns)
+    flags = pd.concat([qc.check(data), qc.flush()], ignore_index=True)
+    index = getattr(data, 'index', None)
+    if index is not None:
+        flags.index = index
+    return flags
+
+
+def _write_flags(conn, upd, names, flags):
+    if len(flags) == 0:
+        return 0
+    keys = ['_timestamp'] + ['_' + name for name in names]
+    cols = [flags[name].tolist() for name in ['timestamp'] + names]
+    with conn.begin():
+        conn.execute(upd, [dict(zip(keys, row)) for row in zip(*cols)])
+    return len(flags)
+
+
+def update_flags(eng, sensor, data_dict=None, t_start=0, t_end=0,
+                 chunksize=100000):
+    """
+    Run the QC tests on the data in a sensor table and store the
+    results in the flag columns, which are created by
+    :func:`dpdata.sql.make_table` with *qc=True* or added to an
+    existing table by :func:`dpdata.sql.add_flag_columns`.
+
+    :param eng: SQLAlchemy database engine
+    :param sensor: sensor name
+    :param data_dict: data dictionary or :class:`dpdata.schema.Schema`
+    :param t_start: start time (in microseconds since 1/1/1970 UTC)
+    :param t_end: end time
+    :param chunksize: number of rows read and updated at a time
+    :return: number of rows updated
+    """
+    import pandas as pd
+    from sqlalchemy import bindparam
+    from dpdata.sql import database, dataset_query
+    db = database(eng)
+    tbl = db.table(sensor)
+    qc = Checker(sensor, data_dict=data_dict)
+    missing = [flag_column(c) for c in qc.columns
+               if flag_column(c) not in tbl.c]
+    if missing:
+        raise RuntimeError('{0}: missing QC flag columns: {1} (run '
+                           'mktables --qc)'.format(sensor, ', '.join(missing)))
+    names = [flag_column(c) for c in qc.columns]
+    upd = tbl.update().where(tbl.c.timestamp == bindparam('_timestamp'))
+    upd = upd.values(dict([(name, bindparam('_' + name)) for name in names]))
+    # The data is read a page at a time rather than streamed, SQLite
+    # does not allow writes while a query is being streamed, so the
+    # flags for each page can be written before the next is read.
+    query = dataset_query(tbl, t_start, t_end, qc.columns)
+    nrows = 0
+    last = None
+    with db.eng.connect() as conn:
+        while True:
+            s = query
+            if last is not None:
+                s = s.where(tbl.c.timestamp > last)
+            chunk = pd.read_sql_query(s.limit(chunksize), conn)
+            if len(chunk) == 0:
+                break
+            last = int(chunk['timestamp'].iloc[-1])
+            nrows += _write_flags(conn, upd, names, qc.check(chunk))
+        nrows += _write_flags(conn, upd, names, qc.flush())
+    return nrows
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""
+.. module:: realtime
+   :synopsis: Incremental CTD and Optode processing of live data.
+"""
+import numpy as np
+from dpdata.sci import process_ctd, process_optode
+
+
+class RingBuffer(object):
+    """
+    Fixed-capacity buffer of the most recent rows of a set of
+    numeric columns. Rows must be added in time order.
+
+    :param capacity: maximum number of rows
+    :param columns: column names, the first column is the time.
+    """
+    def __init__(self, capacity, columns):
+        self.capacity = capacity
+        self.columns = list(columns)
+        self._data = np.empty((len(self.columns), capacity), dtype='f8')
+        self._start = 0
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def extend(self, rows):
+        """
+        Append rows, dropping the oldest rows if the buffer is full.
+
+        :param rows: dictionary of column arrays
+        """
+        block = np.array([np.asarray(rows[c], dtype='f8')
+                          for c in self.columns], ndmin=2)
+        k = block.shape[1]
+        if k >= self.capacity:
+            self._data[:] = block[:, k - self.capacity:]
+            self._start, self.n = 0, self.capacity
+            return
+        end = (self._start + self.n) % self.capacity
+        first = min(k, self.capacity - end)
+        self._data[:, end:end + first] = block[:, :first]
+        self._data[:, :k - first] = block[:, first:]
+        overflow = max(0, self.n + k - self.capacity)
+        self._start = (self._start + overflow) % self.capacity
+        self.n = min(self.n + k, self.capacity)
+
+    def view(self):
+        """
+        Return the buffer contents in time order as a dictionary of
+        column arrays.
+        """
+        idx = (self._start + np.arange(self.n)) % self.capacity
+        data = self._data[:, idx]
+        return dict(zip(self.columns, data))
+
+    def last(self):
+        """
+        Return the time of the most recent row, or ``None``.
+        """
+        if self.n == 0:
+            return None
+        return self._data[0, (self._start + self.n - 1) % self.capacity]
+
+    def first(self):
+        """
+        Return the time of the oldest row, or ``None``.
+        """
+        if self.n == 0:
+            return None
+        return self._data[0, self._start]
+
+
+def _message(name, t, data):
+    t = int(t)
+    return ('DATA', {'name': name,
+                     't': [t // 1000000, t % 1000000],
+                     'data': data})
+
+
+def _rows(df, columns):
+    cols = [df[c].tolist() for c in columns]
+    return [dict(zip(columns, row)) for row in zip(*cols)]
+
+
+class Processor(object):
+    """
+    Compute the derived CTD and Optode variables from the live data
+    stream. Each raw sample is processed once, as part of the
+    micro-batch of messages in which it arrives. The processed CTD
+    samples are kept in a ring buffer, Optode samples are held until
+    a CTD sample at or after their time has arrived and are then
+    processed by interpolating the buffered CTD data, exactly as in
+    :func:`dpdata.sci.process_optode`. Optode samples which are older
+    than the buffered CTD data are dropped.
+
+    The output messages have the same format as the input messages,
+    the sensor names are those of the :mod:`dpdata.util.dpprocess`
+    product tables (e.g. *ctd_1_processed*).
+
+    :param fc: Optode foil calibration coefficients, the Optode data
+               is not processed if this is ``None``.
+    :param lat: deployment latitude in degrees
+    :param lon: deployment longitude in degrees
+    :param ctd: CTD sensor name
+    :param optode: Optode sensor name
+    :param capacity: CTD ring buffer size
+    :param max_pending: maximum number of Optode samples held waiting
+                        for CTD data, the oldest are dropped.
+    """
+    CTD_COLUMNS = ('timestamp', 'pracsal', 'tempwat', 'preswat')
+
+    def __init__(self, fc, lat=0, lon=0, ctd='ctd_1', optode='optode_1',
+                 capacity=1024, max_pending=1024):
+        self.fc = fc
+        self.lat = lat
+        self.lon = lon
+        self.ctd = ctd
+        self.optode = optode
+        self.ctd_product = ctd + '_processed'
+        self.optode_product = optode + '_processed'
+        self.buffer = RingBuffer(capacity, self.CTD_COLUMNS)
+        self.max_pending = max_pending
+        self.pending = []
+        self.dropped = 0
+
+    def process(self, msgs):
+        """
+        Process a micro-batch of messages.
+
+        :param msgs: list of (message-type, contents) tuples from
+                     :func:`dpdata.zmq.recv_message`
+        :return: list of output messages
+        """
+        ctd, optode = [], []
+        for mtype, contents in msgs:
+            if mtype != 'DATA':
+                continue
+            name = contents['name']
+            if name == self.ctd:
+                ctd.append(contents)
+            elif name == self.optode and self.fc is not None:
+                optode.append(contents)
+        out = self._process_ctd(ctd)
+        out.extend(self._process_optode(optode))
+        return out
+
+    def _process_ctd(self, msgs):
+        if not msgs:
+            return []
+        last = self.buffer.last()
+        t, cols = [], {'condwat': [], 'tempwat': [], 'preswat': []}
+        for m in msgs:
+            secs, usecs = m['t']
+            ts = secs * 1000000 + usecs
+            data = m['data']
+            # Samples must be added to the buffer in time order
+            if last is not None and ts <= last:
+                continue
+            try:
+                values = [float(data[c]) for c in cols]
+            except (KeyError, TypeError, ValueError):
+                continue
+            last = ts
+            t.append(ts)
+            for c, v in zip(cols, values):
+                cols[c].append(v)
+        if not t:
+            return []
+        cols['timestamp'] = np.array(t, dtype='i8')
+        df = process_ctd(cols, lat=self.lat, lon=self.lon)
+        self.buffer.extend(df)
+        return [_message(self.ctd_product, ts, row)
+                for ts, row in zip(t, _rows(df, ['pracsal', 'tempwat',
+                                                 'preswat', 'density']))]
+
+    def _process_optode(self, msgs):
+        for m in msgs:
+            secs, usecs = m['t']
+            data = m['data']
+            try:
+                self.pending.append((secs * 1000000 + usecs,
+                                     float(data['doconcs']),
+                                     float(data['t'])))
+            except (KeyError, TypeError, ValueError):
+                continue
+        if len(self.pending) > self.max_pending:
+            self.dropped += len(self.pending) - self.max_pending
+            self.pending = self.pending[-self.max_pending:]
+        last = self.buffer.last()
+        if last is None or not self.pending:
+            return []
+        self.pending.sort()
+        ready = [p for p in self.pending if p[0] <= last]
+        if not ready:
+            return []
+        self.pending = self.pending[len(ready):]
+        optode = dict(zip(('timestamp', 'doconcs', 't'),
+                          [np.array(c) for c in zip(*ready)]))
+        optode['timestamp'] = optode['timestamp'].astype('i8')
+        df = process_optode(self.buffer.view(), optode, self.fc,
+                            lat=self.lat, lon=self.lon)
+        self.dropped += len(ready) - len(df)
+        return [_message(self.optode_product, ts, row)
+                for ts, row in zip(df['timestamp'].tolist(),
+                                   _rows(df, ['doxygen', 'preswat']))]
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+.. module:: schema
+   :synopsis: compiled form of the data dictionary.
+"""
+from decimal import Decimal
+from functools import partial
+from dpdata import data_dictionary
+
+
+def quantize(scale, prec, val):
+    return str(Decimal(val*scale).quantize(prec))
+
+
+class SensorSchema(object):
+    """
+    Column layout of a single sensor derived from its data dictionary
+    entry. List-valued variables (*nvals* > 1) are expanded into
+    *name_0* ... *name_N* columns.
+
+    Attributes, all dictionaries are keyed by column name:
+
+    *columns*
+        column names in data dictionary order
+    *kinds*
+        column type, one of ``int``, ``float`` or ``text``
+    *dtypes*
+        NumPy dtype of the decoded column, numeric values are decoded
+        as float64 so missing values can be represented as NaN.
+    *units*, *scale*, *precision*
+        the corresponding data dictionary attributes
+    *converters*
+        functions to convert a raw value to a string
+    *vectors*
+        list of (variable, column names) for the list-valued variables
+    *qc*
+        quality control test parameters (the *qc* attribute), only
+        the columns which have tests are included, see :mod:`dpdata.qc`
+
+    :param name: sensor name
+    :param cfg: data dictionary entry for the sensor
+    """
+    def __init__(self, name, cfg):
+        self.name = name
+        self.cfg = cfg
+        self.columns = []
+        self.kinds = {}
+        self.dtypes = {}
+        self.units = {}
+        self.scale = {}
+        self.precision = {}
+        self.converters = {}
+        self.tostr = {}
+        self.vectors = []
+        self.qc = {}
+        for desc in cfg['data']:
+            precision = desc.get('precision')
+            tostr = desc.get('tostr')
+            if precision is not None:
+                kind = 'int' if precision == '1' else 'float'
+            elif tostr == str:
+                kind = 'text'
+            else:
+                precision = '1'
+                kind = 'int'
+            scale = desc.get('scale', 1.0)
+            if tostr is None:
+                func = partial(quantize, scale, Decimal(precision))
+            else:
+                func = tostr
+            nvals = desc.get('nvals', 1)
+            if nvals == 1:
+                names = [desc['name']]
+            else:
+                names = ['{0}_{1:d}'.format(desc['name'], i)
+                         for i in range(nvals)]
+                self.vectors.append((desc['name'], names))
+            for col in names:
+                self.columns.append(col)
+                self.kinds[col] = kind
+                self.dtypes[col] = 'O' if kind == 'text' else 'f8'
+                self.units[col] = desc.get('units', '')
+                self.scale[col] = scale
+                self.precision[col] = precision
+                self.converters[col] = func
+                if tostr is not None:
+                    self.tostr[col] = tostr
+                if desc.get('qc'):
+                    self.qc[col] = desc['qc']
+
+    def expand(self, data):
+        """
+        Return a new data record with the list-valued variables
+        expanded into separate columns. List values of variables which
+        are not declared with *nvals* are expanded in the same way as
+        :func:`dpdata.expand_lists`.
+
+        :param data: data record
+        :type data: dict
+        """
+        newdict = data.copy()
+        for name, cols in self.vectors:
+            v = newdict.pop(name, None)
+            if v is not None:
+                newdict.update(zip(cols, v))
+        for k, v in list(newdict.items()):
+            if isinstance(v, (list, tuple)):
+                del newdict[k]
+                newdict.update([(k + '_' + str(i), e)
+                                for i, e in enumerate(v)])
+        return newdict
+
+
+class Schema(object):
+    """
+    Compiled data dictionary. Indexing a Schema by sensor name
+    returns a :class:`SensorSchema`, which is built on first use.
+
+    :param data_dict: data dictionary
+    """
+    def __init__(self, data_dict):
+        self.data_dict = data_dict
+        self._sensors = {}
+
+    def __getitem__(self, name):
+        sch = self._sensors.get(name)
+        if sch is None:
+            sch = SensorSchema(name, self.data_dict[name])
+            self._sensors[name] = sch
+        return sch
+
+    def __contains__(self, name):
+        return name in self.data_dict
+
+    def __iter__(self):
+        return iter(self.data_dict)
+
+    def __len__(self):
+        return len(self.data_dict)
+
+
+_schema = None
+
+
+def get_schema(data_dict=None):
+    """
+    Return the compiled schema for a data dictionary. The schema for
+    the default Deep Profiler data dictionary is only built once.
+
+    :param data_dict: data dictionary or :class:`Schema`, if not
+                      specified the default data dictionary is used.
+    :rtype: :class:`Schema`
+    """
+    global _schema
+    if isinstance(data_dict, Schema):
+        return data_dict
+    if data_dict is None:
+        if _schema is None:
+            _schema = Schema(data_dictionary())
+        return _schema
+    return Schema(data_dict)
@@ -4,15 +4,24 @@
    :synopsis: Various data processing functions.
 """
 import numpy as np
-import gsw
-import pandas as pd
 
 
-def dosv(Pt, T, S, P, Pdens, fc):
+# Salinity correction coefficients
+_SCOMP_B = np.array([-6.24097e-3, -6.93498e-3, -6.90358e-3, -4.29155e-3],
+                    dtype='f8')
+_SCOMP_C0 = -3.11680e-7
+
+
+def dosv(Pt, T, S, P, Pdens, fc, blocksize=16384, out=None):
     """
     Calculate dissolved oxygen from Optode bphase and
     temperature using the modified Stern-Volmer equation.
 
+    The calculation is done in blocks of *blocksize* samples using
+    a few preallocated work buffers, so the memory used is the size of
+    the output plus a small constant. The result is float32 if all of
+    the inputs are float32, otherwise float64.
+
     :param Pt: Optode bphase in degrees
     :type Pt: numpy array-like
     :param T: Optode temperature in degrees-C
@@ -24,33 +33,101 @@ def dosv(Pt, T, S, P, Pdens, fc):
     :param Pdens: potential density in kg/m^3
     :type Pdens: numpy array-like
     :param fc: Optode foil coefficients
+    :param blocksize: number of samples per block
+    :param out: optional output array with the broadcast shape of the
+                inputs, it need not be contiguous.
     :returns: dissolved oxygen in umol/kg
-    :rtype: numpy array-like
+    :rtype: numpy array
     """
     assert len(fc) == 7
+    fc = [float(c) for c in fc]
+    args = [np.asarray(x) for x in (Pt, T, S, P, Pdens)]
+    # Decide on the inputs' own dtypes, np.result_type would let a
+    # float64 scalar be downcast to float32.
+    if all([x.dtype == np.float32 for x in args]):
+        dtype = np.float32
+    else:
+        dtype = np.float64
+    shape = np.broadcast(*args).shape
+    Pt, T, S, P, Pdens = [np.broadcast_to(x, shape).reshape(-1)
+                          for x in args]
+    n = len(T)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif out.shape != shape:
+        raise ValueError('dosv: output shape {0} does not match the '
+                         'input shape {1}'.format(out.shape, shape))
+
+    bs = max(1, min(blocksize, n))
+    if out.flags.c_contiguous:
+        result = out.reshape(-1)
+    else:
+        # reshape would return a copy, each block is computed in a
+        # work buffer and copied to the output.
+        result = None
+        w3 = np.empty(bs, dtype=out.dtype)
+    w0 = np.empty(bs, dtype=dtype)
+    w1 = np.empty(bs, dtype=dtype)
+    w2 = np.empty(bs, dtype=dtype)
+    B = _SCOMP_B
+    for i in range(0, n, bs):
+        j = min(i + bs, n)
+        m = j - i
+        t, pt, s, p, dens = T[i:j], Pt[i:j], S[i:j], P[i:j], Pdens[i:j]
+        a, b, c = w0[:m], w1[:m], w2[:m]
+        do = w3[:m] if result is None else result[i:j]
 
-    # Calculate dissolved-oxygen (do) using Stern-Volmer
-    ksv = fc[0] + fc[1]*T + fc[2]*T*T
-    p0 = fc[3] + fc[4]*T
-    pc = fc[5] + fc[6]*Pt
-    do = (p0 / pc - 1.) / ksv
+        # Calculate dissolved-oxygen (do) using Stern-Volmer
+        # ksv = fc[0] + fc[1]*T + fc[2]*T*T
+        np.multiply(t, fc[1], out=a)
+        a += fc[0]
+        np.multiply(t, fc[2], out=b)
+        b *= t
+        a += b
+        # p0 = fc[3] + fc[4]*T, pc = fc[5] + fc[6]*Pt
+        np.multiply(t, fc[4], out=b)
+        b += fc[3]
+        np.multiply(pt, fc[6], out=c)
+        c += fc[5]
+        # do = (p0 / pc - 1.) / ksv
+        np.divide(b, c, out=do)
+        do -= 1.
+        do /= a
 
-    # Convert from volume to mass units
-    do = 1000. * do / Pdens
+        # Convert from volume to mass units
+        do *= 1000.
+        do /= dens
 
-    # Pressure correction
-    pcomp = 1. + (0.032 * P) / 1000.
-    do = pcomp * do
+        # Pressure correction
+        np.multiply(p, 0.032, out=a)
+        a /= 1000.
+        a += 1.
+        do *= a
 
-    # Salinity correction
-    B = np.array([-6.24097e-3, -6.93498e-3, -6.90358e-3, -4.29155e-3],
-                 dtype='f8')
-    C0 = -3.11680e-7
-    ts = np.log((298.15 - T)/(273.15 + T))
-    btmp = B[0] + ts*(B[1] + ts*(B[2] + ts*B[3]))
-    scomp = np.exp(S * btmp) + C0*S*S
+        # Salinity correction
+        # ts = log((298.15 - T)/(273.15 + T))
+        np.subtract(298.15, t, out=a)
+        np.add(t, 273.15, out=b)
+        a /= b
+        np.log(a, out=a)
+        # btmp = B[0] + ts*(B[1] + ts*(B[2] + ts*B[3]))
+        np.multiply(a, B[3], out=b)
+        b += B[2]
+        b *= a
+        b += B[1]
+        b *= a
+        b += B[0]
+        # scomp = exp(S * btmp) + C0*S*S
+        b *= s
+        np.exp(b, out=b)
+        np.multiply(s, _SCOMP_C0, out=c)
+        c *= s
+        b += c
+        do *= b
+        if result is None:
+            out.flat[i:j] = do
 
-    return scomp * do
+    return out
 
 
 def process_optode(ctd, optode, fc, lat=0, lon=0):
@@ -69,30 +146,35 @@ def process_optode(ctd, optode, fc, lat=0, lon=0):
     :returns: processed Optode data-set
     :rtype: :class:`pandas.DataFrame`
     """
+    import gsw
+    import pandas as pd
+    from dpdata.align import align
     # Interpolate CTD data onto the sample times of
     # the Optode data
-    d = {}
-    nan = float('NaN')
-    for column in ('pracsal', 'tempwat', 'preswat'):
-        d[column] = np.interp(optode['timestamp'],
-                              ctd['timestamp'],
-                              ctd[column],
-                              left=nan,
-                              right=nan)
+    t = np.asarray(optode['timestamp'])
+    cols = align(t, np.asarray(ctd['timestamp']),
+                 {'pracsal': ctd['pracsal'],
+                  'tempwat': ctd['tempwat'],
+                  'preswat': ctd['preswat']})
     # Mask off any sample points that are outside of the
-    # interpolation range.
-    mask = ~(np.isnan(d['pracsal']))
-    sa = gsw.SA_from_SP(d['pracsal'][mask], d['preswat'][mask], lon, lat)
-    ct = gsw.CT_from_t(sa, d['tempwat'][mask], d['preswat'][mask])
-    pdens = gsw.rho(sa, ct, np.zeros(len(sa)))
-    do = dosv(optode['doconcs'][mask],
-              optode['t'][mask],
-              d['pracsal'][mask],
-              d['preswat'][mask],
-              pdens, fc)
-    return pd.DataFrame({'timestamp': optode['timestamp'][mask],
+    # interpolation range
+    idx = np.flatnonzero(~np.isnan(cols['pracsal']))
+    pracsal = cols['pracsal'][idx]
+    tempwat = cols['tempwat'][idx]
+    preswat = cols['preswat'][idx]
+    t = t[idx]
+    sa = gsw.SA_from_SP(pracsal, preswat, lon, lat)
+    ct = gsw.CT_from_t(sa, tempwat, preswat)
+    pdens = gsw.rho(sa, ct, 0)
+    do = dosv(np.asarray(optode['doconcs'])[idx],
+              np.asarray(optode['t'])[idx],
+              pracsal, preswat, pdens, fc)
+    index = getattr(optode, 'index', None)
+    return pd.DataFrame({'timestamp': t,
                          'doxygen': do,
-                         'preswat': d['preswat'][mask]})
+                         'preswat': preswat},
+                        columns=['timestamp', 'doxygen', 'preswat'],
+                        index=None if index is None else index[idx])
 
 
 def process_ctd(ctd, lat=0, lon=0):
@@ -107,12 +189,19 @@ def process_ctd(ctd, lat=0, lon=0):
     :returns: processed CTD data-set
     :rtype: :class:`pandas.DataFrame`
     """
-    pracsal = gsw.SP_from_C(ctd['condwat'], ctd['tempwat'], ctd['preswat'])
-    sa = gsw.SA_from_SP(pracsal, ctd['preswat'], lon, lat)
-    ct = gsw.CT_from_t(sa, ctd['tempwat'], ctd['preswat'])
-    density = gsw.rho(sa, ct, ctd['preswat'])
-    return pd.DataFrame({'timestamp': ctd['timestamp'],
+    import gsw
+    import pandas as pd
+    tempwat = np.asarray(ctd['tempwat'])
+    preswat = np.asarray(ctd['preswat'])
+    pracsal = gsw.SP_from_C(np.asarray(ctd['condwat']), tempwat, preswat)
+    sa = gsw.SA_from_SP(pracsal, preswat, lon, lat)
+    ct = gsw.CT_from_t(sa, tempwat, preswat)
+    density = gsw.rho(sa, ct, preswat)
+    return pd.DataFrame({'timestamp': np.asarray(ctd['timestamp']),
                          'pracsal': pracsal,
-                         'tempwat': ctd['tempwat'],
-                         'preswat': ctd['preswat'],
-                         'density': density})
+                         'tempwat': tempwat,
+                         'preswat': preswat,
+                         'density': density},
+                        columns=['timestamp', 'pracsal', 'tempwat',
+                                 'preswat', 'density'],
+                        index=getattr(ctd, 'index', None))
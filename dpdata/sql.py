@@ -3,17 +3,284 @@
 .. module:: sql
    :synopsis: Interface to DP SQL database.
 """
-import pandas as pd
+import time
+import hashlib
 from sqlalchemy import Table, MetaData, select, Column, Integer,\
-    Float, Text
+    SmallInteger, Float, Text, String, create_engine, and_, or_
 from sqlalchemy.sql import func
-from sqlalchemy.exc import NoSuchTableError
+from sqlalchemy.exc import NoSuchTableError, IntegrityError
 from collections import namedtuple
+from dpdata.schema import get_schema
 
 
 
+_SQLTYPES = {'int': Integer, 'float': Float, 'text': Text}
+
 Profile = namedtuple('Profile', ['start', 'end', 'pnum', 'mode'])
 
+
+class DPDatabase(object):
+    """
+    Long-lived interface to the DP database. Table metadata is
+    reflected once and reused, connections are taken from the
+    engine's connection pool and returned after each call. The
+    profile list and calibration constants are cached for *max_age*
+    seconds, after which the rows are read again and the cached value
+    is only rebuilt if a hash of the rows has changed, so changes made
+    by other processes are picked up within *max_age* seconds.
+
+    The module-level functions use the instance returned by
+    :func:`database`, which is shared by all callers using the same
+    engine.
+
+    :param eng: SQLAlchemy database engine or connection string
+    :param max_age: time in seconds for which cached values are used
+                    without checking the database, 0 to check on every
+                    call.
+    :param kwds: passed to :func:`sqlalchemy.create_engine` (e.g.
+                 *pool_size*) when *eng* is a connection string.
+    """
+    #: Maximum number of time ranges in one profile query
+    max_ranges = 100
+
+    def __init__(self, eng, max_age=1.0, **kwds):
+        if not hasattr(eng, 'connect'):
+            eng = create_engine(eng, **kwds)
+        self.eng = eng
+        self.max_age = max_age
+        self.meta = MetaData()
+        self._cache = {}
+
+    def table(self, name, *cols):
+        """
+        Return a reflected table, the table is only reflected on the
+        first call.
+
+        :param name: table name
+        :param cols: columns which override the reflected definitions
+        :rtype: :class:`sqlalchemy.Table`
+        """
+        tbl = self.meta.tables.get(name)
+        if tbl is None:
+            tbl = Table(name, self.meta, *cols,
+                        autoload=True, autoload_with=self.eng)
+        return tbl
+
+    def refresh(self):
+        """
+        Discard all reflected tables and cached values.
+        """
+        self.meta.clear()
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Discard all cached values.
+        """
+        self._cache.clear()
+
+    def _cached(self, key, query, build):
+        now = time.time()
+        entry = self._cache.get(key)
+        if entry is not None and now - entry[2] < self.max_age:
+            return entry[1]
+        with self.eng.connect() as conn:
+            rows = [tuple(r) for r in conn.execute(query)]
+        sig = hashlib.sha1(repr(rows).encode('utf-8')).hexdigest()
+        if entry is not None and entry[0] == sig:
+            value = entry[1]
+        else:
+            value = build(rows)
+        self._cache[key] = (sig, value, now)
+        return value
+
+    def get_profiles(self):
+        """
+        Return a list of profiles available in database. Each
+        list entry is a :class:`Profile` instance.
+        """
+        profiles = self.table('profiles',
+                              Column('start', Integer),
+                              Column('end', Integer))
+        s = select([profiles.c.start, profiles.c.end, profiles.c.pnum,
+                    profiles.c.mode]).order_by(profiles.c.pnum)
+        return self._cached(
+            'profiles', s,
+            lambda rows: [Profile._make(r) for r in rows])
+
+    def get_calibration(self, sensor):
+        """
+        Return the all calibration constants for a sensor.
+
+        :param sensor: sensor name
+        """
+        cal = self.table('calibration')
+        s = select([cal.c.varname, cal.c.val]).where(
+            cal.c.sensor == sensor).order_by(cal.c.varname)
+        return self._cached(('calibration', sensor), s, dict)
+
+    def get_processed(self, product):
+        """
+        Return the processed chunks of a derived product, see
+        :func:`get_processed`.
+        """
+        try:
+            tbl = self.table('processed')
+        except NoSuchTableError:
+            return {}
+        s = select([tbl.c.t_start, tbl.c.signature]).where(
+            tbl.c.product == product)
+        with self.eng.connect() as conn:
+            return dict([tuple(row) for row in conn.execute(s)])
+
+    def set_processed(self, product, chunks):
+        """
+        Record processed chunks of a derived product, see
+        :func:`set_processed`.
+        """
+        if not chunks:
+            return
+        tbl = self.table('processed')
+        starts = list(chunks)
+        with self.eng.connect() as conn:
+            with conn.begin():
+                conn.execute(tbl.delete().where(and_(
+                    tbl.c.product == product, tbl.c.t_start.in_(starts))))
+                conn.execute(tbl.insert(),
+                             [dict(product=product, t_start=t,
+                                   signature=chunks[t]) for t in starts])
+
+    def get_chunk_counts(self, table, length, t_end=0):
+        """
+        Return the number of rows in each chunk of a table, see
+        :func:`get_chunk_counts`.
+        """
+        try:
+            tbl = self.table(table)
+        except NoSuchTableError:
+            return {}
+        start = (tbl.c.timestamp - tbl.c.timestamp % length).label('start')
+        s = select([start, func.count()]).group_by(start)
+        if t_end:
+            s = s.where(tbl.c.timestamp <= t_end)
+        with self.eng.connect() as conn:
+            return dict([tuple(row) for row in conn.execute(s)])
+
+    def get_time_range(self, table):
+        """
+        Return a tuple of the start and end times (in microseconds since
+        1/1/1970 UTC) for the named SQL table.
+
+        :param table: SQL table name
+        """
+        try:
+            tbl = self.table(table)
+        except NoSuchTableError:
+            return 0, 0
+        s = select([func.min(tbl.c.timestamp), func.max(tbl.c.timestamp)])
+        with self.eng.connect() as conn:
+            t0, t1 = conn.execute(s).fetchone()
+        if t0 is None:
+            t0, t1 = 0, 0
+        return t0, t1
+
+    def get_dataset(self, table, t_start=0, t_end=0, columns=None,
+                    chunksize=None):
+        """
+        Return a data-set from the database, see :func:`get_dataset`.
+        """
+        query = dataset_query(self.table(table), t_start, t_end, columns)
+        if chunksize is None:
+            import pandas as pd
+            return pd.read_sql_query(query, self.eng)
+        return iter_query(self.eng, query, chunksize)
+
+    def put_dataset(self, table, df):
+        """
+        Load a dataset into an SQL table, see :func:`put_dataset`.
+        """
+        return put_dataset(self.eng, table, df)
+
+    def get_profile_datasets(self, table, pnums=None, columns=None,
+                             grouped=True):
+        """
+        Return the data from one or more profiles, see
+        :func:`get_profile_datasets`.
+        """
+        import numpy as np
+        import pandas as pd
+        tbl = self.table(table)
+        bounds = profile_bounds(self.get_profiles())
+        position = dict([(pnum, i) for i, pnum in enumerate(sorted(bounds))])
+        if pnums is not None:
+            pnums = set(pnums)
+            bounds = dict([(k, v) for k, v in bounds.items() if k in pnums])
+        selected = sorted(bounds)
+        # Runs of consecutive profiles are read as one time range and
+        # the ranges are queried in batches, SQLite limits the depth
+        # of an expression.
+        ranges = []
+        last = None
+        for pnum in selected:
+            if last is not None and position[pnum] == position[last] + 1:
+                ranges[-1] = (ranges[-1][0], bounds[pnum][1])
+            else:
+                ranges.append(bounds[pnum])
+            last = pnum
+        ts = tbl.c.timestamp
+        query = dataset_query(tbl, columns=columns)
+        if not ranges:
+            frames = [pd.read_sql_query(query.limit(0), self.eng)]
+        else:
+            frames = []
+            for k in range(0, len(ranges), self.max_ranges):
+                cond = or_(*[and_(ts >= t0, ts < t1)
+                             for t0, t1 in ranges[k:k + self.max_ranges]])
+                frames.append(pd.read_sql_query(query.where(cond), self.eng))
+        df = pd.concat(frames, ignore_index=True)
+        # The rows are sorted by time, so each profile is a slice
+        t = df['timestamp'].values
+        parts = []
+        for pnum in selected:
+            i, j = np.searchsorted(t, bounds[pnum])
+            if j > i:
+                parts.append((pnum, df.iloc[i:j]))
+        if grouped:
+            return dict([(pnum, part.reset_index(drop=True))
+                         for pnum, part in parts])
+        if not parts:
+            return df.assign(pnum=np.zeros(0, dtype='i8'))
+        return pd.concat([part.assign(pnum=pnum) for pnum, part in parts],
+                         ignore_index=True)
+
+    def get_profile_dataset(self, table, pnum, columns=None):
+        """
+        Return the data from a single profile, see
+        :func:`get_profile_dataset`.
+        """
+        df = self.get_profile_datasets(table, [pnum], columns=columns,
+                                       grouped=False)
+        return df.drop('pnum', axis=1)
+
+
+def database(eng):
+    """
+    Return the :class:`DPDatabase` shared by all users of an engine,
+    the module-level functions use it so the reflected tables and
+    cached values are reused between calls. The instance lives as
+    long as the engine.
+
+    :param eng: SQLAlchemy database engine or :class:`DPDatabase`
+    """
+    if isinstance(eng, DPDatabase):
+        return eng
+    db = getattr(eng, '_dpdatabase', None)
+    if db is None:
+        db = DPDatabase(eng)
+        eng._dpdatabase = db
+    return db
+
+
 def get_profiles(eng):
     """
     Return a list of profiles available in database. Each
@@ -21,15 +288,7 @@ def get_profiles(eng):
 
     :param eng: SQLAlchemy database engine
     """
-    meta = MetaData()
-    profiles = Table('profiles', meta,
-                     Column('start', Integer),
-                     Column('end', Integer),
-                     autoload=True, autoload_with=eng)
-    s = select([profiles.c.start, profiles.c.end, profiles.c.pnum, profiles.c.mode])
-    conn = eng.connect()
-    result = conn.execute(s)
-    return map(Profile._make, result.fetchall())
+    return database(eng).get_profiles()
 
 
 def get_calibration(eng, sensor):
@@ -39,12 +298,7 @@ def get_calibration(eng, sensor):
     :param eng: SQLAlchemy database engine
     :param sensor: sensor name
     """
-    meta = MetaData()
-    cal = Table('calibration', meta, autoload=True, autoload_with=eng)
-    s = select([cal.c.varname, cal.c.val]).where(cal.c.sensor == sensor)
-    conn = eng.connect()
-    result = conn.execute(s)
-    return dict(result.fetchall())
+    return database(eng).get_calibration(sensor)
 
 
 def get_time_range(eng, table):
@@ -55,42 +309,155 @@ def get_time_range(eng, table):
     :param eng: SQLAlchemy database engine
     :param table: SQL table name
     """
-    meta = MetaData()
-    try:
-        tbl = Table(table, meta, autoload=True, autoload_with=eng)
-    except NoSuchTableError:
-        t0, t1 = 0, 0
+    return database(eng).get_time_range(table)
+
+
+def dataset_query(tbl, t_start=0, t_end=0, columns=None):
+    """
+    Return the SQLAlchemy query for a data-set, see :func:`get_dataset`.
+
+    :param tbl: SQL table
+    :type tbl: :class:`sqlalchemy.Table`
+    :param t_start: start time (in microseconds since 1/1/1970 UTC)
+    :param t_end: end time
+    :param columns: list of column names, the *timestamp* column is
+                    always included.
+    """
+    if columns is None:
+        cols = [tbl]
     else:
-        s = select([func.min(tbl.c.timestamp), func.max(tbl.c.timestamp)])
-        conn = eng.connect()
-        t0, t1 = conn.execute(s).fetchone()
-        if t0 is None:
-            t0, t1 = 0, 0
-    return t0, t1
+        cols = [tbl.c.timestamp] + [tbl.c[name] for name in columns
+                                    if name != 'timestamp']
+    s = select(cols)
+    if t_start != 0 or t_end != 0:
+        if t_end == 0:
+            s = s.where(tbl.c.timestamp > t_start)
+        else:
+            s = s.where(tbl.c.timestamp.between(t_start, t_end))
+    return s.order_by(tbl.c.timestamp)
 
 
-def get_dataset(eng, table, t_start=0, t_end=0):
+def get_dataset(eng, table, t_start=0, t_end=0, columns=None,
+                chunksize=None):
     """
     Return a data-set from the database. If *t_end* is 0, select
     from *t_start* to the end of the table, if both bounds are 0,
     select all rows of the table.
 
+    If *chunksize* is specified, an iterator of DataFrames of at most
+    *chunksize* rows is returned instead of a single DataFrame. The
+    rows are streamed from the database (using a server-side cursor
+    where the backend supports it) so the full data-set is never held
+    in memory. At least one, possibly empty, DataFrame is returned so
+    the chunks can always be passed to :func:`pandas.concat`.
+
     :param eng: SQLAlchemy database engine
     :param table: SQL table name
     :param t_start: start time (in microseconds since 1/1/1970 UTC)
     :param t_end: end time
+    :param columns: list of column names to select, the *timestamp*
+                    column is always included. The default is all
+                    columns.
+    :param chunksize: number of rows per DataFrame
     :rtype: :class:`pandas.DataFrame`
     """
-    if t_start == 0 and t_end == 0:
-        query = 'select * from {}'.format(table)
-        params = None
-    elif t_end == 0:
-        query = 'select * from {} where timestamp > ?'.format(table)
-        params = (t_start,)
-    else:
-        query = 'select * from {} where timestamp between ? and ?'.format(table)
-        params=(t_start, t_end)
-    return pd.read_sql_query(query, eng, params=params)
+    return database(eng).get_dataset(table, t_start, t_end,
+                                       columns=columns, chunksize=chunksize)
+
+
+def iter_query(eng, query, chunksize):
+    """
+    Execute a query and return the results as an iterator of
+    DataFrames of at most *chunksize* rows.
+
+    :param eng: SQLAlchemy database engine
+    :param query: SQLAlchemy query
+    :param chunksize: number of rows per DataFrame
+    """
+    import pandas as pd
+    conn = eng.connect().execution_options(stream_results=True)
+    try:
+        result = conn.execute(query)
+        cols = list(result.keys())
+        empty = True
+        while True:
+            rows = result.fetchmany(chunksize)
+            if not rows:
+                break
+            empty = False
+            yield pd.DataFrame.from_records(rows, columns=cols,
+                                            coerce_float=True)
+        if empty:
+            yield pd.DataFrame(columns=cols)
+    finally:
+        conn.close()
+
+
+def profile_bounds(profiles, now=None):
+    """
+    Return the time range of each profile, in microseconds since
+    1/1/1970 UTC, as a dictionary of (start, end) tuples keyed by
+    profile number. The end time is exclusive and includes the whole
+    of the last second of the profile. A profile without an end time
+    ends at the start of the next profile, or at *now* if it is the
+    last profile. Profiles without a start time are omitted.
+
+    :param profiles: list of :class:`Profile`
+    :param now: current time in seconds, the default is the system
+                time.
+    """
+    if now is None:
+        now = time.time()
+    profiles = sorted([p for p in profiles if p.start is not None],
+                      key=lambda p: (p.start, p.pnum))
+    bounds = {}
+    for i, p in enumerate(profiles):
+        if p.end is not None:
+            end = p.end + 1
+        elif i + 1 < len(profiles):
+            end = profiles[i + 1].start
+        else:
+            end = int(now) + 1
+        bounds[p.pnum] = (p.start * 1000000, end * 1000000)
+    return bounds
+
+
+def get_profile_dataset(eng, table, pnum, columns=None):
+    """
+    Return the data recorded during a profile, the time range of
+    the profile is given by :func:`profile_bounds`.
+
+    :param eng: SQLAlchemy database engine
+    :param table: SQL table name
+    :param pnum: profile number
+    :param columns: list of column names to select, the *timestamp*
+                    column is always included.
+    :rtype: :class:`pandas.DataFrame`
+    """
+    return database(eng).get_profile_dataset(table, pnum, columns=columns)
+
+
+def get_profile_datasets(eng, table, pnums=None, columns=None,
+                         grouped=True):
+    """
+    Return the data recorded during a set of profiles using a
+    single query. The time ranges of the profiles are given by
+    :func:`profile_bounds`, a row can only belong to more than one
+    profile if the recorded profile times overlap.
+
+    :param eng: SQLAlchemy database engine
+    :param table: SQL table name
+    :param pnums: sequence of profile numbers, the default is all
+                  profiles.
+    :param columns: list of column names to select, the *timestamp*
+                    column is always included.
+    :param grouped: if true, return a dictionary of DataFrames keyed
+                    by profile number, otherwise return a single
+                    DataFrame with an additional *pnum* column.
+    """
+    return database(eng).get_profile_datasets(table, pnums,
+                                                columns=columns,
+                                                grouped=grouped)
 
 
 def put_dataset(eng, table, df):
@@ -107,7 +474,181 @@ def put_dataset(eng, table, df):
                      index=False)
 
 
-def make_table(eng, sensor, meta, data_dict):
+def insert_batch(conn, ins, rows):
+    """
+    Insert a batch of rows using a single *executemany* call inside
+    a transaction. Rows whose *timestamp* is already in the table, or
+    repeated within the batch, are skipped; the existing timestamps
+    are found with a single query over the time range of the batch,
+    so re-loading data which is already in the database costs one
+    query per batch. If the insert still violates a constraint (e.g.
+    a concurrent writer or a table without a *timestamp* column), the
+    transaction is rolled back and the batch is split in half and
+    retried until the offending rows are isolated and skipped. Any
+    other error rolls back the transaction and is raised.
+
+    :param conn: SQLAlchemy database connection
+    :param ins: SQLAlchemy insert statement
+    :param rows: list of row dictionaries, missing columns are
+                 inserted as NULL.
+    :returns: number of rows skipped
+    """
+    if not rows:
+        return 0
+    nrows = len(rows)
+    # executemany needs the same keys in every row, primary keys
+    # which are not given are left to the database.
+    given = set().union(*rows)
+    names = [c.name for c in ins.table.c
+             if not c.primary_key or c.name in given]
+    rows = [dict([(name, r.get(name)) for name in names]) for r in rows]
+    rows = _new_rows(conn, ins.table, rows)
+    return nrows - len(rows) + _insert_rows(conn, ins, rows)
+
+
+def _new_rows(conn, tbl, rows):
+    """
+    Return the rows whose timestamps are not in the table or earlier
+    in the batch.
+    """
+    if 'timestamp' not in tbl.c:
+        return rows
+    ts = [r['timestamp'] for r in rows]
+    if None in ts:
+        return rows
+    query = select([tbl.c.timestamp]).where(
+        and_(tbl.c.timestamp >= min(ts), tbl.c.timestamp <= max(ts)))
+    seen = set([row[0] for row in conn.execute(query)])
+    new = []
+    for t, r in zip(ts, rows):
+        if t not in seen:
+            seen.add(t)
+            new.append(r)
+    return new
+
+
+def _insert_rows(conn, ins, rows):
+    if not rows:
+        return 0
+    trans = conn.begin()
+    try:
+        conn.execute(ins, rows)
+    except IntegrityError:
+        trans.rollback()
+    except Exception:
+        trans.rollback()
+        raise
+    else:
+        trans.commit()
+        return 0
+    if len(rows) == 1:
+        return 1
+    mid = len(rows) // 2
+    return _insert_rows(conn, ins, rows[:mid]) + \
+        _insert_rows(conn, ins, rows[mid:])
+
+
+def get_processed(eng, product):
+    """
+    Return the chunks of a derived product which have been processed
+    and the signature of each, which covers the processing parameters
+    (e.g. calibration constants) and the number of raw data rows, see
+    :mod:`dpdata.util.dpprocess`.
+
+    :param eng: SQLAlchemy database engine
+    :param product: derived product (table) name
+    :return: dictionary of signatures keyed by chunk start time (in
+             microseconds since 1/1/1970 UTC)
+    """
+    return database(eng).get_processed(product)
+
+
+def set_processed(eng, product, chunks):
+    """
+    Record processed chunks of a derived product.
+
+    :param eng: SQLAlchemy database engine
+    :param product: derived product (table) name
+    :param chunks: dictionary of signatures keyed by chunk start time
+    """
+    database(eng).set_processed(product, chunks)
+
+
+def get_chunk_counts(eng, table, length, t_end=0):
+    """
+    Return the number of rows in each chunk of a table. The chunks are
+    aligned to multiples of *length* so their boundaries do not depend
+    on the contents of the table.
+
+    :param eng: SQLAlchemy database engine
+    :param table: SQL table name
+    :param length: chunk length in microseconds
+    :param t_end: end time, rows after this time are not counted
+    :return: dictionary of row counts keyed by chunk start time
+    """
+    return database(eng).get_chunk_counts(table, length, t_end)
+
+
+def make_processed_table(eng, meta):
+    """
+    Create the table of processed derived product chunks.
+
+    :param eng: SQLAlchemy database engine
+    :param meta: SQLAlchemy Metadata object
+    :rtype: :class:`sqlalchemy.Table`
+    """
+    tbl = Table('processed', meta,
+                Column('product', String(64), primary_key=True),
+                Column('t_start', Integer, primary_key=True),
+                Column('signature', Text))
+    meta.create_all(eng)
+    return tbl
+
+
+def make_manifest_table(eng, meta):
+    """
+    Create the table of archive files which have been loaded into the
+    database. For each file the size, modification time, a hash of
+    the start of the file and the number of bytes loaded are stored
+    so unchanged files can be skipped and growing files resumed.
+
+    :param eng: SQLAlchemy database engine
+    :param meta: SQLAlchemy Metadata object
+    :rtype: :class:`sqlalchemy.Table`
+    """
+    tbl = Table('manifest', meta,
+                Column('path', String(512), primary_key=True),
+                Column('sensor', String(64)),
+                Column('size', Integer),
+                Column('mtime', Float),
+                Column('prefix_hash', String(40)),
+                Column('offset', Integer),
+                Column('nrows', Integer))
+    meta.create_all(eng)
+    return tbl
+
+
+def make_profiles_table(eng, meta):
+    """
+    Create the table of profile start and end times (in seconds
+    since 1/1/1970 UTC), keyed by profile number. The table is also
+    indexed on the profile start time.
+
+    :param eng: SQLAlchemy database engine
+    :param meta: SQLAlchemy Metadata object
+    :rtype: :class:`sqlalchemy.Table`
+    """
+    tbl = Table('profiles', meta,
+                Column('pnum', Integer, primary_key=True,
+                       autoincrement=False),
+                Column('start', Integer, index=True),
+                Column('end', Integer),
+                Column('mode', Text))
+    meta.create_all(eng)
+    return tbl
+
+
+def make_table(eng, sensor, meta, data_dict, qc=False):
     """
     Create an SQL table for a sensor. The table is added to the
     database and returned. Metdata for the sensor variables is added
@@ -116,40 +657,30 @@ def make_table(eng, sensor, meta, data_dict):
     :param eng: SQLAlchemy database engine
     :param sensor: sensor name
     :param meta: SQLAlchemy Metadata object
-    :param data_dict: data dictionary.
+    :param data_dict: data dictionary or :class:`dpdata.schema.Schema`
+    :param qc: if true, add a *<name>_qc* flag column for each variable
+               with QC tests (see :mod:`dpdata.qc`). The columns are
+               also added to an existing table, see
+               :func:`add_flag_columns`.
     :rtype: :class:`sqlalchemy.Table`
     """
-    if not sensor in data_dict:
+    schema = get_schema(data_dict)
+    if not sensor in schema:
         raise KeyError
+    sch = schema[sensor]
     cols = [Column('timestamp', Integer, unique=True)]
     metadata = []
-    cfg = data_dict[sensor]
-    for desc in cfg['data']:
-        if 'precision' in desc:
-            precision = desc['precision']
-            if desc['precision'] == '1':
-                ctype = Integer
-            else:
-                ctype = Float
-        else:
-            if desc.get('tostr') == str:
-                ctype = Text
-            else:
-                precision = '1'
-                ctype = Integer
-        nvals = desc.get('nvals', 1)
-        units = desc.get('units', '')
-        scale = desc.get('scale', 1.0)
-        if nvals == 1:
-            cols.append(Column(desc['name'], ctype))
-            metadata.append((sensor, desc['name'], units, precision, scale))
-        else:
-            for i in range(nvals):
-                colname = '{0}_{1:d}'.format(desc['name'], i)
-                cols.append(Column(colname, ctype))
-                metadata.append((sensor, colname, units, precision, scale))
+    for name in sch.columns:
+        cols.append(Column(name, _SQLTYPES[sch.kinds[name]]))
+        metadata.append((sensor, name, sch.units[name],
+                         sch.precision[name], sch.scale[name]))
+    if qc:
+        cols.extend([Column(name + '_qc', SmallInteger)
+                     for name in sch.columns if name in sch.qc])
     tbl = Table(sensor, meta, *cols)
     meta.create_all(eng)
+    if qc:
+        add_flag_columns(eng, sensor, schema)
     mdtable = meta.tables.get('metadata')
     if mdtable is not None:
         mdcols = ('sensor', 'varname', 'units', 'precision', 'scale')
@@ -158,3 +689,32 @@ def make_table(eng, sensor, meta, data_dict):
                      [dict(zip(mdcols, m)) for m in metadata])
 
     return tbl
+
+
+def add_flag_columns(eng, sensor, data_dict):
+    """
+    Add any missing QC flag columns to an existing sensor table, e.g.
+    one created without *qc* by :func:`make_table`.
+
+    :param eng: SQLAlchemy database engine
+    :param sensor: sensor name
+    :param data_dict: data dictionary or :class:`dpdata.schema.Schema`
+    :return: list of the names of the columns added
+    """
+    from sqlalchemy import inspect
+    sch = get_schema(data_dict)[sensor]
+    existing = set([c['name'] for c in inspect(eng).get_columns(sensor)])
+    quote = eng.dialect.identifier_preparer.quote
+    added = []
+    with eng.connect() as conn:
+        for name in sch.columns:
+            col = name + '_qc'
+            if name not in sch.qc or col in existing:
+                continue
+            conn.execute('ALTER TABLE {0} ADD COLUMN {1} SMALLINT'.format(
+                quote(sensor), quote(col)))
+            added.append(col)
+    if added:
+        # The reflected table no longer matches the database
+        database(eng).refresh()
+    return added
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""
+.. module:: stats
+   :synopsis: Counters and histograms for the ingest tools.
+"""
+import os
+import sys
+import json
+import math
+import time
+import threading
+
+
+class NullStats(object):
+    """
+    Statistics collector which does nothing, used when the
+    instrumentation is disabled. Callers can check the *enabled*
+    attribute to skip timing measurements.
+    """
+    enabled = False
+
+    def incr(self, name, n=1):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def gauge(self, name, value):
+        pass
+
+    def snapshot(self):
+        return {}
+
+
+#: Shared disabled collector
+NULL_STATS = NullStats()
+
+
+class Histogram(object):
+    """
+    Histogram with power-of-two bucket boundaries, so no range needs
+    to be configured and the bucket lookup is a single
+    :func:`math.frexp` call.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        # Bucket e holds the values in (2**(e-1), 2**e]
+        m, e = math.frexp(value)
+        if m == 0.5:
+            e -= 1
+        self.buckets[e] = self.buckets.get(e, 0) + 1
+
+    def summary(self):
+        return {'count': self.count,
+                'sum': self.total,
+                'min': self.min,
+                'max': self.max,
+                'mean': self.total / self.count if self.count else None,
+                'buckets': [[math.ldexp(1., e), self.buckets[e]]
+                            for e in sorted(self.buckets)]}
+
+
+class Stats(NullStats):
+    """
+    Thread-safe collector of counters, gauges and histograms. Names
+    are free-form strings, the ingest tools use *<metric>.<sensor>*
+    for per-sensor values. A gauge may be a callable, which is
+    evaluated when a snapshot is taken (e.g. a queue length).
+    """
+    enabled = True
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        with self._lock:
+            h = self.histograms.get(name)
+            if h is None:
+                h = self.histograms[name] = Histogram()
+            h.add(value)
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def snapshot(self):
+        """
+        Return the current values as a JSON-serializable dictionary.
+        """
+        with self._lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = dict([(k, h.summary())
+                               for k, h in self.histograms.items()])
+        for k, v in gauges.items():
+            if callable(v):
+                try:
+                    gauges[k] = v()
+                except Exception:
+                    # e.g. multiprocessing.Queue.qsize is not available
+                    # on all platforms
+                    gauges[k] = None
+        now = time.time()
+        return {'time': now,
+                'uptime': now - self.started,
+                'counters': counters,
+                'gauges': gauges,
+                'histograms': histograms}
+
+
+def write_snapshot(path, snap):
+    """
+    Write a snapshot to a JSON file. The file is replaced atomically
+    so readers never see a partial file.
+    """
+    tmpfile = path + '.tmp'
+    with open(tmpfile, 'w') as f:
+        json.dump(snap, f, sort_keys=True)
+    os.rename(tmpfile, path)
+
+
+class Reporter(threading.Thread):
+    """
+    Thread which reports the statistics every *interval* seconds as
+    a single ``stats {...}`` JSON line on *stream* and/or by
+    rewriting the JSON file *path*. A final report is made by
+    :meth:`stop`.
+
+    :param stats: statistics collector
+    :type stats: :class:`Stats`
+    :param interval: reporting interval in seconds
+    :param stream: output stream for the log line
+    :param path: stats file name
+    """
+    def __init__(self, stats, interval, stream=None, path=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.stats = stats
+        self.interval = interval
+        self.stream = stream
+        self.path = path
+        self._done = threading.Event()
+
+    def report(self):
+        snap = self.stats.snapshot()
+        if self.stream is not None:
+            self.stream.write('stats ' + json.dumps(snap, sort_keys=True) +
+                              '\n')
+            self.stream.flush()
+        if self.path is not None:
+            write_snapshot(self.path, snap)
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        self._done.set()
+        if self.is_alive():
+            self.join()
+        self.report()
+
+
+def start_stats(interval=0, path=None):
+    """
+    Create the statistics collector for an ingest tool. The
+    instrumentation is only enabled if a log interval or a stats file
+    is given.
+
+    :param interval: log interval in seconds, 0 to disable the log
+                     line.
+    :param path: stats file, updated every *interval* seconds (every
+                 10 seconds if no log interval is given).
+    :return: tuple of collector and running :class:`Reporter` (or
+             ``None``).
+    """
+    if not interval and not path:
+        return NULL_STATS, None
+    stats = Stats()
+    reporter = Reporter(stats, interval or 10.,
+                        stream=sys.stderr if interval else None,
+                        path=path)
+    reporter.start()
+    return stats, reporter
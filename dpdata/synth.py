@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+"""
+.. module:: synth
+   :synopsis: Synthetic Deep Profiler data for testing and benchmarks.
+"""
+import zlib
+import heapq
+import numpy as np
+from dpdata.mpk import put_record
+from dpdata.schema import get_schema
+
+#: Default sample rates in Hz
+RATES = {
+    'ctd_1': 1.0,
+    'optode_1': 0.5,
+    'flntu_1': 1.0,
+    'flcd_1': 1.0,
+    'acm_1': 2.0,
+    'profiler': 0.2,
+    'mmp': 0.2,
+    'charger': 0.1,
+    'dock': 0.1,
+}
+
+
+class Deployment(object):
+    """
+    Model of the profiler motion. The profiler alternates between
+    up profiles (from *pmax* to *pmin*) and down profiles (from
+    *pmin* to *pmax*) at a constant speed and rests for *rest*
+    seconds at the end of each profile. Profile numbers start at 1
+    and the first profile is an up profile.
+
+    :param start: start time in seconds since 1/1/1970 UTC
+    :param pmin: minimum pressure in dbar
+    :param pmax: maximum pressure in dbar
+    :param speed: profiling speed in dbar/s
+    :param rest: time between profiles in seconds
+    """
+    def __init__(self, start=1400000000, pmin=10., pmax=2000., speed=0.25,
+                 rest=600.):
+        self.start = start
+        self.pmin = pmin
+        self.pmax = pmax
+        self.rest = rest
+        self.profile_time = (pmax - pmin) / speed
+        self.period = 2 * (self.profile_time + rest)
+
+    def pressure(self, t):
+        """
+        Return the profiler pressure at a set of times.
+
+        :param t: times in seconds since 1/1/1970 UTC
+        :rtype: numpy array
+        """
+        tp, r = self.profile_time, self.rest
+        knots = [0., tp, tp + r, 2 * tp + r, self.period]
+        values = [self.pmax, self.pmin, self.pmin, self.pmax, self.pmax]
+        phase = np.mod(np.asarray(t, dtype='f8') - self.start, self.period)
+        return np.interp(phase, knots, values)
+
+    def pnum(self, t):
+        """
+        Return the number of the profile in progress, or most recently
+        completed, at a set of times.
+        """
+        t = np.asarray(t, dtype='f8') - self.start
+        return (t // (self.profile_time + self.rest)).astype(int) + 1
+
+    def profiles(self, duration):
+        """
+        Return the profiles which start within *duration* seconds of
+        the deployment start.
+
+        :return: list of (pnum, start, end, mode) tuples, times are in
+                 seconds since 1/1/1970 UTC.
+        """
+        result = []
+        step = self.profile_time + self.rest
+        k = 0
+        while k * step < duration:
+            start = self.start + k * step
+            result.append((k + 1, int(start), int(start + self.profile_time),
+                           'up' if k % 2 == 0 else 'down'))
+            k += 1
+        return result
+
+
+def _physical(sensor, t, p, dep, rng):
+    # Realistic values for the core science sensors, raw values for
+    # the rest are generated by _generic.
+    n = len(t)
+    if sensor == 'ctd_1':
+        import gsw
+        temp = 2. + 18. * np.exp(-p / 500.) + rng.normal(0, 0.005, n)
+        salt = 34.2 + 0.5 * (1. - np.exp(-p / 1000.)) + \
+            rng.normal(0, 0.002, n)
+        cond = gsw.C_from_SP(salt, temp, p)
+        return {'condwat': cond, 'tempwat': temp,
+                'preswat': p + rng.normal(0, 0.05, n)}
+    if sensor == 'optode_1':
+        temp = 2. + 18. * np.exp(-p / 500.) + rng.normal(0, 0.01, n)
+        return {'doconcs': 30. + 8. * np.exp(-p / 800.) +
+                rng.normal(0, 0.02, n),
+                't': temp}
+    if sensor == 'profiler':
+        return {'profile': dep.pnum(t), 'pressure': p * 1000.}
+    if sensor == 'mmp':
+        return {'pnum': dep.pnum(t), 'pressure': p}
+    return {}
+
+
+def _generic(sch, col, n, rng):
+    kind = sch.kinds[col]
+    if kind == 'text':
+        return rng.choice(['up', 'down', 'docked', 'charging'], n)
+    # A slowly varying value around a column dependent level
+    level = 10. + (zlib.crc32(col.encode('utf-8')) % 90)
+    walk = np.cumsum(rng.normal(0, 0.01, n))
+    value = (level + walk) / sch.scale[col]
+    if kind == 'int':
+        return np.round(value).astype(int)
+    return value
+
+
+def sample_times(t_start, duration, rate):
+    """
+    Return the sample times of a sensor.
+
+    :param t_start: start time in seconds since 1/1/1970 UTC
+    :param duration: length of the data-set in seconds
+    :param rate: sample rate in Hz
+    :return: tuple of seconds and microseconds arrays
+    """
+    n = int(duration * rate)
+    usecs = int(t_start * 1000000) + \
+        np.round(np.arange(n) * (1000000. / rate)).astype('i8')
+    return usecs // 1000000, usecs % 1000000
+
+
+def records(sensor, duration, rate=None, deployment=None, data_dict=None,
+            seed=0, chunksize=10000):
+    """
+    Generate data records for a sensor in the data dictionary. The
+    records have the same form as the records in the MessagePack
+    archives, list-valued variables (e.g. *charger.current*) are
+    returned as lists.
+
+    :param sensor: sensor name
+    :param duration: length of the data-set in seconds
+    :param rate: sample rate in Hz, defaults to the value in
+                 :data:`RATES`.
+    :param deployment: profiler motion model
+    :type deployment: :class:`Deployment`
+    :param data_dict: data dictionary or :class:`dpdata.schema.Schema`
+    :param seed: random number generator seed
+    :param chunksize: number of records generated at a time
+    :return: iterator of (secs, usecs, data) tuples
+    """
+    sch = get_schema(data_dict)[sensor]
+    dep = deployment or Deployment()
+    rate = rate or RATES.get(sensor, 1.0)
+    rng = np.random.RandomState(seed)
+    secs, usecs = sample_times(dep.start, duration, rate)
+    vectors = dict(sch.vectors)
+    expanded = set([c for cols in vectors.values() for c in cols])
+    for i in range(0, len(secs), chunksize):
+        s, u = secs[i:i + chunksize], usecs[i:i + chunksize]
+        t = s + u * 1e-6
+        p = dep.pressure(t)
+        cols = _physical(sensor, t, p, dep, rng)
+        for col in sch.columns:
+            if col not in cols:
+                cols[col] = _generic(sch, col, len(t), rng)
+        fields = [(c, cols[c].tolist()) for c in sch.columns
+                  if c not in expanded]
+        fields.extend([(name, np.column_stack([cols[c] for c in names])
+                        .tolist()) for name, names in vectors.items()])
+        names = [name for name, _ in fields]
+        for j, row in enumerate(zip(*[v for _, v in fields])):
+            yield int(s[j]), int(u[j]), dict(zip(names, row))
+
+
+def write_archive(filename, sensor, duration, rate=None, deployment=None,
+                  data_dict=None, seed=0):
+    """
+    Write a MessagePack archive of synthetic data.
+
+    :return: number of records written
+    """
+    n = 0
+    with open(filename, 'wb') as f:
+        for secs, usecs, data in records(sensor, duration, rate=rate,
+                                         deployment=deployment,
+                                         data_dict=data_dict, seed=seed):
+            put_record(f, secs, usecs, data)
+            n += 1
+    return n
+
+
+def _data_messages(sensor, k, recs):
+    for secs, usecs, data in recs:
+        yield (secs, usecs, k, 0, 'DATA',
+               {'name': sensor, 't': [secs, usecs], 'data': data})
+
+
+def messages(sensors, duration, rates=None, deployment=None,
+             data_dict=None, seed=0):
+    """
+    Generate the message stream of the DP server, i.e. *DATA*
+    messages from a set of sensors and the *profile:start* and
+    *profile:end* *EVENT* messages, in time order.
+
+    :param sensors: list of sensor names
+    :param duration: length of the data-set in seconds
+    :param rates: dictionary of sample rates in Hz
+    :return: iterator of (message-type, contents) tuples which can be
+             sent with :func:`dpdata.zmq.send_message`.
+    """
+    dep = deployment or Deployment()
+    rates = rates or {}
+    streams = []
+    for k, sensor in enumerate(sensors):
+        recs = records(sensor, duration, rate=rates.get(sensor),
+                       deployment=dep, data_dict=data_dict, seed=seed + k)
+        streams.append(_data_messages(sensor, k, recs))
+    events = []
+    for pnum, start, end, mode in dep.profiles(duration):
+        events.append((start, 0, -1, 2 * pnum, 'EVENT',
+                       {'name': 'profile:start', 't': [start, 0],
+                        'attrs': {'pnum': pnum, 'mode': mode}}))
+        if end < dep.start + duration:
+            events.append((end, 0, -1, 2 * pnum + 1, 'EVENT',
+                           {'name': 'profile:end', 't': [end, 0],
+                            'attrs': {'pnum': pnum}}))
+    events.sort(key=lambda e: e[:4])
+    streams.append(events)
+    for item in heapq.merge(*streams):
+        yield item[4], item[5]
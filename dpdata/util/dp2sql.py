@@ -3,13 +3,24 @@
 Subscribe to one or more Deep Profiler data streams and log
 the data records to an SQL database.
 """
+import os
 import sys
+import time
 import argparse
+import threading
 import zmq
 from dpdata import expand_lists
+from dpdata.schema import get_schema
+from dpdata.mpk import ArchiveWriter
 from dpdata.zmq import recv_message
+from dpdata.sql import insert_batch
+from dpdata.stats import NULL_STATS, start_stats
 from sqlalchemy import create_engine, MetaData
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import SQLAlchemyError
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 
 def subscribe(ctx, endpoint):
@@ -19,57 +30,309 @@ def subscribe(ctx, endpoint):
     return sock
 
 
-def add_record(conn, ins, data):
-    conn.execute(ins, **data)
-
-
 def insert_event(msg, conn, meta):
+    """
+    Record a profile start or end event. The profile row is updated
+    if it already exists, so repeated events and an end event which
+    arrives before the start event are handled.
+    """
     tbl = meta.tables.get('profiles')
     if tbl is not None:
-        ins = tbl.insert()
         secs, usecs = msg['t']
         attrs = msg['attrs']
         if msg['name'] == 'profile:start':
-            conn.execute(ins, start=secs, pnum=attrs['pnum'],
-                         mode=attrs['mode'])
+            values = {'start': secs, 'mode': attrs['mode']}
         elif msg['name'] == 'profile:end':
-            upd = tbl.update().where(tbl.c.pnum == attrs['pnum'])
-            try:
-                conn.execute(upd, end=secs)
-            except IntegrityError:
-                conn.execute(ins, pnum=attrs['pnum'], end=secs)
+            values = {'end': secs}
+        else:
+            return
+        upd = tbl.update().where(tbl.c.pnum == attrs['pnum'])
+        with conn.begin():
+            if conn.execute(upd, **values).rowcount == 0:
+                conn.execute(tbl.insert(), pnum=attrs['pnum'], **values)
 
 
-def insert_data(msg, conn, meta):
+def make_row(msg):
     secs, usecs = msg['t']
-    tbl = meta.tables.get(msg['name'])
-    if tbl is not None:
-        data = msg['data']
-        ins = tbl.insert()
-        data['timestamp'] = int(secs * 1000000) + usecs
+    data = msg['data']
+    data['timestamp'] = int(secs * 1000000) + usecs
+    schema = get_schema()
+    if msg['name'] in schema:
+        return schema[msg['name']].expand(data)
+    return expand_lists(data)
+
+
+class Writer(threading.Thread):
+    """
+    Thread which consumes messages from a queue and writes them to
+    the database. Data records are collected into per-table batches
+    which are written when a batch reaches *batch_size* rows or
+    every *interval* seconds, whichever comes first. A ``None``
+    message flushes all pending batches and stops the thread.
+
+    If a batch cannot be written, the connection is rolled back and
+    invalidated (so it is re-opened on the next write) and the rows
+    are kept for the next write. After *retries* failed attempts the
+    rows are passed to *spill*, if given, rather than retried.
+
+    :param q: message queue
+    :param eng: SQLAlchemy database engine
+    :param meta: reflected database metadata
+    :param logevents: if true, log profile events
+    :param batch_size: maximum number of rows per batch
+    :param interval: maximum time in seconds between writes
+    :param stats: statistics collector
+    :type stats: :class:`dpdata.stats.Stats`
+    :param spill: destination for rows which cannot be written
+    :type spill: :class:`Spiller`
+    :param retries: number of attempts to write a batch before it is
+                    spilled
+    """
+    def __init__(self, q, eng, meta, logevents=False,
+                 batch_size=100, interval=1.0, stats=NULL_STATS,
+                 spill=None, retries=3):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = q
+        self.eng = eng
+        self.meta = meta
+        self.logevents = logevents
+        self.batch_size = batch_size
+        self.interval = interval
+        self.stats = stats
+        self.spill = spill
+        self.retries = retries
+        self.pending = {}
+        self.failures = {}
+
+    def flush(self, conn, name):
+        rows = self.pending.pop(name, None)
+        if not rows:
+            return
+        stats = self.stats
+        t = time.time()
         try:
-            add_record(conn, ins, expand_lists(data))
-        except IntegrityError as e:
+            n = insert_batch(conn, self.meta.tables[name].insert(), rows)
+        except SQLAlchemyError as e:
+            stats.incr('failed.' + name, len(rows))
             sys.stderr.write(repr(e) + '\n')
-            sys.stderr.write('Skipping row @[{0:d}, {1:d}]\n'.format(secs, usecs))
+            if conn.in_transaction():
+                conn.get_transaction().rollback()
+            conn.invalidate()
+            nfail = self.failures.get(name, 0) + 1
+            if self.spill is not None and nfail >= self.retries:
+                self.spill.write_rows(name, rows)
+                self.failures.pop(name, None)
+                sys.stderr.write('Spilled {0:d} {1} rows\n'.format(
+                    len(rows), name))
+            else:
+                # Retry with the next batch, ahead of any new rows
+                self.failures[name] = nfail
+                self.pending[name] = rows + self.pending.get(name, [])
+        else:
+            self.failures.pop(name, None)
+            if stats.enabled:
+                stats.observe('insert_latency.' + name, time.time() - t)
+                stats.observe('batch_size.' + name, len(rows))
+                stats.incr('inserted.' + name, len(rows) - n)
+                stats.incr('skipped.' + name, n)
+            if n:
+                sys.stderr.write('Skipped {0:d} {1} rows\n'.format(n, name))
+
+    def flush_all(self, conn):
+        for name in list(self.pending):
+            self.flush(conn, name)
+
+    def run(self):
+        conn = self.eng.connect()
+        deadline = time.time() + self.interval
+        while True:
+            try:
+                msg = self.queue.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                pass
+            else:
+                if msg is None:
+                    break
+                try:
+                    self.handle(conn, msg)
+                except Exception as e:
+                    # A bad message must not stop the writer
+                    self.stats.incr('errors')
+                    sys.stderr.write(repr(e) + '\n')
+                    sys.stderr.write('Dropping message: {0!r}\n'.format(msg))
+                    if conn.in_transaction():
+                        conn.get_transaction().rollback()
+            if time.time() >= deadline:
+                self.flush_all(conn)
+                deadline = time.time() + self.interval
+        self.flush_all(conn)
+        conn.close()
+
+    def handle(self, conn, msg):
+        mtype, contents = msg
+        if mtype == 'DATA':
+            name = contents['name']
+            if name in self.meta.tables:
+                rows = self.pending.setdefault(name, [])
+                rows.append(make_row(contents))
+                if len(rows) >= self.batch_size:
+                    self.flush(conn, name)
+        elif mtype == 'EVENT' and self.logevents:
+            # Keep events in order with respect to the data
+            self.flush_all(conn)
+            insert_event(contents, conn, self.meta)
+
+
+class Spiller(object):
+    """
+    Write data messages which do not fit in the queue to per-sensor
+    MessagePack files in a directory. The files can be loaded into
+    the database later with ``mpk2sql``. The files are buffered, call
+    :meth:`flush` periodically so the spilled data reaches the disk
+    when the overflow stops.
+
+    :param dirname: output directory
+    """
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.files = {}
+        # Used by the receiving and the writer threads
+        self.lock = threading.Lock()
+
+    def _writer(self, name):
+        writer = self.files.get(name)
+        if writer is None:
+            writer = ArchiveWriter(os.path.join(self.dirname, name))
+            self.files[name] = writer
+        return writer
+
+    def __call__(self, msg):
+        mtype, contents = msg
+        if mtype != 'DATA':
+            return False
+        secs, usecs = contents['t']
+        with self.lock:
+            self._writer(contents['name']).write(secs, usecs,
+                                                 contents['data'])
+        return True
+
+    def write_rows(self, name, rows):
+        """
+        Write database rows, e.g. from a batch which could not be
+        inserted, to the file for a table.
+
+        :param name: table name
+        :param rows: list of row dictionaries with a *timestamp*
+        """
+        with self.lock:
+            writer = self._writer(name)
+            for row in rows:
+                data = dict(row)
+                t = data.pop('timestamp')
+                writer.write(t // 1000000, t % 1000000, data)
+
+    def flush(self):
+        """
+        Write the buffered data to the files.
+        """
+        with self.lock:
+            for writer in self.files.values():
+                writer.flush()
+
+    def close(self):
+        with self.lock:
+            for writer in self.files.values():
+                writer.close()
+            self.files = {}
+
+
+def enqueue(q, msg, overflow='block', spill=None):
+    """
+    Add a message to the writer queue. If the queue is full, the
+    *overflow* policy determines what happens; ``block`` waits for
+    space, ``drop`` discards the oldest data message in the queue and
+    ``spill`` passes data messages to the *spill* function. Event
+    messages are never dropped or spilled.
+
+    :return: True if a message was dropped or spilled
+    """
+    if overflow == 'block' or msg[0] != 'DATA':
+        q.put(msg)
+        return False
+    try:
+        q.put_nowait(msg)
+        return False
+    except queue.Full:
+        pass
+    if overflow == 'spill':
+        spill(msg)
+        return True
+    with q.mutex:
+        # Replace the oldest data message, the events stay in order
+        for i, m in enumerate(q.queue):
+            if m is not None and m[0] == 'DATA':
+                del q.queue[i]
+                q.queue.append(msg)
+                q.not_empty.notify()
+                return True
+    # The queue only holds events
+    q.put(msg)
+    return False
 
 
-def monitor(socks, conn, meta, logevents=False):
+def monitor(socks, eng, meta, logevents=False, batch_size=100,
+            interval=1.0, qsize=10000, overflow='block', spilldir='.',
+            stats=NULL_STATS):
     """
     Monitor a list of sockets and insert data records
-    in an SQLAlchemy-managed database.
+    in an SQLAlchemy-managed database. The messages are received on
+    the calling thread and passed to a :class:`Writer` thread through
+    a bounded queue. Spilled data, and rows which the writer could not
+    insert, are written to *spilldir* at least every *interval*
+    seconds.
     """
+    q = queue.Queue(qsize)
+    stats.gauge('queue_depth', q.qsize)
+    # Also used for rows which the writer fails to insert
+    spill = Spiller(spilldir)
+    writer = Writer(q, eng, meta, logevents=logevents,
+                    batch_size=batch_size, interval=interval, stats=stats,
+                    spill=spill)
+    writer.start()
     poller = zmq.Poller()
     for sock in socks:
         poller.register(sock)
-    while True:
-        ready = dict(poller.poll())
-        for sock in ready:
-            mtype, contents = recv_message(sock)
-            if mtype == 'DATA':
-                insert_data(contents, conn, meta)
-            elif mtype == 'EVENT' and logevents:
-                insert_event(contents, conn, meta)
+    overflows = 0
+    last_flush = time.time()
+    try:
+        while True:
+            ready = dict(poller.poll(interval * 1000))
+            if time.time() - last_flush >= interval:
+                spill.flush()
+                last_flush = time.time()
+            for sock in ready:
+                if stats.enabled:
+                    t = time.time()
+                    msg = recv_message(sock)
+                    stats.observe('decode_time', time.time() - t)
+                    if msg[0] == 'DATA':
+                        stats.incr('received.' + msg[1]['name'])
+                    else:
+                        stats.incr('events')
+                else:
+                    msg = recv_message(sock)
+                if enqueue(q, msg, overflow, spill):
+                    overflows += 1
+                    stats.incr('overflow.' + overflow)
+                    if overflows % 1000 == 1:
+                        sys.stderr.write('Queue full ({0}): {1:d} '
+                                         'messages\n'.format(overflow,
+                                                             overflows))
+    finally:
+        q.put(None)
+        writer.join()
+        spill.close()
 
 
 def main():
@@ -79,6 +342,30 @@ def main():
                         nargs='+')
     parser.add_argument('--events', help='log profile start/end events',
                         action='store_true')
+    parser.add_argument('-b', '--batch', metavar='N', type=int, default=100,
+                        help='maximum rows per database write '
+                        '(default: %(default)d)')
+    parser.add_argument('-i', '--interval', metavar='SECS', type=float,
+                        default=1.0,
+                        help='maximum time between database writes '
+                        '(default: %(default).1f)')
+    parser.add_argument('-q', '--queue', metavar='N', type=int,
+                        default=10000,
+                        help='maximum number of queued messages '
+                        '(default: %(default)d)')
+    parser.add_argument('--overflow', choices=('block', 'drop', 'spill'),
+                        default='block',
+                        help='action when the queue is full '
+                        '(default: %(default)s)')
+    parser.add_argument('--spill-dir', metavar='DIR', default='.',
+                        help='directory for spilled data files and '
+                        'rows which could not be inserted')
+    parser.add_argument('--stats-interval', metavar='SECS', type=float,
+                        default=0,
+                        help='log ingest statistics as JSON every SECS '
+                        'seconds')
+    parser.add_argument('--stats-file', metavar='FILE',
+                        help='write ingest statistics to FILE')
     args = parser.parse_args()
 
     eng = create_engine(args.db)
@@ -87,7 +374,15 @@ def main():
 
     ctx = zmq.Context()
     socks = [subscribe(ctx, p) for p in args.publisher]
-    monitor(socks, eng.connect(), meta, logevents=args.events)
+    stats, reporter = start_stats(args.stats_interval, args.stats_file)
+    try:
+        monitor(socks, eng, meta, logevents=args.events,
+                batch_size=args.batch, interval=args.interval,
+                qsize=args.queue, overflow=args.overflow,
+                spilldir=args.spill_dir, stats=stats)
+    finally:
+        if reporter is not None:
+            reporter.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+Time each stage of the Deep Profiler data pipeline on synthetic data
+and write the results as JSON for regression tracking.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import shutil
+import platform
+import argparse
+import tempfile
+import timeit
+import numpy as np
+import dpdata
+from dpdata import expand_lists, synth, sci
+from dpdata.mpk import get_records
+from dpdata.schema import get_schema
+from dpdata.sql import get_dataset
+from dpdata.util.mktables import make_tables
+from dpdata.util.mpk2csv import format_records, format_chunks
+from dpdata.util.mpk2sql import load_batches, _expander
+from sqlalchemy import create_engine, MetaData
+
+clock = timeit.default_timer
+
+# Optode foil coefficients used for the benchmarks
+FOIL_COEFFS = [2.8e-3, 1.1e-4, 2.4e-6, 230., -0.3, -50., 4.5]
+
+SENSORS = ('ctd_1', 'optode_1', 'charger')
+
+
+class Bench(object):
+    """
+    Benchmark state shared by the stages, the synthetic archives and
+    the SQLite database are created in *workdir*.
+    """
+    def __init__(self, workdir, duration):
+        self.workdir = workdir
+        self.duration = duration
+        self.url = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+
+    def archive(self, sensor):
+        return os.path.join(self.workdir, sensor + '.mpk')
+
+    def synth(self):
+        n = 0
+        for sensor in SENSORS:
+            n += synth.write_archive(self.archive(sensor), sensor,
+                                     self.duration)
+        return n
+
+    def get_records(self):
+        n = 0
+        with open(self.archive('ctd_1'), 'rb') as f:
+            for rec in get_records(f):
+                n += 1
+        return n
+
+    def expand_lists(self):
+        with open(self.archive('charger'), 'rb') as f:
+            recs = [data for _, _, data in get_records(f)]
+        t = clock()
+        for data in recs:
+            expand_lists(data)
+        return len(recs), clock() - t
+
+    def mpk2csv(self):
+        n = 0
+        with open(self.archive('ctd_1'), 'rb') as f:
+            for line in format_records(f, get_schema()['ctd_1']):
+                n += 1
+        return n
+
+    def mpk2csv_fast(self):
+        n = 0
+        with open(self.archive('ctd_1'), 'rb') as f:
+            for chunk in format_chunks(f, get_schema()['ctd_1']):
+                n += chunk.count('\n')
+        return n
+
+    def mpk2sql(self):
+        path = self.url[len('sqlite:///'):]
+        if os.path.exists(path):
+            os.remove(path)
+        eng = create_engine(self.url)
+        make_tables(eng, get_schema())
+        meta = MetaData()
+        meta.reflect(bind=eng)
+        t = clock()
+        n = 0
+        conn = eng.connect()
+        for sensor in ('ctd_1', 'optode_1'):
+            with open(self.archive(sensor), 'rb') as f:
+                n += load_batches(conn, meta.tables[sensor].insert(), f,
+                                  1000, _expander(sensor))[0]
+        conn.close()
+        return n, clock() - t
+
+    def get_dataset(self):
+        return len(get_dataset(create_engine(self.url), 'ctd_1'))
+
+    def process_ctd(self):
+        ctd = get_dataset(create_engine(self.url), 'ctd_1')
+        t = clock()
+        sci.process_ctd(ctd)
+        return len(ctd), clock() - t
+
+    def process_optode(self):
+        eng = create_engine(self.url)
+        ctd = sci.process_ctd(get_dataset(eng, 'ctd_1'))
+        optode = get_dataset(eng, 'optode_1')
+        t = clock()
+        sci.process_optode(ctd, optode, FOIL_COEFFS)
+        return len(optode), clock() - t
+
+    def dosv(self):
+        n = 1000000
+        rng = np.random.RandomState(0)
+        args = [30. + rng.random_sample(n), 2. + rng.random_sample(n),
+                34. + rng.random_sample(n), 2000. * rng.random_sample(n),
+                1027. + rng.random_sample(n)]
+        t = clock()
+        sci.dosv(*(args + [FOIL_COEFFS]))
+        return n, clock() - t
+
+
+#: Benchmark stages in run order, later stages use the output of
+#: earlier ones.
+STAGES = ('synth', 'get_records', 'expand_lists', 'mpk2csv', 'mpk2csv_fast',
+          'mpk2sql', 'get_dataset', 'process_ctd', 'process_optode', 'dosv')
+
+
+def run_stage(bench, name, repeat):
+    """
+    Run a benchmark stage *repeat* times. A stage returns the number
+    of items processed and, optionally, the elapsed time of the part
+    which is being measured (excluding any setup).
+
+    :return: result dictionary
+    """
+    times = []
+    for i in range(repeat):
+        t = clock()
+        result = getattr(bench, name)()
+        elapsed = clock() - t
+        if isinstance(result, tuple):
+            nitems, elapsed = result
+        else:
+            nitems = result
+        times.append(elapsed)
+    best = min(times)
+    return {'stage': name,
+            'items': nitems,
+            'times': times,
+            'best': best,
+            'rate': nitems / best if best > 0 else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-d', '--duration', metavar='SECS', type=float,
+                        default=86400.,
+                        help='length of the synthetic data-set '
+                        '(default: %(default).0f)')
+    parser.add_argument('-r', '--repeat', metavar='N', type=int, default=3,
+                        help='number of runs of each stage, the best time '
+                        'is reported (default: %(default)d)')
+    parser.add_argument('-s', '--stage', action='append', choices=STAGES,
+                        help='run only the named stage (may be repeated), '
+                        'the synth and mpk2sql stages are always run')
+    parser.add_argument('-w', '--workdir',
+                        help='directory for the data files (default: a '
+                        'temporary directory which is removed)')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='JSON output file (default: standard output)')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='dpbench')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    stages = [s for s in STAGES if args.stage is None or s in args.stage or
+              s in ('synth', 'mpk2sql')]
+    bench = Bench(workdir, args.duration)
+    results = []
+    try:
+        for name in stages:
+            r = run_stage(bench, name, args.repeat)
+            sys.stderr.write('{0:16s} {1:10d} items {2:9.3f} secs '
+                             '{3:12.0f} items/sec\n'.format(
+                                 name, r['items'], r['best'],
+                                 r['rate'] or 0))
+            results.append(r)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+    report = {'version': dpdata.__version__,
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'platform': platform.platform(),
+              'duration': args.duration,
+              'repeat': args.repeat,
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Subscribe to one or more Deep Profiler data streams, calculate the
+processed CTD and Optode variables as the samples arrive and publish
+them on a ZeroMQ PUB socket.
+"""
+import sys
+import time
+import argparse
+import zmq
+from dpdata.realtime import Processor
+from dpdata.zmq import CODECS, recv_message, send_message
+from dpdata.stats import NULL_STATS, start_stats
+from dpdata.util.dp2sql import subscribe
+
+
+def receive_batch(poller, max_size, timeout=None):
+    """
+    Wait for messages and return all of the messages which are
+    immediately available, up to *max_size*.
+
+    :param poller: :class:`zmq.Poller` for the input sockets
+    :param max_size: maximum batch size
+    :param timeout: poll timeout in milliseconds
+    :return: list of (message-type, contents) tuples
+    """
+    msgs = []
+    ready = dict(poller.poll(timeout))
+    while ready and len(msgs) < max_size:
+        for sock in ready:
+            if len(msgs) < max_size:
+                msgs.append(recv_message(sock))
+        ready = dict(poller.poll(0))
+    return msgs
+
+
+def run(socks, pub, proc, events=False, batch_size=100, codec='json',
+        stats=NULL_STATS):
+    """
+    Process the messages from a list of sockets and publish the
+    results. Messages are processed in micro-batches of all of the
+    messages which have arrived since the last batch (up to
+    *batch_size*), which bounds the latency when the input rate is
+    high.
+    """
+    poller = zmq.Poller()
+    for sock in socks:
+        poller.register(sock, zmq.POLLIN)
+    while True:
+        msgs = receive_batch(poller, batch_size)
+        t = time.time()
+        out = proc.process(msgs)
+        if events:
+            out.extend([m for m in msgs if m[0] == 'EVENT'])
+        for mtype, contents in out:
+            send_message(pub, mtype, contents, codec=codec)
+        if stats.enabled:
+            stats.observe('latency', time.time() - t)
+            stats.observe('batch_size', len(msgs))
+            for mtype, contents in out:
+                if mtype == 'DATA':
+                    stats.incr('published.' + contents['name'])
+            stats.gauge('dropped', proc.dropped)
+            stats.gauge('pending', len(proc.pending))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('publisher', help='ZeroMQ PUB endpoints',
+                        nargs='+')
+    parser.add_argument('-o', '--output', metavar='ENDPOINT',
+                        default='tcp://*:5590',
+                        help='ZeroMQ endpoint for the processed data '
+                        '(default: %(default)s)')
+    parser.add_argument('--lat', type=float, default=0.,
+                        help='deployment latitude in degrees')
+    parser.add_argument('--lon', type=float, default=0.,
+                        help='deployment longitude in degrees')
+    parser.add_argument('--ctd', metavar='NAME', default='ctd_1',
+                        help='CTD sensor name (default: %(default)s)')
+    parser.add_argument('--optode', metavar='NAME', default='optode_1',
+                        help='Optode sensor name (default: %(default)s)')
+    parser.add_argument('--fc', metavar='C', type=float, nargs=7,
+                        help='Optode foil coefficients fc0 ... fc6')
+    parser.add_argument('--db', metavar='URL',
+                        help='read the Optode foil coefficients from the '
+                        'calibration table of this database')
+    parser.add_argument('--events', action='store_true',
+                        help='republish profile start/end events')
+    parser.add_argument('--codec', choices=CODECS, default='json',
+                        help='output message encoding '
+                        '(default: %(default)s)')
+    parser.add_argument('-b', '--batch', metavar='N', type=int, default=100,
+                        help='maximum messages per processing batch '
+                        '(default: %(default)d)')
+    parser.add_argument('--buffer', metavar='N', type=int, default=1024,
+                        help='number of recent CTD samples kept for the '
+                        'Optode processing (default: %(default)d)')
+    parser.add_argument('--stats-interval', metavar='SECS', type=float,
+                        default=0,
+                        help='log processing statistics as JSON every SECS '
+                        'seconds')
+    parser.add_argument('--stats-file', metavar='FILE',
+                        help='write processing statistics to FILE')
+    args = parser.parse_args()
+
+    fc = args.fc
+    if fc is None and args.db:
+        from dpdata.sql import DPDatabase
+        from dpdata.util.dpprocess import foil_coefficients
+        from sqlalchemy.exc import NoSuchTableError
+        try:
+            fc = foil_coefficients(
+                DPDatabase(args.db).get_calibration(args.optode))
+        except (RuntimeError, NoSuchTableError) as e:
+            sys.stderr.write('Not processing {0}: {1}\n'.format(args.optode,
+                                                                 e))
+    elif fc is None:
+        sys.stderr.write('Not processing {0}: no foil '
+                         'coefficients\n'.format(args.optode))
+
+    proc = Processor(fc, lat=args.lat, lon=args.lon, ctd=args.ctd,
+                     optode=args.optode, capacity=args.buffer,
+                     max_pending=args.buffer)
+    ctx = zmq.Context()
+    socks = [subscribe(ctx, p) for p in args.publisher]
+    pub = ctx.socket(zmq.PUB)
+    pub.bind(args.output)
+    stats, reporter = start_stats(args.stats_interval, args.stats_file)
+    try:
+        run(socks, pub, proc, events=args.events, batch_size=args.batch,
+            codec=args.codec, stats=stats)
+    finally:
+        if reporter is not None:
+            reporter.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+Incrementally update the derived (processed) CTD and Optode data
+tables from the raw data tables.
+
+The raw data is processed in fixed time chunks. For each chunk the
+signature of the processing parameters and of the number of raw rows
+is stored in the *processed* table and only the chunks whose
+signature has changed are processed again, so new data, data loaded
+late into an earlier time range and calibration changes are all
+picked up.
+"""
+from __future__ import print_function
+import sys
+import hashlib
+import argparse
+from dpdata.sql import DPDatabase, make_processed_table
+from dpdata.parallel import run_ctd, run_optode
+from sqlalchemy import Table, MetaData, Column, Integer, Float
+from sqlalchemy.exc import NoSuchTableError
+
+
+#: Column names of the derived products
+PRODUCTS = {
+    'ctd': ('pracsal', 'tempwat', 'preswat', 'density'),
+    'optode': ('doxygen', 'preswat'),
+}
+
+
+def make_product_table(eng, meta, name, columns):
+    """
+    Create a derived product table if it does not exist.
+
+    :param eng: SQLAlchemy database engine
+    :param meta: SQLAlchemy Metadata object
+    :param name: table name
+    :param columns: data column names
+    :rtype: :class:`sqlalchemy.Table`
+    """
+    cols = [Column('timestamp', Integer, unique=True)]
+    cols.extend([Column(c, Float) for c in columns])
+    tbl = Table(name, meta, *cols)
+    meta.create_all(eng)
+    return tbl
+
+
+def foil_coefficients(cal):
+    """
+    Return the Optode foil coefficients from the calibration
+    constants, which must be stored as *fc0* ... *fc6*.
+
+    :param cal: calibration constants from
+                :func:`dpdata.sql.get_calibration`
+    """
+    try:
+        return [cal['fc{0:d}'.format(i)] for i in range(7)]
+    except KeyError as e:
+        raise RuntimeError('Missing Optode calibration constant: '
+                           '{0}'.format(e.args[0]))
+
+
+def signature(*params):
+    """
+    Return a signature string for a set of processing parameters.
+    """
+    return hashlib.sha1(repr(params).encode('utf-8')).hexdigest()
+
+
+def update(db, product, raw_tables, t_end, sig, run, chunk):
+    """
+    Process the chunks of raw data up to *t_end* which are new or
+    whose signature has changed since the last run. Each processed
+    chunk replaces the rows of the product in its time range.
+
+    :param db: database interface
+    :type db: :class:`dpdata.sql.DPDatabase`
+    :param product: derived product table name
+    :param raw_tables: raw data table names, the chunks are taken
+                       from the first table and the row counts of all
+                       of the tables are included in the chunk
+                       signatures.
+    :param t_end: end time (in microseconds since 1/1/1970 UTC)
+    :param sig: processing parameter signature from :func:`signature`
+    :param run: function which processes a list of time chunks and
+                returns the number of rows written
+    :param chunk: chunk length in microseconds
+    :return: number of rows written
+    """
+    counts = [db.get_chunk_counts(name, chunk, t_end) for name in raw_tables]
+    done = db.get_processed(product)
+    chunks, sigs = [], {}
+    for t in sorted(counts[0]):
+        # The last chunk is cut off at t_end and processed again
+        # once it has been filled.
+        end = min(t + chunk, t_end + 1)
+        csig = signature(sig, end, [c.get(t, 0) for c in counts])
+        if done.get(t) != csig:
+            chunks.append((t, end))
+            sigs[t] = csig
+    if not chunks:
+        return 0
+    nrows = run(chunks)
+    db.set_processed(product, sigs)
+    return nrows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('db', help='SQLAlchemy database connection string')
+    parser.add_argument('--lat', type=float, default=0.,
+                        help='deployment latitude in degrees')
+    parser.add_argument('--lon', type=float, default=0.,
+                        help='deployment longitude in degrees')
+    parser.add_argument('--ctd', metavar='TABLE', default='ctd_1',
+                        help='raw CTD table (default: %(default)s)')
+    parser.add_argument('--optode', metavar='TABLE', default='optode_1',
+                        help='raw Optode table (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help='number of worker processes')
+    parser.add_argument('--chunk', metavar='SECS', type=int, default=86400,
+                        help='processing chunk length (default: %(default)d)')
+    args = parser.parse_args()
+
+    db = DPDatabase(args.db)
+    meta = MetaData()
+    make_processed_table(db.eng, meta)
+    ctd_product = args.ctd + '_processed'
+    optode_product = args.optode + '_processed'
+    make_product_table(db.eng, meta, ctd_product, PRODUCTS['ctd'])
+    make_product_table(db.eng, meta, optode_product, PRODUCTS['optode'])
+    chunk = args.chunk * 1000000
+
+    _, ctd_end = db.get_time_range(args.ctd)
+    n = update(db, ctd_product, [args.ctd], ctd_end,
+               signature(args.lat, args.lon),
+               lambda chunks: run_ctd(args.db, chunks, ctd_product,
+                                      ctd_table=args.ctd, lat=args.lat,
+                                      lon=args.lon, jobs=args.jobs),
+               chunk)
+    print('{0}: {1:d} rows'.format(ctd_product, n))
+
+    try:
+        fc = foil_coefficients(db.get_calibration(args.optode))
+    except (RuntimeError, NoSuchTableError) as e:
+        sys.stderr.write('Skipping {0}: {1}\n'.format(optode_product, e))
+        return
+    # Optode samples after the last CTD sample cannot be processed
+    # until more CTD data arrives.
+    _, optode_end = db.get_time_range(args.optode)
+    n = update(db, optode_product, [args.optode, args.ctd],
+               min(optode_end, ctd_end),
+               signature(args.lat, args.lon, fc),
+               lambda chunks: run_optode(args.db, chunks, fc, optode_product,
+                                         ctd_table=args.ctd,
+                                         optode_table=args.optode,
+                                         lat=args.lat, lon=args.lon,
+                                         jobs=args.jobs),
+               chunk)
+    print('{0}: {1:d} rows'.format(optode_product, n))
+
+
+if __name__ == '__main__':
+    main()
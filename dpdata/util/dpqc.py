@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Run the data dictionary quality control tests on the sensor tables
+of a Deep Profiler database and store the results in the QC flag
+columns created by ``mktables --qc``.
+"""
+from __future__ import print_function
+import sys
+import time
+import argparse
+from dpdata.qc import Checker, flag_column, update_flags
+from dpdata.schema import get_schema
+from sqlalchemy import create_engine, MetaData
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('db', help='SQLAlchemy database connection string')
+    parser.add_argument('sensors', help='sensor tables (default: all tables '
+                        'with QC flag columns)', nargs='*')
+    parser.add_argument('-c', '--chunk', metavar='N', type=int,
+                        default=100000,
+                        help='number of rows processed at a time '
+                        '(default: %(default)d)')
+    args = parser.parse_args()
+
+    eng = create_engine(args.db)
+    meta = MetaData()
+    meta.reflect(bind=eng)
+    schema = get_schema()
+    sensors = args.sensors
+    for name in sensors:
+        if name not in schema:
+            parser.error('unknown sensor: {0}'.format(name))
+        if name not in meta.tables:
+            parser.error('no table for sensor: {0}'.format(name))
+    if not sensors:
+        sensors = []
+        for name in schema:
+            tbl = meta.tables.get(name)
+            if tbl is None:
+                continue
+            cols = Checker(name).columns
+            if cols and all(flag_column(c) in tbl.c for c in cols):
+                sensors.append(name)
+
+    for name in sensors:
+        t = time.time()
+        try:
+            n = update_flags(eng, name, chunksize=args.chunk)
+        except RuntimeError as e:
+            sys.stderr.write('{0}\n'.format(e))
+            continue
+        print('{0}: {1:d} rows, {2:.1f} secs'.format(name, n,
+                                                   time.time() - t))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,19 +4,21 @@ Populate an SQL database with tables for Deep Profiler data.
 """
 from __future__ import print_function
 import argparse
-from dpdata import data_dictionary
-from dpdata.sql import make_table
+from dpdata.schema import get_schema
+from dpdata.sql import make_table, make_profiles_table
 from sqlalchemy import Table, MetaData, Column, \
     Float, Text, create_engine
 
 
-def make_tables(eng, data_dict):
+def make_tables(eng, data_dict, qc=False):
     """
     Create all of the SQL tables for the DP database.
 
     :param eng: SQLAlchemy database engine
-    :param data_dict: data dictionary
+    :param data_dict: data dictionary or :class:`dpdata.schema.Schema`
+    :param qc: if true, add the QC flag columns to the sensor tables
     """
+    schema = get_schema(data_dict)
     meta = MetaData()
     mdtable = Table('metadata', meta,
                     Column('sensor', Text),
@@ -26,18 +28,21 @@ def make_tables(eng, data_dict):
                     Column('scale', Float))
     meta.bind = eng
     meta.create_all()
-    for name in data_dict:
-        make_table(eng, name, meta, data_dict)
+    make_profiles_table(eng, meta)
+    for name in schema:
+        make_table(eng, name, meta, schema, qc=qc)
     return meta
 
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('db', help='SQLAlchemy database connection string')
+    parser.add_argument('--qc', action='store_true',
+                        help='add quality control flag columns')
     args = parser.parse_args()
 
     eng = create_engine(args.db)
-    meta = make_tables(eng, data_dictionary())
+    meta = make_tables(eng, get_schema(), qc=args.qc)
     print('Created tables:')
     for t in meta.sorted_tables:
         print('\t{0}'.format(t.name))
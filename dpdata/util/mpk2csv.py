@@ -5,14 +5,124 @@ in CSV format.
 """
 import sys
 import argparse
-from dpdata import expand_lists, data_dictionary
-from dpdata.mpk import get_records
+import multiprocessing
+import numpy as np
+from dpdata.mpk import get_records, iter_columns
+from dpdata.schema import get_schema
 from decimal import Decimal
-from functools import partial
 
 
-def quantize(scale, prec, val):
-    return str(Decimal(val*scale).quantize(prec))
+def format_records(infile, sch):
+    """
+    Iterate over the records in *infile* and return each one
+    as a line of CSV.
+
+    :param infile: input data file
+    :param sch: sensor schema
+    :type sch: :class:`dpdata.schema.SensorSchema`
+    """
+    varnames = sorted(sch.columns)
+    fcvt = [sch.converters[v] for v in varnames]
+    expand = sch.expand
+    for secs, usecs, data in get_records(infile):
+        values = expand(data)
+        rec = [str(secs), str(usecs)] + \
+            [f(values[v]) for f, v in zip(fcvt, varnames)]
+        yield ','.join(rec) + '\n'
+
+
+class FastFormatter(object):
+    """
+    Format chunks of column arrays (see :func:`dpdata.mpk.iter_columns`)
+    as CSV. Numeric variables are scaled with a single array operation
+    and formatted with a fixed number of decimal places derived from
+    the precision string. This produces the same output as
+    :func:`dpdata.schema.quantize` because both round the exact binary
+    value of the scaled number half-to-even.
+
+    :param sch: sensor schema
+    :type sch: :class:`dpdata.schema.SensorSchema`
+    """
+    def __init__(self, sch):
+        self.columns = []
+        for name in sorted(sch.columns):
+            fmt = None
+            if name not in sch.tostr:
+                exp = Decimal(sch.precision[name]).as_tuple().exponent
+                if exp <= 0:
+                    fmt = '%.{0:d}f'.format(-exp)
+            self.columns.append((name, fmt, sch.scale[name],
+                                 sch.converters[name]))
+
+    def format(self, chunk):
+        """
+        Return a chunk of data records as a string of CSV lines.
+        """
+        secs, usecs = np.divmod(chunk['timestamp'], 1000000)
+        fmts = ['%d', '%d']
+        cols = [secs.tolist(), usecs.tolist()]
+        for name, fmt, scale, func in self.columns:
+            x = chunk[name]
+            if fmt is None:
+                fmts.append('%s')
+                cols.append([_convert(func, v) for v in x.tolist()])
+                continue
+            y = x * scale
+            bad = ~np.isfinite(y)
+            if bad.any():
+                # Non-finite values are passed to the original function
+                vals = [fmt % v for v in y.tolist()]
+                for i in np.flatnonzero(bad):
+                    vals[i] = func(x[i])
+                fmts.append('%s')
+                cols.append(vals)
+            else:
+                fmts.append(fmt)
+                cols.append(y.tolist())
+        template = ','.join(fmts) + '\n'
+        return ''.join([template % row for row in zip(*cols)])
+
+
+def _convert(func, v):
+    # Integer values are decoded as floats by the column reader
+    if isinstance(v, float) and v.is_integer():
+        v = int(v)
+    return func(v)
+
+
+def format_chunks(infile, sch, chunksize=10000):
+    """
+    Iterate over the records in *infile* and return chunks of
+    CSV lines using a :class:`FastFormatter`.
+
+    :param infile: input data file
+    :param sch: sensor schema
+    :type sch: :class:`dpdata.schema.SensorSchema`
+    :param chunksize: number of records per chunk
+    """
+    formatter = FastFormatter(sch)
+    for chunk in iter_columns(infile, sch, chunksize=chunksize):
+        yield formatter.format(chunk)
+
+
+_format = None
+
+
+def _init_worker(name, fast):
+    global _format
+    sch = get_schema()[name]
+    if fast:
+        _format = lambda f: format_chunks(f, sch)
+    else:
+        _format = lambda f: format_records(f, sch)
+
+
+def convert_file(filename):
+    """
+    Pool worker which returns the contents of a file as CSV.
+    """
+    with open(filename, 'rb') as f:
+        return ''.join(_format(f))
 
 
 def main():
@@ -25,37 +135,39 @@ def main():
                         dest='output',
                         type=argparse.FileType('wb'),
                         default=sys.stdout)
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help='convert the input files using N processes, '
+                        'the output is written in input file order')
+    parser.add_argument('--fast', action='store_true',
+                        help='decode and format the records in chunks of '
+                        'column arrays')
     args = parser.parse_args()
 
     try:
-        cfg = (data_dictionary())[args.name]
+        sch = get_schema()[args.name]
     except KeyError:
         raise RuntimeError('Invalid sensor name: {0}'.format(args.name))
 
-    varnames = []
-    fcvt = {}
-    for vdesc in cfg['data']:
-        n = vdesc.get('nvals', 1)
-        func = vdesc.get('tostr',
-                         partial(quantize,
-                                 vdesc.get('scale', 1.),
-                                 Decimal(vdesc.get('precision', '1'))))
-        if n > 1:
-            for i in range(n):
-                name = '{0}_{1:d}'.format(vdesc['name'], i)
-                varnames.append(name)
-                fcvt[name] = func
-        else:
-            varnames.append(vdesc['name'])
-            fcvt[vdesc['name']] = func
-
-    varnames.sort()
+    varnames = sorted(sch.columns)
     args.output.write(','.join(['t_secs', 't_usecs'] + varnames) + '\n')
-    for f in args.infiles:
-        for secs, usecs, data in get_records(f):
-            values = expand_lists(data)
-            rec = [str(secs), str(usecs)] + [fcvt[v](values[v]) for v in varnames]
-            args.output.write(','.join(rec) + '\n')
+    if args.jobs > 1:
+        filenames = [f.name for f in args.infiles]
+        for f in args.infiles:
+            f.close()
+        pool = multiprocessing.Pool(args.jobs, _init_worker,
+                                    (args.name, args.fast))
+        for text in pool.imap(convert_file, filenames):
+            args.output.write(text)
+        pool.close()
+        pool.join()
+    elif args.fast:
+        for f in args.infiles:
+            for text in format_chunks(f, sch):
+                args.output.write(text)
+    else:
+        for f in args.infiles:
+            for line in format_records(f, sch):
+                args.output.write(line)
 
 
 if __name__ == '__main__':
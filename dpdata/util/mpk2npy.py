@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""
+Convert Deep Profiler MessagePack data files to a memory-mapped
+columnar archive (see dpdata.colstore). Files which were converted
+by an earlier run are only read from where the last run stopped, so
+the archive can be updated as new data arrives.
+"""
+import sys
+import time
+import argparse
+from dpdata.colstore import ColumnStore
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('name', help='sensor name')
+    parser.add_argument('outdir', help='archive directory')
+    parser.add_argument('infiles', help='input files',
+                        nargs='+')
+    parser.add_argument('-c', '--chunk', metavar='N', type=int,
+                        default=100000,
+                        help='records decoded at a time '
+                        '(default: %(default)d)')
+    args = parser.parse_args()
+
+    try:
+        store = ColumnStore(args.outdir, args.name)
+    except KeyError:
+        raise RuntimeError('Bad sensor name: {0}'.format(args.name))
+    if store.header['sensor'] != args.name:
+        raise RuntimeError('{0} is an archive of {1}'.format(
+            args.outdir, store.header['sensor']))
+    for filename in args.infiles:
+        t = time.time()
+        try:
+            nrows = store.add_file(filename, chunksize=args.chunk)
+        except IOError as e:
+            sys.stderr.write('{0}\n'.format(e))
+            continue
+        sys.stderr.write('{0}: {1:d} rows, {2:.1f} secs\n'.format(
+            filename, nrows, time.time() - t))
+
+
+if __name__ == '__main__':
+    main()
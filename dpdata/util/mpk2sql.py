@@ -4,9 +4,15 @@ Import the contents of a Deep Profiler MessagePack archive
 file into an SQL database.
 """
 import sys
+import time
 import argparse
+import multiprocessing
 from dpdata import expand_lists
+from dpdata.schema import get_schema
 from dpdata.mpk import get_records
+from dpdata.sql import insert_batch
+from dpdata.pyramid import update_pyramid
+from dpdata.stats import NULL_STATS, start_stats
 from sqlalchemy import create_engine, MetaData
 from sqlalchemy.exc import IntegrityError
 
@@ -15,6 +21,195 @@ def add_record(conn, ins, data):
     conn.execute(ins, **data)
 
 
+def extend_span(span, batch):
+    """
+    Extend a [start, end] time span, which starts as ``[None, None]``,
+    to include the timestamps of a batch of rows.
+    """
+    if span is None or not batch:
+        return
+    ts = [row['timestamp'] for row in batch]
+    t0, t1 = min(ts), max(ts)
+    span[0] = t0 if span[0] is None else min(span[0], t0)
+    span[1] = t1 if span[1] is None else max(span[1], t1)
+
+
+def insert_rows(conn, ins, batch, stats=NULL_STATS, name=''):
+    """
+    Insert a batch of rows with :func:`dpdata.sql.insert_batch` and
+    record the insert latency, batch size and number of rows inserted
+    and skipped.
+
+    :returns: number of rows skipped
+    """
+    if not stats.enabled:
+        return insert_batch(conn, ins, batch)
+    t = time.time()
+    nskipped = insert_batch(conn, ins, batch)
+    stats.observe('insert_latency.' + name, time.time() - t)
+    stats.observe('batch_size.' + name, len(batch))
+    stats.incr('inserted.' + name, len(batch) - nskipped)
+    stats.incr('skipped.' + name, nskipped)
+    return nskipped
+
+
+def load_records(conn, ins, infile, expand=expand_lists, stats=NULL_STATS,
+                 name='', span=None):
+    """
+    Insert the records from *infile* one row at a time. If *span* is
+    given it is extended to the time range of the records, see
+    :func:`extend_span`.
+
+    :returns: tuple of rows read, rows skipped
+    """
+    nrows, nskipped = 0, 0
+    for secs, usecs, data in get_records(infile):
+        data['timestamp'] = int(secs * 1000000) + usecs
+        extend_span(span, [data])
+        nrows += 1
+        if stats.enabled:
+            stats.incr('records.' + name)
+            t = time.time()
+        try:
+            add_record(conn, ins, expand(data))
+        except IntegrityError as e:
+            nskipped += 1
+            stats.incr('skipped.' + name)
+            sys.stderr.write(repr(e) + '\n')
+            sys.stderr.write('Skipping row @[{0:d}, {1:d}]\n'.format(secs, usecs))
+        else:
+            if stats.enabled:
+                stats.observe('insert_latency.' + name, time.time() - t)
+                stats.incr('inserted.' + name)
+    return nrows, nskipped
+
+
+def load_batches(conn, ins, infile, batch_size, expand=expand_lists,
+                 stats=NULL_STATS, name='', span=None):
+    """
+    Insert the records from *infile* in batches of *batch_size*
+    rows, each batch is written in a single transaction. If *span* is
+    given it is extended to the time range of the records, see
+    :func:`extend_span`.
+
+    :returns: tuple of rows read, rows skipped
+    """
+    nrows, nskipped = 0, 0
+    batch = []
+    t = time.time()
+    for secs, usecs, data in get_records(infile):
+        data['timestamp'] = int(secs * 1000000) + usecs
+        batch.append(expand(data))
+        if len(batch) >= batch_size:
+            if stats.enabled:
+                stats.observe('decode_time.' + name, time.time() - t)
+                stats.incr('records.' + name, len(batch))
+            extend_span(span, batch)
+            nskipped += insert_rows(conn, ins, batch, stats, name)
+            nrows += len(batch)
+            batch = []
+            t = time.time()
+    if batch and stats.enabled:
+        stats.observe('decode_time.' + name, time.time() - t)
+        stats.incr('records.' + name, len(batch))
+    extend_span(span, batch)
+    nskipped += insert_rows(conn, ins, batch, stats, name)
+    nrows += len(batch)
+    return nrows, nskipped
+
+
+def _expander(name):
+    schema = get_schema()
+    if name in schema:
+        return schema[name].expand
+    return expand_lists
+
+
+_queue = None
+
+
+def _init_worker(queue):
+    global _queue
+    _queue = queue
+
+
+def decode_file(args):
+    """
+    Pool worker which decodes a file and passes batches of rows,
+    along with the time taken to decode each batch, to the writer
+    through the shared queue. A ``None`` batch marks the end of the
+    file.
+    """
+    i, filename, batch_size, name = args
+    expand = _expander(name)
+    try:
+        batch = []
+        t = time.time()
+        with open(filename, 'rb') as f:
+            for secs, usecs, data in get_records(f):
+                data['timestamp'] = int(secs * 1000000) + usecs
+                batch.append(expand(data))
+                if len(batch) >= batch_size:
+                    _queue.put((i, batch, time.time() - t))
+                    batch = []
+                    t = time.time()
+        if batch:
+            _queue.put((i, batch, time.time() - t))
+    finally:
+        _queue.put((i, None, 0))
+
+
+def load_parallel(conn, ins, filenames, batch_size, jobs, name,
+                  stats=NULL_STATS, span=None):
+    """
+    Decode the input files in a pool of *jobs* worker processes
+    while the calling process inserts the batches of rows into the
+    database. If *span* is given it is extended to the time range of
+    the records from all of the files, see :func:`extend_span`.
+
+    :return: iterator of filename, rows read, rows skipped and
+             elapsed time as each file is completed.
+    """
+    queue = multiprocessing.Queue(maxsize=4 * jobs)
+    pool = multiprocessing.Pool(jobs, _init_worker, (queue,))
+    result = pool.map_async(decode_file,
+                            [(i, fn, batch_size, name)
+                             for i, fn in enumerate(filenames)],
+                            chunksize=1)
+    pool.close()
+    counts = [[0, 0] for fn in filenames]
+    started = {}
+    pending = len(filenames)
+    stats.gauge('queue_depth', queue.qsize)
+    try:
+        while pending:
+            i, batch, elapsed = queue.get()
+            t = started.setdefault(i, time.time())
+            if batch is None:
+                pending -= 1
+                yield (filenames[i], counts[i][0], counts[i][1],
+                       time.time() - t)
+            else:
+                if stats.enabled:
+                    stats.observe('decode_time.' + name, elapsed)
+                    stats.incr('records.' + name, len(batch))
+                counts[i][0] += len(batch)
+                extend_span(span, batch)
+                counts[i][1] += insert_rows(conn, ins, batch, stats, name)
+        pool.join()
+    finally:
+        # Stop the workers if an insert failed
+        pool.terminate()
+    # Raise any exception from the workers
+    result.get()
+
+
+def report(name, nrows, nskipped, elapsed):
+    rate = nrows / elapsed if elapsed > 0 else 0.
+    sys.stderr.write('{0}: {1:d} rows, {2:d} skipped, '
+                     '{3:.0f} rows/sec\n'.format(name, nrows, nskipped, rate))
+
+
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('name', help='sensor name')
@@ -22,6 +217,20 @@ def main():
     parser.add_argument('infiles', help='input files',
                         type=argparse.FileType('rb'),
                         nargs='+')
+    parser.add_argument('-b', '--batch', metavar='N', type=int, default=0,
+                        help='insert records in transactions of N rows '
+                        '(default: one row at a time)')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help='decode the input files using N processes')
+    parser.add_argument('-p', '--pyramid', action='store_true',
+                        help='update the multi-resolution summary tables '
+                        'after loading')
+    parser.add_argument('--stats-interval', metavar='SECS', type=float,
+                        default=0,
+                        help='log ingest statistics as JSON every SECS '
+                        'seconds')
+    parser.add_argument('--stats-file', metavar='FILE',
+                        help='write ingest statistics to FILE')
     args = parser.parse_args()
 
     eng = create_engine(args.db)
@@ -33,14 +242,55 @@ def main():
     tbl = meta.tables[args.name]
     conn = eng.connect()
     ins = tbl.insert()
-    for f in args.infiles:
-        for secs, usecs, data in get_records(f):
-            data['timestamp'] = int(secs * 1000000) + usecs
-            try:
-                add_record(conn, ins, expand_lists(data))
-            except IntegrityError as e:
-                sys.stderr.write(repr(e) + '\n')
-                sys.stderr.write('Skipping row @[{0:d}, {1:d}]\n'.format(secs, usecs))
+    expand = _expander(args.name)
+    stats, reporter = start_stats(args.stats_interval, args.stats_file)
+    total, total_skipped = 0, 0
+    # Time range of the records from each file (or from all of the
+    # files when they are decoded in parallel)
+    spans = []
+    t0 = time.time()
+    if args.jobs > 1:
+        filenames = [f.name for f in args.infiles]
+        for f in args.infiles:
+            f.close()
+        batch_size = args.batch if args.batch > 0 else 1000
+        spans.append([None, None])
+        for name, nrows, nskipped, elapsed in load_parallel(conn, ins,
+                                                            filenames,
+                                                            batch_size,
+                                                            args.jobs,
+                                                            args.name,
+                                                            stats,
+                                                            spans[-1]):
+            report(name, nrows, nskipped, elapsed)
+            total += nrows
+            total_skipped += nskipped
+        report('total', total, total_skipped, time.time() - t0)
+    else:
+        for f in args.infiles:
+            t = time.time()
+            spans.append([None, None])
+            if args.batch > 0:
+                nrows, nskipped = load_batches(conn, ins, f, args.batch,
+                                               expand, stats, args.name,
+                                               spans[-1])
+            else:
+                nrows, nskipped = load_records(conn, ins, f, expand,
+                                               stats, args.name, spans[-1])
+            report(f.name, nrows, nskipped, time.time() - t)
+            total += nrows
+            total_skipped += nskipped
+        if len(args.infiles) > 1:
+            report('total', total, total_skipped, time.time() - t0)
+    if reporter is not None:
+        reporter.stop()
+
+    if args.pyramid:
+        conn.close()
+        ranges = [tuple(span) for span in spans if span[0] is not None]
+        result = update_pyramid(eng, args.name, ranges=ranges)
+        for name, nrows in sorted(result.items()):
+            sys.stderr.write('{0}: {1:d} summary rows\n'.format(name, nrows))
 
 
 if __name__ == '__main__':
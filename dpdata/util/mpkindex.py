@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+"""
+Create or update the sidecar time indices for one or more Deep
+Profiler MessagePack archive files.
+"""
+from __future__ import print_function
+import argparse
+from dpdata.mpk import build_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('infiles', help='input files',
+                        nargs='+')
+    parser.add_argument('-s', '--stride', metavar='N', type=int,
+                        default=1000,
+                        help='number of records between index entries '
+                        '(default: %(default)d)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show index summary')
+    args = parser.parse_args()
+
+    for filename in args.infiles:
+        index = build_index(filename, stride=args.stride)
+        if args.verbose:
+            print('{0}: {1:d} records, {2:d} entries'.format(filename,
+                                                             index.nrecs,
+                                                             len(index)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+Load new data from directories of Deep Profiler MessagePack archive
+files into an SQL database. Each file is routed to a sensor table by
+the name of its parent directory or, failing that, by the sensor name
+at the start of the file name. The files which have been loaded are
+recorded in the *manifest* table so unchanged files are skipped and
+growing files are only read from where the last run stopped.
+"""
+import os
+import sys
+import time
+import hashlib
+import argparse
+import msgpack
+from dpdata.schema import get_schema
+from dpdata.sql import make_manifest_table
+from dpdata.util.mpk2sql import insert_rows, report, _expander
+from sqlalchemy import create_engine, MetaData, select
+
+#: Number of bytes at the start of a file which are hashed to detect
+#: a file which has been replaced
+HASH_BYTES = 4096
+
+
+def find_files(dirs, suffix='.mpk'):
+    """
+    Return the sorted list of data files under a set of directories.
+    """
+    found = []
+    for top in dirs:
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames.sort()
+            found.extend([os.path.join(dirpath, name)
+                          for name in sorted(filenames)
+                          if name.endswith(suffix)])
+    return found
+
+
+def route(path, sensors):
+    """
+    Return the sensor name for a data file, or ``None``.
+
+    :param path: file name
+    :param sensors: set of sensor names
+    """
+    parent = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    if parent in sensors:
+        return parent
+    name = os.path.basename(path)
+    matches = [s for s in sensors
+               if name.startswith(s) and
+               (len(name) == len(s) or not name[len(s)].isalnum())]
+    if matches:
+        return max(matches, key=len)
+    return None
+
+
+def prefix_hash(f, nbytes):
+    """
+    Return the SHA-1 hash of the first *nbytes* of a file.
+    """
+    f.seek(0)
+    return hashlib.sha1(f.read(nbytes)).hexdigest()
+
+
+def load_from(conn, ins, infile, offset, batch_size, expand):
+    """
+    Insert the records from *infile* starting at byte *offset* in
+    batches of *batch_size* rows. A partial record at the end of the
+    file is left for the next run.
+
+    :returns: tuple of rows read, rows skipped, offset after the last
+              complete record.
+    """
+    infile.seek(offset)
+    unpacker = msgpack.Unpacker(infile)
+    nrows, nskipped = 0, 0
+    end = offset
+    batch = []
+    for secs, usecs, data in unpacker:
+        data['timestamp'] = int(secs * 1000000) + usecs
+        batch.append(expand(data))
+        if len(batch) >= batch_size:
+            nskipped += insert_rows(conn, ins, batch)
+            nrows += len(batch)
+            batch = []
+        end = offset + unpacker.tell()
+    nskipped += insert_rows(conn, ins, batch)
+    nrows += len(batch)
+    return nrows, nskipped, end
+
+
+def sync_file(conn, manifest, ins, path, sensor, entry, batch_size,
+              dry_run=False):
+    """
+    Load the new records from a file and update its manifest entry.
+
+    :param entry: current manifest row for the file or ``None``
+    :return: tuple of rows read, rows skipped or ``None`` if the file
+             is unchanged.
+    """
+    st = os.stat(path)
+    if entry is not None and entry['size'] == st.st_size and \
+       entry['mtime'] == st.st_mtime and entry['sensor'] == sensor:
+        return None
+    with open(path, 'rb') as f:
+        offset = 0
+        if entry is not None and entry['sensor'] == sensor and \
+           st.st_size >= entry['offset']:
+            # Resume a growing file unless the data already loaded
+            # has been changed.
+            n = min(HASH_BYTES, entry['offset'])
+            if prefix_hash(f, n) == entry['prefix_hash']:
+                offset = entry['offset']
+        if dry_run:
+            return st.st_size - offset, 0
+        nrows, nskipped, end = load_from(conn, ins, f, offset, batch_size,
+                                         _expander(sensor))
+        digest = prefix_hash(f, min(HASH_BYTES, end))
+    total = nrows + (entry['nrows'] if offset and entry['nrows'] else 0)
+    with conn.begin():
+        conn.execute(manifest.delete().where(manifest.c.path == path))
+        conn.execute(manifest.insert(), path=path, sensor=sensor,
+                     size=st.st_size, mtime=st.st_mtime,
+                     prefix_hash=digest, offset=end, nrows=total)
+    return nrows, nskipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('db', help='SQLAlchemy database connection string')
+    parser.add_argument('dirs', help='data directories',
+                        nargs='+')
+    parser.add_argument('-b', '--batch', metavar='N', type=int, default=1000,
+                        help='insert records in transactions of N rows '
+                        '(default: %(default)d)')
+    parser.add_argument('-s', '--suffix', default='.mpk',
+                        help='data file name suffix (default: %(default)s)')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='list the files to load and the number of '
+                        'bytes to read, but do not load them')
+    args = parser.parse_args()
+
+    eng = create_engine(args.db)
+    meta = MetaData()
+    meta.reflect(bind=eng)
+    manifest = meta.tables.get('manifest')
+    if manifest is None:
+        manifest = make_manifest_table(eng, meta)
+    sensors = set([name for name in get_schema() if name in meta.tables])
+
+    conn = eng.connect()
+    entries = dict([(row['path'], row)
+                    for row in conn.execute(select([manifest]))])
+    t0 = time.time()
+    total, total_skipped, nfiles = 0, 0, 0
+    for path in find_files(args.dirs, args.suffix):
+        path = os.path.abspath(path)
+        sensor = route(path, sensors)
+        if sensor is None:
+            sys.stderr.write('{0}: no sensor table\n'.format(path))
+            continue
+        t = time.time()
+        result = sync_file(conn, manifest, meta.tables[sensor].insert(),
+                           path, sensor, entries.get(path), args.batch,
+                           dry_run=args.dry_run)
+        if result is None:
+            continue
+        nfiles += 1
+        if args.dry_run:
+            sys.stderr.write('{0}: {1} {2:d} bytes\n'.format(path, sensor,
+                                                             result[0]))
+            continue
+        report(path, result[0], result[1], time.time() - t)
+        total += result[0]
+        total_skipped += result[1]
+    if not args.dry_run:
+        report('total ({0:d} files)'.format(nfiles), total, total_skipped,
+               time.time() - t0)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,13 +3,59 @@
 .. module:: zmq
    :synopsis: ZeroMQ message functions
 """
+import msgpack
 try:
     import simplejson as json
 except ImportError:
     import json
 
 
-def send_message(sock, command, params):
+#: Supported message body encodings
+CODECS = ('json', 'msgpack')
+
+# Leading bytes of a JSON message body. MessagePack message bodies
+# are maps, which never start with one of these bytes.
+_JSON_START = b'{[ \t\r\n'
+
+
+def encode(params, codec='json'):
+    """
+    Encode a message body.
+
+    :param params: message contents
+    :type params: dict
+    :param codec: *json* or *msgpack*, the MessagePack encoding is the
+                  same as used for the records in :mod:`dpdata.mpk`
+                  data files.
+    :rtype: bytes
+    """
+    if codec == 'msgpack':
+        return msgpack.packb(params)
+    if codec == 'json':
+        body = json.dumps(params)
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        return body
+    raise ValueError('Unknown codec: {0}'.format(codec))
+
+
+def decode(buf):
+    """
+    Decode a message body, the encoding (JSON or MessagePack) is
+    detected from the first byte.
+
+    :param buf: message body
+    :type buf: bytes or any object supporting the buffer protocol
+    :rtype: dict
+    """
+    buf = memoryview(buf)
+    if len(buf) and buf[:1].tobytes() in _JSON_START:
+        return json.loads(buf.tobytes().decode('utf-8'))
+    # The MessagePack decoder reads directly from the buffer
+    return msgpack.unpackb(buf)
+
+
+def send_message(sock, command, params, codec='json'):
     """
     Send a message to the DP server.
 
@@ -17,18 +63,26 @@ def send_message(sock, command, params):
     :param command: command string
     :param params: command parameters
     :type params: dict
+    :param codec: message body encoding, see :func:`encode`
     """
-    sock.send_multipart([bytes(command.upper()),
-                         json.dumps(params)])
+    command = command.upper()
+    if not isinstance(command, bytes):
+        command = command.encode('ascii')
+    sock.send_multipart([command, encode(params, codec)])
 
 
 def recv_message(sock):
     """
-    Receive a message from the DP server.
+    Receive a message from the DP server. The message body may be
+    encoded as JSON or MessagePack, it is decoded directly from the
+    ZeroMQ frame without copying.
 
     :param sock: ZeroMQ socket.
     :return: tuple of message-type, contents
     :rtype: tuple(string, dict)
     """
-    mtype, contents = sock.recv_multipart()
-    return mtype, json.dumps(contents)
+    mtype, contents = sock.recv_multipart(copy=False)
+    mtype = mtype.bytes
+    if not isinstance(mtype, str):
+        mtype = mtype.decode('ascii')
+    return mtype, decode(contents.buffer)
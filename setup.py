@@ -33,6 +33,7 @@ setup(name="Dpdata",
       url="http://wavelet.apl.uw.edu/~mike/python/",
       packages=["dpdata", "dpdata.util"],
       install_requires=["msgpack-python",
+                        "numpy",
                         "gsw",
                         "sqlalchemy",
                         "pandas",
@@ -44,7 +45,14 @@ setup(name="Dpdata",
               "mktables = dpdata.util.mktables:main",
               "mpk2sql = dpdata.util.mpk2sql:main",
               "mpk2csv = dpdata.util.mpk2csv:main",
-              "dp2sql = dpdata.util.dp2sql:main"
+              "mpkindex = dpdata.util.mpkindex:main",
+              "mpksync = dpdata.util.mpksync:main",
+              "dp2sql = dpdata.util.dp2sql:main",
+              "dpderive = dpdata.util.dpderive:main",
+              "dpprocess = dpdata.util.dpprocess:main",
+              "dpqc = dpdata.util.dpqc:main",
+              "mpk2npy = dpdata.util.mpk2npy:main",
+              "dpbench = dpdata.util.dpbench:main"
           ]
       },
       scripts=[])
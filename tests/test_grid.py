@@ -0,0 +1,69 @@
+import os
+import numpy as np
+import pandas as pd
+from dpdata.grid import ProfileGrid, interp_pressure, pressure_bins
+from dpdata.sql import DPDatabase
+from sqlalchemy import create_engine
+
+T0 = 1400000000
+
+
+def _setup(tmpdir, ctd_profiles=(1, 3)):
+    # Three 100 second profiles, the CTD only has samples from
+    # *ctd_profiles*.
+    eng = create_engine('sqlite:///' + os.path.join(str(tmpdir), 'test.db'))
+    pd.DataFrame({'pnum': [1, 2, 3],
+                  'start': [T0, T0 + 200, T0 + 400],
+                  'end': [T0 + 100, T0 + 300, T0 + 500],
+                  'mode': ['up', 'down', 'up']}).to_sql('profiles', eng,
+                                                        index=False)
+    secs = np.r_[np.arange(0, 100), np.arange(200, 300),
+                 np.arange(400, 500)]
+    t = (T0 + secs) * 1000000
+    p = 10. + secs % 200
+    keep = np.in1d(secs // 200 + 1, ctd_profiles)
+    pd.DataFrame({'timestamp': t[keep], 'preswat': p[keep]}).to_sql(
+        'ctd_1', eng, index=False)
+    pd.DataFrame({'timestamp': t + 500000,
+                  'doconcs': np.ones(len(t))}).to_sql('optode_1', eng,
+                                                      index=False)
+    return DPDatabase(eng)
+
+
+def test_interp_pressure_without_ctd():
+    ctd = pd.DataFrame({'timestamp': np.zeros(0, dtype='i8'),
+                        'preswat': np.zeros(0)})
+    assert np.isnan(interp_pressure([1, 2, 3], ctd)).all()
+
+
+def test_update_profile_without_ctd(tmpdir):
+    db = _setup(tmpdir)
+    grid = ProfileGrid(pressure_bins(0, 200, 10))
+    assert grid.update(db, 'optode_1', ['doconcs']) == 3
+    assert list(grid.pnums) == [1, 2, 3]
+    for col in (0, 2):
+        ok = ~np.isnan(grid['doconcs'][:, col])
+        assert ok[1:11].all() and not ok[11:].any()
+    assert np.isnan(grid['doconcs'][:, 1]).all()
+    assert grid.done['doconcs'] == set([1, 2, 3])
+
+
+def test_update_without_ctd(tmpdir):
+    db = _setup(tmpdir, ctd_profiles=())
+    grid = ProfileGrid(pressure_bins(0, 200, 10))
+    assert grid.update(db, 'optode_1', ['doconcs']) == 3
+    assert np.isnan(grid['doconcs']).all()
+
+
+def test_save_load(tmpdir):
+    db = _setup(tmpdir)
+    grid = ProfileGrid(pressure_bins(0, 200, 10), stat='median')
+    grid.update(db, 'optode_1', ['doconcs'])
+    path = os.path.join(str(tmpdir), 'grid.npz')
+    grid.save(path)
+    copy = ProfileGrid.load(path)
+    assert copy.stat == 'median'
+    assert list(copy.data) == ['doconcs']
+    np.testing.assert_array_equal(copy['doconcs'], grid['doconcs'])
+    np.testing.assert_array_equal(copy.pnums, grid.pnums)
+    assert copy.done == grid.done
@@ -0,0 +1,76 @@
+import os
+import pytest
+from dpdata import synth
+from dpdata.schema import get_schema
+from dpdata.sql import make_table, insert_batch
+from dpdata.util.mpk2sql import load_batches, load_records, _expander
+from sqlalchemy import create_engine, MetaData, select, func
+
+
+def _setup(tmpdir, duration=600):
+    archive = os.path.join(str(tmpdir), 'ctd_1.mpk')
+    n = synth.write_archive(archive, 'ctd_1', duration)
+    eng = create_engine('sqlite:///' + os.path.join(str(tmpdir), 'test.db'))
+    tbl = make_table(eng, 'ctd_1', MetaData(), get_schema())
+    return archive, n, eng, tbl
+
+
+def _count(conn, tbl):
+    return conn.execute(select([func.count()]).select_from(tbl)).scalar()
+
+
+def test_reload_skips_duplicates(tmpdir):
+    archive, n, eng, tbl = _setup(tmpdir)
+    conn = eng.connect()
+    with open(archive, 'rb') as f:
+        assert load_batches(conn, tbl.insert(), f, 100,
+                            _expander('ctd_1')) == (n, 0)
+    assert _count(conn, tbl) == n
+    with open(archive, 'rb') as f:
+        assert load_batches(conn, tbl.insert(), f, 100,
+                            _expander('ctd_1')) == (n, n)
+    assert _count(conn, tbl) == n
+
+
+def test_partial_reload(tmpdir):
+    archive, n, eng, tbl = _setup(tmpdir)
+    conn = eng.connect()
+    # Load every third record one at a time, then the whole file in
+    # batches which overlap the existing rows.
+    rows = list(synth.records('ctd_1', 600))
+    expand = _expander('ctd_1')
+    for secs, usecs, data in rows[::3]:
+        data['timestamp'] = secs * 1000000 + usecs
+        conn.execute(tbl.insert(), **expand(data))
+    nold = len(rows[::3])
+    with open(archive, 'rb') as f:
+        assert load_batches(conn, tbl.insert(), f, 64,
+                            expand) == (n, nold)
+    assert _count(conn, tbl) == n
+    with open(archive, 'rb') as f:
+        nrows, nskipped = load_records(conn, tbl.insert(), f, expand)
+    assert (nrows, nskipped) == (n, n)
+    assert _count(conn, tbl) == n
+
+
+def test_missing_columns(tmpdir):
+    archive, n, eng, tbl = _setup(tmpdir)
+    conn = eng.connect()
+    rows = [{'timestamp': 1, 'condwat': 1.0, 'tempwat': 2.0},
+            {'timestamp': 2, 'condwat': 1.5}]
+    assert insert_batch(conn, tbl.insert(), rows) == 0
+    other = eng.connect()
+    result = other.execute(select([tbl.c.timestamp, tbl.c.tempwat])
+                           .order_by(tbl.c.timestamp)).fetchall()
+    assert [tuple(r) for r in result] == [(1, 2.0), (2, None)]
+
+
+def test_error_rolls_back(tmpdir):
+    archive, n, eng, tbl = _setup(tmpdir)
+    conn = eng.connect()
+    bad = tbl.insert().values(nosuch=1)
+    with pytest.raises(Exception):
+        insert_batch(conn, bad, [{'timestamp': 1}])
+    assert not conn.in_transaction()
+    assert insert_batch(conn, tbl.insert(), [{'timestamp': 2}]) == 0
+    assert _count(eng.connect(), tbl) == 1
@@ -0,0 +1,60 @@
+import os
+import numpy as np
+import pandas as pd
+from dpdata.qc import Checker, check, qc_tests, update_flags, QC_RANGE
+from dpdata.schema import get_schema
+from dpdata.sql import make_table
+from sqlalchemy import create_engine, MetaData
+
+
+def _data(n=500, seed=0):
+    rng = np.random.RandomState(seed)
+    t = 1400000000000000 + np.arange(n, dtype='i8') * 250000
+    df = pd.DataFrame({'timestamp': t,
+                       'condwat': 30. + 0.01 * rng.standard_normal(n),
+                       'tempwat': 5. + 0.01 * rng.standard_normal(n),
+                       'preswat': 100. + 0.1 * np.arange(n)})
+    # Spikes, out of range values, a gap, stuck values and a jump in
+    # pressure.
+    df.loc[[10, 200, 201], 'condwat'] = 80.
+    df.loc[[50, 333], 'tempwat'] = 10.
+    df.loc[[120, 121], 'condwat'] = np.nan
+    df.loc[300:340, 'tempwat'] = 4.
+    df.loc[400:, 'preswat'] += 50.
+    return df
+
+
+def test_null_range():
+    dd = {'x': {'name': 'X', 'data': [{'name': 'v', 'desc': 'V',
+                                       'units': 'm',
+                                       'qc': {'range': None, 'spike': 1}}]}}
+    assert qc_tests('x', dd)['v']['range'] is None
+    flags = check({'timestamp': np.arange(3), 'v': [1e9, 1e9, 1e9]},
+                  'x', dd)
+    assert not (flags['v_qc'].values & QC_RANGE).any()
+
+
+def test_chunked_matches_whole():
+    df = _data()
+    expected = check(df, 'ctd_1')
+    assert (expected.iloc[:, 1:].values != 0).any()
+    for size in (1, 2, 3, 7, 999):
+        qc = Checker('ctd_1')
+        parts = [qc.check(df.iloc[i:i + size])
+                 for i in range(0, len(df), size)]
+        parts.append(qc.flush())
+        flags = pd.concat(parts, ignore_index=True)
+        pd.testing.assert_frame_equal(flags, expected.reset_index(drop=True))
+
+
+def test_update_flags(tmpdir):
+    eng = create_engine('sqlite:///' + os.path.join(str(tmpdir), 'test.db'))
+    make_table(eng, 'ctd_1', MetaData(), get_schema(), qc=True)
+    df = _data()
+    df.to_sql('ctd_1', eng, if_exists='append', index=False)
+    assert update_flags(eng, 'ctd_1', chunksize=7) == len(df)
+    expected = check(df, 'ctd_1')
+    names = list(expected.columns)
+    stored = pd.read_sql_query('SELECT {0} FROM ctd_1 ORDER BY '
+                               'timestamp'.format(', '.join(names)), eng)
+    np.testing.assert_array_equal(stored.values, expected.values)
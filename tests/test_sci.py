@@ -0,0 +1,82 @@
+"""
+Tests of dpdata.sci.dosv against the original (unblocked)
+implementation. Run this file as a script to benchmark the two.
+"""
+import numpy as np
+from numpy.testing import assert_allclose
+from dpdata.sci import dosv
+
+FOIL_COEFFS = [2.8e-3, 1.1e-4, 2.4e-6, 230., -0.3, -50., 4.5]
+
+
+def dosv_reference(Pt, T, S, P, Pdens, fc):
+    # dosv as it was before it was evaluated in blocks
+    ksv = fc[0] + fc[1]*T + fc[2]*T*T
+    p0 = fc[3] + fc[4]*T
+    pc = fc[5] + fc[6]*Pt
+    do = (p0 / pc - 1.) / ksv
+    do = 1000. * do / Pdens
+    pcomp = 1. + (0.032 * P) / 1000.
+    do = pcomp * do
+    B = np.array([-6.24097e-3, -6.93498e-3, -6.90358e-3, -4.29155e-3],
+                 dtype='f8')
+    C0 = -3.11680e-7
+    ts = np.log((298.15 - T)/(273.15 + T))
+    btmp = B[0] + ts*(B[1] + ts*(B[2] + ts*B[3]))
+    scomp = np.exp(S * btmp) + C0*S*S
+    return scomp * do
+
+
+def random_inputs(n, seed=0, dtype='f8'):
+    rng = np.random.RandomState(seed)
+    return [(30. + 10. * rng.random_sample(n)).astype(dtype),
+            (2. + 10. * rng.random_sample(n)).astype(dtype),
+            (33. + 2. * rng.random_sample(n)).astype(dtype),
+            (2000. * rng.random_sample(n)).astype(dtype),
+            (1025. + 3. * rng.random_sample(n)).astype(dtype)]
+
+
+def test_dosv_matches_reference():
+    # Sizes which are smaller than, equal to and not a multiple of
+    # the block size
+    for n in (1, 7, 100, 16384, 50001):
+        args = random_inputs(n, seed=n)
+        expected = dosv_reference(*(args + [FOIL_COEFFS]))
+        result = dosv(*(args + [FOIL_COEFFS]), blocksize=1000)
+        assert result.dtype == np.float64
+        assert_allclose(result, expected, rtol=1e-12)
+
+
+def test_dosv_out_and_broadcast():
+    args = random_inputs(1000)
+    expected = dosv_reference(*(args + [FOIL_COEFFS]))
+    out = np.empty(1000)
+    assert dosv(*(args + [FOIL_COEFFS]), out=out) is out
+    assert_allclose(out, expected, rtol=1e-12)
+    # Non-contiguous output
+    out = np.zeros(2000)[::2]
+    assert dosv(*(args + [FOIL_COEFFS]), out=out, blocksize=64) is out
+    assert_allclose(out, expected, rtol=1e-12)
+    # Scalar pressure and density
+    args[3], args[4] = 100., 1026.
+    assert_allclose(dosv(*(args + [FOIL_COEFFS])),
+                    dosv_reference(*(args + [FOIL_COEFFS])), rtol=1e-12)
+
+
+def test_dosv_dtype():
+    args = random_inputs(1000, dtype='f4')
+    result = dosv(*(args + [FOIL_COEFFS]))
+    assert result.dtype == np.float32
+    assert_allclose(result, dosv_reference(*(args + [FOIL_COEFFS])),
+                    rtol=1e-4)
+    # A float64 scalar must not be downcast to float32
+    args[3] = 100.
+    assert dosv(*(args + [FOIL_COEFFS])).dtype == np.float64
+
+
+if __name__ == '__main__':
+    import timeit
+    args = random_inputs(3000000) + [FOIL_COEFFS]
+    for name, func in (('reference', dosv_reference), ('blocked', dosv)):
+        best = min(timeit.repeat(lambda: func(*args), number=1, repeat=5))
+        print('{0:10s} {1:8.1f} ms'.format(name, best * 1000.))